@@ -2,73 +2,120 @@ import pickle,os,sys, json
 import torch
 import numpy as np
 from torch.utils.data import Dataset
+from transformers import AutoTokenizer
+from dataloaders.cache import get_cache_dir, load_or_build_samples
 # from VideoAlignment.dataset.data_augment import create_data_augment
 USER = os.environ['USER']
 
 bonelink = [(0, 1), (0, 2), (0, 3), (1, 4), (2,5), (3,6), (4, 7), (5, 8), (6, 9), (7, 10), 
             (8, 11), (9, 12), (9, 13), (9, 14), (12, 15), (13, 16), (14, 17), (16, 18), (17, 19), (18,  20), (19, 21)]
 
-def generate_data(current_keypoints ):
-    joint_coordinate    = np.zeros((3,len(current_keypoints),22))
-    bone_coordinate     = np.zeros((3,len(current_keypoints),22))
-    for i in range(len(current_keypoints)):
-        for j in range(0,len(current_keypoints[i]),3):
-            joint_coordinate[:, i, j//3] = current_keypoints[i, j: j+3]
+# Labels are tokenized with the t5-base tokenizer and truncated to this many tokens, pad token id of T5 is 0
+max_label_length    = 160
+pad_token_id        = 0
 
-    for v1, v2 in bonelink:
-        bone_coordinate[:, :, v2] = joint_coordinate[:, :, v1] - joint_coordinate[:, :, v2]
+# parent / child joint index of every bone, used to build the bone coordinates in one gather
+bone_parent = np.array([v1 for v1, _ in bonelink])
+bone_child  = np.array([v2 for _, v2 in bonelink])
 
-    coordinates = np.concatenate((joint_coordinate, bone_coordinate), axis=0)
-    return coordinates
+def generate_data_batch(keypoints_list, num_joints = 22):
+    '''
+        Convert a list of variable-length keypoint sequences into joint/bone coordinates at once.
+        @keypoints_list : list of [number of frame, joints(22) * coordinates(3)] arrays
+        return          : list of float32 arrays, each [coordinates(6), number of frame, joints(22)]
+        The returned arrays are views of one shared buffer, so the whole list costs a single allocation.
+    '''
+    lengths = [len(keypoints) for keypoints in keypoints_list]
+    if sum(lengths) == 0:
+        return [np.zeros((6, 0, num_joints), dtype=np.float32) for _ in keypoints_list]
+    flat = np.concatenate([np.asarray(keypoints).reshape(len(keypoints), -1) for keypoints in keypoints_list], axis=0)
+    assert flat.shape[1] % 3 == 0 and flat.shape[1] // 3 <= num_joints, f"Unexpected keypoint width {flat.shape[1]}"
+
+    # [coordinates(3), all frames, joints(22)] in the input precision, joints missing from the input stay zero
+    joint_coordinate = np.zeros((3, flat.shape[0], num_joints), dtype=np.result_type(flat.dtype, np.float32))
+    joint_coordinate[:, :, :flat.shape[1] // 3] = flat.reshape(flat.shape[0], -1, 3).transpose(2, 0, 1)
+
+    # [coordinates(6), all frames, joints(22)], joints first then bones, bones without a parent stay zero
+    coordinates = np.zeros((6, flat.shape[0], num_joints), dtype=np.float32)
+    coordinates[:3] = joint_coordinate
+    coordinates[3:, :, bone_child] = joint_coordinate[:, :, bone_parent] - joint_coordinate[:, :, bone_child]
+    return np.split(coordinates, np.cumsum(lengths)[:-1], axis=1)
+
+def generate_data(current_keypoints):
+    return generate_data_batch([current_keypoints])[0]
 
 class DatasetLoader(Dataset):
     def __init__(self,cfg, pretrain, pkl_file):
         self.cfg = cfg
-        with open(pkl_file, 'rb') as f:
-            self.data_list = pickle.load(f)
+        self.standard_path = None
         if not pretrain:
             if cfg.TASK.SPORT == 'Skating' :
-                standard_path = '/home/andrewchen/Error_Localize/standard_features.pkl'
+                self.standard_path = '/home/andrewchen/Error_Localize/standard_features.pkl'
             if cfg.TASK.SPORT == 'Boxing' :
-                standard_path = '/home/andrewchen/Error_Localize/standard_features_boxing.pkl'
+                self.standard_path = '/home/andrewchen/Error_Localize/standard_features_boxing.pkl'
+
+        # Reuse the preprocessed samples of an earlier run if DATA.CACHE_DIR is set
+        if hasattr(cfg.DATA,'CACHE_DIR') and cfg.DATA.CACHE_DIR:
+            cache_dir = get_cache_dir(cfg, pretrain, pkl_file, self.standard_path)
+            self.samples, self.max_len, index_dict, self.standard = load_or_build_samples(cache_dir, lambda: self.build_samples(pretrain, pkl_file))
+        else:
+            self.samples, self.max_len, index_dict, self.standard = self.build_samples(pretrain, pkl_file)
+        print('Sample length:', len(self.samples))
+        self.tokenizer = AutoTokenizer.from_pretrained('t5-base', use_fast=True)
+        self.tokenize_labels()
+
+        # Samples of the same motion (one per augmented label) share their feature arrays
+        groups = {}
+        for index, (features, _, video_name, _, _, _) in enumerate(self.samples):
+            groups.setdefault((video_name, id(features)), []).append(index)
+        self.groups = list(groups.values())
+
+        with open(cfg.JSONDIR+'/index_dict_results.json', 'w') as f:
+            json.dump(index_dict, f, indent=4)
 
-            with open(standard_path, 'rb') as f:
+    def build_samples(self, pretrain, pkl_file):
+        cfg = self.cfg
+        with open(pkl_file, 'rb') as f:
+            data_list = pickle.load(f)
+        if not pretrain:
+            with open(self.standard_path, 'rb') as f:
                 standard_features_file = pickle.load(f)
-                self.standard_features_list = [generate_data(item['features']) for item in standard_features_file]
+                standard_features_list = generate_data_batch([item['features'] for item in standard_features_file])
 
-        self.samples = []
+        samples = []
         max_len = 0  
         
         if pretrain:
-            self.standard = generate_data(self.data_list[0]['features'])
+            standard = generate_data(data_list[0]['features'])
         if not pretrain:
-            self.standard = generate_data(self.data_list[0]['features'])
-            if 'train' in pkl_file and 'standard' in self.data_list[0]['name']:
-                print(f'Standard motion {self.data_list[0]["name"]} found, skipping')
-                self.data_list = self.data_list[1:] ## RGB subtract the standard already, no need to append standard 
+            standard = generate_data(data_list[0]['features'])
+            if 'train' in pkl_file and 'standard' in data_list[0]['name']:
+                print(f'Standard motion {data_list[0]["name"]} found, skipping')
+                data_list = data_list[1:] ## RGB subtract the standard already, no need to append standard 
 
-        print('Data List Length:', len(self.data_list))
+        print('Data List Length:', len(data_list))
         index_dict = {}
-        for item in self.data_list:
-            features =  generate_data(item['features'])
+        features_list = generate_data_batch([item['features'] for item in data_list])
+        for item, features in zip(data_list, features_list):
             ## Figure Skating
             if cfg.TASK.SPORT == 'Skating' :
                 if   'Axel'     in item['original_video_file']:
-                    std_features = self.standard_features_list[0]
+                    std_features, routine = standard_features_list[0], 'Axel'
                 elif 'Axel_com' in item['original_video_file']:
-                    std_features = self.standard_features_list[1]
+                    std_features, routine = standard_features_list[1], 'Axel_com'
                 elif 'Loop'     in item['original_video_file']:
-                    std_features = self.standard_features_list[2]
+                    std_features, routine = standard_features_list[2], 'Loop'
                 else:
-                    std_features = self.standard_features_list[3]
+                    std_features, routine = standard_features_list[3], 'Lutz'
 
             if cfg.TASK.SPORT == 'Boxing' :
                 if 'back'         in item['video_name']:
-                    std_features = self.standard_features_list[0]
+                    std_features, routine = standard_features_list[0], 'back'
                 elif 'front'    in item['video_name']:
-                    std_features = self.standard_features_list[1]
+                    std_features, routine = standard_features_list[1], 'front'
 
             video_name = item['video_name']
+            std_key = None
             trimmed_start = item['trimmed_start'] if 'trimmed_start' in item else 0
             if not item['standard_longer']:
                 start_frame = item['start_frame']   + trimmed_start
@@ -112,6 +159,7 @@ class DatasetLoader(Dataset):
                 standard_longer? {item['standard_longer']},
                 """
             elif hasattr(self.cfg.TASK,'DIFFERENCE_TYPE') and self.cfg.TASK.DIFFERENCE_TYPE== 'Skeleton':
+                routine_len = std_features.shape[1]
                 # deal with error segment selection
                 if self.cfg.args.eval_name == 'segment': ## if segmenting, need to further adjust the video and the standard
                     print(f"Error segmenting {item['video_name']}")
@@ -131,9 +179,11 @@ class DatasetLoader(Dataset):
                             std_start_frame     = int(item['start_frame'])      +   int(item['error_start_frame'])
                             std_error_end_frame = int(item['start_frame'])      + ( int(item['error_end_frame']) - 1)
                     features        = features[:,int(feature_start_frame):int(feature_end_frame)]
+                    std_window_start = int(std_start_frame)
                     std_features    = std_features[:,int(std_start_frame):int(std_error_end_frame)]
                 else:
                     features        = features[:,int(start_frame):int(end_frame)] 
+                    std_window_start = int(item['std_start_frame'])
                     std_features    = std_features[:,int(item['std_start_frame']):int(item['std_end_frame'])]
                     index_dict[item['video_name']] = {
                         # "original_seq_len"  : int(item['original_seq_len']),
@@ -163,6 +213,9 @@ class DatasetLoader(Dataset):
                 trimmed_start = {item['trimmed_start']}, trimmed_end = {item['trimmed_end']}, \n
                 standard_longer? {item['standard_longer']},
                 """
+                # Identifies the standard frames of the sample for the standard embedding cache of SimpleT5Model
+                std_window_start = min(max(std_window_start, 0), routine_len)
+                std_key = f"{routine}:{std_window_start}:{std_window_start + std_features.shape[1]}"
             else:
                 subtraction = torch.empty(0)
             for label in labels:
@@ -173,30 +226,58 @@ class DatasetLoader(Dataset):
                 if features.shape[1] == 0:
                     print(f"Skipping {video_name} as no frames found")
                     continue
-                self.samples.append((features, label, video_name,subtraction, std_features)) 
+                samples.append((features, label, video_name,subtraction, std_features, std_key)) 
         # generate a tensor that is zero, shape is (64,128)
-        # self.samples.append((self.standard_features_list[0], '', 'back',      torch.zeros(self.standard_features_list[0].shape[1],128), self.standard_features_list[0])) 
-        # self.samples.append((self.standard_features_list[1], '', 'front',     torch.zeros(self.standard_features_list[1].shape[1],128), self.standard_features_list[1])) 
-        # self.samples.append((self.standard_features_list[0], '', 'Axel',      torch.zeros(self.standard_features_list[0].shape[1],128), self.standard_features_list[0])) 
-        # self.samples.append((self.standard_features_list[1], '', 'Axel_com',  torch.zeros(self.standard_features_list[1].shape[1],128), self.standard_features_list[1])) 
-        # self.samples.append((self.standard_features_list[2], '', 'Loop',      torch.zeros(self.standard_features_list[2].shape[1],128), self.standard_features_list[2])) 
-        # self.samples.append((self.standard_features_list[3], '', 'Lutz',      torch.zeros(self.standard_features_list[3].shape[1],128), self.standard_features_list[3])) 
-        print('Sample length:', len(self.samples))
-        self.max_len = max_len  
+        # samples.append((standard_features_list[0], '', 'back',      torch.zeros(standard_features_list[0].shape[1],128), standard_features_list[0])) 
+        # samples.append((standard_features_list[1], '', 'front',     torch.zeros(standard_features_list[1].shape[1],128), standard_features_list[1])) 
+        # samples.append((standard_features_list[0], '', 'Axel',      torch.zeros(standard_features_list[0].shape[1],128), standard_features_list[0])) 
+        # samples.append((standard_features_list[1], '', 'Axel_com',  torch.zeros(standard_features_list[1].shape[1],128), standard_features_list[1])) 
+        # samples.append((standard_features_list[2], '', 'Loop',      torch.zeros(standard_features_list[2].shape[1],128), standard_features_list[2])) 
+        # samples.append((standard_features_list[3], '', 'Lutz',      torch.zeros(standard_features_list[3].shape[1],128), standard_features_list[3])) 
+        return samples, max_len, index_dict, standard
+
+    def tokenize_labels(self):
+        '''
+            Tokenize every label (with its "Motion Instruction : " / "Motion Description : " prefix) once.
+            The token ids of all samples are stored back to back in one int32 array,
+            the ids of sample i are label_ids[label_offsets[i] : label_offsets[i+1]].
+        '''
+        labels      = [label for _, label, _, _, _, _ in self.samples]
+        input_ids   = self.tokenizer(labels, truncation=True, max_length=max_label_length)['input_ids'] if len(labels) > 0 else []
+        lengths     = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+        self.label_offsets  = np.concatenate(([0], np.cumsum(lengths)))
+        self.label_ids      = np.fromiter((token for ids in input_ids for token in ids), dtype=np.int32, count=int(lengths.sum()))
 
-        with open(cfg.JSONDIR+'/index_dict_results.json', 'w') as f:
-            json.dump(index_dict, f, indent=4)
     def __len__(self):
         return len(self.samples)
 
+    def frame_lengths(self):
+        # Number of frames of every sample, for the bucket samplers
+        return [features.shape[1] for features, *_ in self.samples]
+
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
+        if isinstance(idx, list):
+            return self.get_group(idx)
 
         ## features: 6 x frame x 22
-        features, label, video_name, subtraction, std_features = self.samples[idx]
+        features, label, video_name, subtraction, std_features, std_key = self.samples[idx]
         keypoints_mask  = torch.ones(22)       
         current_len     = torch.tensor(len(features[0]))
 
+        label_ids       = torch.from_numpy(self.label_ids[self.label_offsets[idx]:self.label_offsets[idx + 1]]).long()
+
         # change self.standard to std_features
-        return  video_name, torch.FloatTensor(features), torch.FloatTensor(keypoints_mask),  torch.FloatTensor(std_features), current_len, label, subtraction
+        return  video_name, torch.FloatTensor(features), torch.FloatTensor(keypoints_mask),  torch.FloatTensor(std_features), current_len, label, subtraction, label_ids, std_key
+
+    def get_group(self, indices):
+        '''
+            One motion with several of its labels, used by the grouped training mode.
+            @indices : sample indices of the same motion (an entry of self.groups)
+            return   : the item of indices[0] with label and label_ids replaced by lists over all indices
+        '''
+        video_name, features, keypoints_mask, std_features, current_len, _, subtraction, _, std_key = self[indices[0]]
+        labels      = [self.samples[idx][1] for idx in indices]
+        label_ids   = [torch.from_numpy(self.label_ids[self.label_offsets[idx]:self.label_offsets[idx + 1]]).long() for idx in indices]
+        return video_name, features, keypoints_mask, std_features, current_len, labels, subtraction, label_ids, std_key
@@ -4,13 +4,26 @@ if __name__ == "__main__":
     sys.path.append('/home/c1l1mo/projects/MotionExpert')
     ## path for VideoAlignment submodule
     sys.path.append(os.path.join(os.getcwd(),os.pardir,"VideoAlignment"))
-from dataloaders.Dataset import DatasetLoader
+from dataloaders.Dataset import DatasetLoader, max_label_length, pad_token_id
+from dataloaders.sampler import DistributedBucketSampler, MotionGroupBatchSampler, ResumableBatchSampler
 from torch.utils.data import DataLoader
 from torch.nn.utils.rnn import pad_sequence
+from functools import partial
 import numpy as np
 
-def collate_fn(batch):
-    video_name, keypoints, keypoints_mask, standard, seq_len, label, subtraction = zip(*batch)
+def collate_fn(batch, dynamic_padding=False, pad_to_multiple_of=None):
+    '''
+        @dynamic_padding    : pad the labels to the longest label of the batch instead of max_label_length,
+                              padded label positions are set to -100 so they are ignored by the loss
+        @pad_to_multiple_of : with dynamic_padding, round the decoder length up to a multiple of this value
+    '''
+    video_name, keypoints, keypoints_mask, standard, seq_len, label, subtraction, label_ids, standard_key = zip(*batch)
+    # Grouped items carry one motion with a list of labels, label_group maps every label row to its motion
+    label_group = None
+    if len(label) > 0 and isinstance(label[0], list):
+        label_group = torch.repeat_interleave(torch.arange(len(label)), torch.tensor([len(l) for l in label]))
+        label       = tuple(l for labels in label for l in labels)
+        label_ids   = tuple(ids for group in label_ids for ids in group)
     def collect_video_from_batch(batch, idx=1):
         seq = []
         # convert to [number of frame , coordinates(6), joints(22)]
@@ -32,36 +45,94 @@ def collate_fn(batch):
     
     seq_len = torch.stack(seq_len,dim=0)
     subtraction =pad_sequence(subtraction,batch_first=True,padding_value=0) 
+
+    # pre-tokenized labels, padded and shifted for teacher forcing
+    label_len = torch.tensor([len(ids) for ids in label_ids])
+    if dynamic_padding:
+        decoder_len = max(int(label_len.max()) - 1, 1)
+        if pad_to_multiple_of:
+            decoder_len = -(-decoder_len // pad_to_multiple_of) * pad_to_multiple_of
+        tgt_len = decoder_len + 1
+    else:
+        tgt_len = max_label_length
+    tgt_batch = torch.full((len(label_ids), tgt_len), pad_token_id, dtype=torch.long)
+    for i, ids in enumerate(label_ids):
+        tgt_batch[i, :len(ids)] = ids
+    decoder_input_ids   = tgt_batch[:, :-1]
+    labels              = tgt_batch[:, 1:].clone()
+    if dynamic_padding:
+        # label j is the token j + 1 of the target, mask every position after the end of the target
+        labels[torch.arange(tgt_len - 1).unsqueeze(0) >= (label_len - 1).unsqueeze(1)] = -100
     # change standard to padded_standard
-    return (video_name), padded_keypoints, keypoints_mask, (padded_standard), (seq_len), (label), subtraction
+    return (video_name), padded_keypoints, keypoints_mask, (padded_standard), (seq_len), (label), subtraction, decoder_input_ids, labels, label_group, standard_key
 
 def construct_dataloader(split,cfg,pkl_file):
     if split == 'train' : 
         batch_size = cfg.DATA.BATCH_SIZE
     elif split == 'test' :
         batch_size = cfg.DATA.BATCH_SIZE
-        if(not cfg.TASK.PRETRAIN):
+        if hasattr(cfg.DATA,'EVAL_BATCH_SIZE') and cfg.DATA.EVAL_BATCH_SIZE:
+            # generate masks the padded frames, so batched evaluation decodes every sample as with a batch size of 1
+            batch_size = cfg.DATA.EVAL_BATCH_SIZE
+        elif(not cfg.TASK.PRETRAIN):
             batch_size = 1
 
     dataset = DatasetLoader(cfg,cfg.TASK.PRETRAIN,pkl_file)
+    if hasattr(cfg.DATA,'DYNAMIC_PADDING') and cfg.DATA.DYNAMIC_PADDING:
+        pad_to_multiple_of = cfg.DATA.PAD_TO_MULTIPLE_OF if hasattr(cfg.DATA,'PAD_TO_MULTIPLE_OF') else None
+        collate = partial(collate_fn, dynamic_padding=True, pad_to_multiple_of=pad_to_multiple_of)
+    else:
+        collate = collate_fn
 
-    if split == 'train':
+    if split == 'train' and hasattr(cfg.DATA,'GROUPED_LABELS') and cfg.DATA.GROUPED_LABELS:
+        # Distributed Training, batches of motions, every motion is encoded once and decoded against several labels
+        labels_per_motion = cfg.DATA.LABELS_PER_MOTION if hasattr(cfg.DATA,'LABELS_PER_MOTION') else None
+        if hasattr(cfg.DATA,'BUCKET_SAMPLER') and cfg.DATA.BUCKET_SAMPLER:
+            bucket_size = cfg.DATA.BUCKET_SIZE if hasattr(cfg.DATA,'BUCKET_SIZE') else 100
+            lengths = dataset.frame_lengths()
+            lengths = [lengths[group[0]] for group in dataset.groups]
+            motion_sampler = DistributedBucketSampler(lengths, batch_size, shuffle=True, drop_last=True, bucket_size=bucket_size)
+        else:
+            sampler = torch.utils.data.distributed.DistributedSampler(range(len(dataset.groups)),shuffle=True)
+            motion_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=True)
+        batch_sampler = MotionGroupBatchSampler(motion_sampler, dataset.groups, labels_per_motion)
+        dataloader = DataLoader(dataset, batch_sampler=ResumableBatchSampler(batch_sampler), collate_fn=collate, generator=torch.Generator())
+    elif split == 'train' and hasattr(cfg.DATA,'BUCKET_SAMPLER') and cfg.DATA.BUCKET_SAMPLER:
+        # Distributed Training, batches of clips with similar number of frames to reduce padding
+        bucket_size = cfg.DATA.BUCKET_SIZE if hasattr(cfg.DATA,'BUCKET_SIZE') else 100
+        lengths = dataset.frame_lengths()
+        batch_sampler = DistributedBucketSampler(lengths, batch_size, shuffle=True, drop_last=True, bucket_size=bucket_size)
+        dataloader = DataLoader(dataset, batch_sampler=ResumableBatchSampler(batch_sampler), collate_fn=collate, generator=torch.Generator())
+    elif split == 'train':
         # Distributed Training
         sampler = torch.utils.data.distributed.DistributedSampler(dataset,shuffle=True)
-        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, drop_last=True, sampler=sampler,collate_fn=collate_fn)
+        batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=True)
+        dataloader = DataLoader(dataset, batch_sampler=ResumableBatchSampler(batch_sampler), collate_fn=collate, generator=torch.Generator())
     elif split == "test":
         # Distributed Training
         sampler = torch.utils.data.distributed.DistributedSampler(dataset,shuffle=False)
-        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, drop_last=False,sampler=sampler,collate_fn=collate_fn)
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, drop_last=False,sampler=sampler,collate_fn=collate)
 
     return dataloader
 
+def set_epoch(dataloader, epoch):
+    # The training loaders draw the seed of every epoch from their own generator instead of the global RNG,
+    # so a run resumed in the middle of an epoch (RNG states restored) makes the same random draws
+    if dataloader.generator is not None:
+        dataloader.generator.manual_seed(epoch)
+    # The bucket sampler replaces the batch sampler, the DistributedSampler is the plain sampler
+    if hasattr(dataloader.batch_sampler,'set_epoch'):
+        dataloader.batch_sampler.set_epoch(epoch)
+    elif hasattr(dataloader.sampler,'set_epoch'):
+        dataloader.sampler.set_epoch(epoch)
+
 if __name__ == "__main__":
     from easydict import EasyDict as edict
     import torch.distributed as dist
     import yaml
 
-    dist.init_process_group(backend='nccl', init_method='env://')
+    from utils.dist import init_distributed
+    init_distributed()
     rank = dist.get_rank()
 
     CONFIG = edict()
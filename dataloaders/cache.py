@@ -0,0 +1,116 @@
+'''
+    Persistent on-disk cache of the samples built by DatasetLoader.
+
+    The cache directory is content addressed : its name is the hash of the dataset pickle, the standard
+    routine pickle and every config value that changes how the samples are built. Each directory holds
+        index.json             : labels, video names, standard window keys, per-sample shard offsets, max_len and index_dict
+        <kind>.f32             : float32 shard of every features / std_features / subtraction / standard array
+    The shards are opened with np.memmap, so every rank maps the same pages instead of holding a private copy.
+'''
+import os, json, shutil, hashlib
+import numpy as np
+import torch
+import torch.distributed as dist
+
+CACHE_VERSION   = 2
+SHARD_KINDS     = ['features', 'std_features', 'subtraction', 'standard']
+
+def file_hash(path, chunk_size = 1 << 24):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def get_cache_dir(cfg, pretrain, pkl_file, standard_path):
+    args = cfg.args if hasattr(cfg, 'args') else None
+    key = { 'version'           : CACHE_VERSION,
+            'pkl_file'          : file_hash(pkl_file),
+            'standard_file'     : file_hash(standard_path) if standard_path is not None else None,
+            # labels are expanded differently for the training split
+            'train'             : 'train' in pkl_file,
+            'pretrain'          : bool(pretrain),
+            'sport'             : cfg.TASK.SPORT if hasattr(cfg.TASK, 'SPORT') else None,
+            'difference_type'   : cfg.TASK.DIFFERENCE_TYPE if hasattr(cfg.TASK, 'DIFFERENCE_TYPE') else None,
+            'eval_name'         : getattr(args, 'eval_name', None)}
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(cfg.DATA.CACHE_DIR, digest)
+
+def save_samples(cache_dir, samples, max_len, index_dict, standard):
+    # Write into a temporary directory first so a crashed run never leaves a half written cache behind
+    tmp_dir = cache_dir + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    shards  = {kind: open(os.path.join(tmp_dir, kind + '.f32'), 'wb') for kind in SHARD_KINDS}
+    entries = {kind: [] for kind in SHARD_KINDS}
+    offsets = {kind: 0 for kind in SHARD_KINDS}
+    # Augmented labels of one video share the same arrays, store every array only once
+    written = {kind: {} for kind in SHARD_KINDS}
+
+    def write(kind, array):
+        key = id(array)
+        if key in written[kind]:
+            return written[kind][key]
+        if torch.is_tensor(array):
+            array = array.cpu().numpy()
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        shards[kind].write(array.tobytes())
+        entries[kind].append([offsets[kind], list(array.shape)])
+        offsets[kind] += array.size
+        written[kind][key] = len(entries[kind]) - 1
+        return len(entries[kind]) - 1
+
+    index_samples = []
+    for features, label, video_name, subtraction, std_features, std_key in samples:
+        index_samples.append([write('features', features), label, video_name,
+                              write('subtraction', subtraction), write('std_features', std_features), std_key])
+    standard_entry = write('standard', standard) if standard is not None else None
+    for f in shards.values():
+        f.close()
+
+    index = {   'max_len'       : int(max_len),
+                'index_dict'    : index_dict,
+                'standard'      : standard_entry,
+                'samples'       : index_samples,
+                'entries'       : entries}
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # Another process finished the same cache first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print(f"Saved {len(samples)} samples to dataset cache {cache_dir}")
+
+def load_samples(cache_dir):
+    with open(os.path.join(cache_dir, 'index.json')) as f:
+        index = json.load(f)
+
+    arrays = {}
+    for kind in SHARD_KINDS:
+        path = os.path.join(cache_dir, kind + '.f32')
+        # np.memmap refuses empty files, copy-on-write keeps the pages shared while giving writable arrays
+        shard = np.memmap(path, dtype=np.float32, mode='c') if os.path.getsize(path) > 0 else np.zeros(0, dtype=np.float32)
+        arrays[kind] = [shard[offset:offset + int(np.prod(shape))].reshape(shape) for offset, shape in index['entries'][kind]]
+    subtractions = [torch.from_numpy(np.array(array)) for array in arrays['subtraction']]
+
+    samples = []
+    for features, label, video_name, subtraction, std_features, std_key in index['samples']:
+        samples.append((arrays['features'][features], label, video_name, subtractions[subtraction], arrays['std_features'][std_features], std_key))
+    standard = arrays['standard'][index['standard']] if index['standard'] is not None else None
+    print(f"Loaded {len(samples)} samples from dataset cache {cache_dir}")
+    return samples, index['max_len'], index['index_dict'], standard
+
+def load_or_build_samples(cache_dir, build_samples):
+    '''
+        Rank 0 builds and writes the cache on a miss while the other ranks wait at the barrier,
+        then every rank maps the same shards.
+        @build_samples : callable returning (samples, max_len, index_dict, standard)
+    '''
+    distributed = dist.is_available() and dist.is_initialized()
+    if not distributed or dist.get_rank() == 0:
+        if not os.path.exists(os.path.join(cache_dir, 'index.json')):
+            os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+            save_samples(cache_dir, *build_samples())
+    if distributed:
+        dist.barrier()
+    return load_samples(cache_dir)
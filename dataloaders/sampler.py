@@ -0,0 +1,159 @@
+import math
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+class DistributedBucketSampler(Sampler):
+    '''
+        Batch sampler that puts clips of similar frame count into the same batch, so collate_fn pads less.
+
+        Every epoch the indices are shuffled with seed + epoch, cut into buckets of
+        @bucket_size batches and sorted by length inside each bucket. Consecutive batches are then grouped
+        into steps of num_replicas batches and the steps are shuffled, so every rank gets a batch of
+        similar length at the same step (keeping the ranks in lockstep) and the same number of batches.
+        Call set_epoch at the start of every epoch, exactly like DistributedSampler.
+    '''
+    def __init__(self, lengths, batch_size, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=True, bucket_size=100):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.lengths        = torch.as_tensor(lengths, dtype=torch.long)
+        self.batch_size     = batch_size
+        self.num_replicas   = num_replicas
+        self.rank           = rank
+        self.shuffle        = shuffle
+        self.seed           = seed
+        self.drop_last      = drop_last
+        self.bucket_size    = bucket_size
+        self.epoch          = 0
+
+        num_batches = len(self.lengths) // batch_size if drop_last else math.ceil(len(self.lengths) / batch_size)
+        if drop_last:
+            self.num_steps = num_batches // num_replicas
+        else:
+            self.num_steps = math.ceil(num_batches / num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_steps(self):
+        # Identical on every rank : [num_steps, num_replicas] lists of index batches
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=g)
+        else:
+            indices = torch.arange(len(self.lengths))
+
+        # Sort by length inside every bucket, the ties keep the shuffled order
+        bucket = self.batch_size * self.bucket_size
+        indices = torch.cat([chunk[torch.argsort(self.lengths[chunk], stable=True)] for chunk in torch.split(indices, bucket)])
+        batches = list(torch.split(indices, self.batch_size))
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+
+        num_batches = self.num_steps * self.num_replicas
+        while 0 < len(batches) < num_batches:
+            # Repeat the first batches so every rank gets the same number of batches
+            batches += batches[:num_batches - len(batches)]
+        batches = batches[:num_batches]
+
+        steps = [batches[i:i + self.num_replicas] for i in range(0, num_batches, self.num_replicas)]
+        if self.shuffle:
+            steps = [steps[i] for i in torch.randperm(len(steps), generator=g).tolist()]
+        return steps
+
+    def __iter__(self):
+        for step in self.get_steps():
+            yield step[self.rank].tolist()
+
+    def __len__(self):
+        return self.num_steps
+
+    def padding_efficiency(self):
+        '''
+            Real frames divided by padded frames of this rank's batches in the current epoch,
+            together with the same ratio for randomly drawn batches of the same size.
+        '''
+        real, padded = 0, 0
+        for step in self.get_steps():
+            batch_lengths = self.lengths[step[self.rank]]
+            real    += batch_lengths.sum().item()
+            padded  += batch_lengths.max().item() * len(batch_lengths)
+
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        random_lengths = self.lengths[torch.randperm(len(self.lengths), generator=g)]
+        random_lengths = random_lengths[:len(random_lengths) // self.batch_size * self.batch_size].view(-1, self.batch_size)
+        random_real     = random_lengths.sum().item()
+        random_padded   = random_lengths.max(dim=1).values.sum().item() * self.batch_size if len(random_lengths) > 0 else 0
+        return real / max(padded, 1), random_real / max(random_padded, 1)
+
+class MotionGroupBatchSampler(Sampler):
+    '''
+        Grouped training mode : wraps a batch sampler over motion indices and turns every motion into the
+        list of its sample indices (one per label), so a batch carries every motion once with K labels.
+        @groups             : sample indices of every motion, DatasetLoader.groups
+        @labels_per_motion  : number of labels drawn per motion and epoch, None uses all of them
+    '''
+    def __init__(self, motion_sampler, groups, labels_per_motion=None, seed=0):
+        self.motion_sampler     = motion_sampler
+        self.groups             = groups
+        self.labels_per_motion  = labels_per_motion
+        self.seed               = seed
+        self.epoch              = 0
+        if hasattr(motion_sampler, 'padding_efficiency'):
+            self.padding_efficiency = motion_sampler.padding_efficiency
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.motion_sampler, 'set_epoch'):
+            self.motion_sampler.set_epoch(epoch)
+        elif hasattr(self.motion_sampler.sampler, 'set_epoch'):
+            self.motion_sampler.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        for motions in self.motion_sampler:
+            batch = []
+            for motion in motions:
+                group = self.groups[motion]
+                if self.labels_per_motion is not None and self.labels_per_motion < len(group):
+                    group = [group[i] for i in torch.randperm(len(group), generator=g)[:self.labels_per_motion].tolist()]
+                batch.append(group)
+            yield batch
+
+    def __len__(self):
+        return len(self.motion_sampler)
+
+class ResumableBatchSampler(Sampler):
+    '''
+        Wraps the training batch sampler so a run resumes in the middle of an epoch : after set_start(step) the next
+        epoch skips its first step batches. Only the indices are drawn, no sample is loaded, and the wrapped sampler
+        draws them in the same order as without the interruption (DistributedSampler, bucket or motion group sampler).
+    '''
+    def __init__(self, batch_sampler):
+        self.batch_sampler  = batch_sampler
+        self.start          = 0
+        if hasattr(batch_sampler, 'padding_efficiency'):
+            self.padding_efficiency = batch_sampler.padding_efficiency
+
+    def set_epoch(self, epoch):
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(epoch)
+        elif hasattr(self.batch_sampler.sampler, 'set_epoch'):
+            self.batch_sampler.sampler.set_epoch(epoch)
+
+    def set_start(self, step):
+        self.start = step
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        for step, batch in enumerate(self.batch_sampler):
+            if step >= start:
+                yield batch
+
+    def __len__(self):
+        return len(self.batch_sampler)
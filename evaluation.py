@@ -7,20 +7,22 @@ import torch.distributed as dist
 from pytorch_lightning import seed_everything
 from utils.parser import parse_args,load_config
 from utils.data_information import convert
-from cider import readJSON, readPickle, getGTCaptions, BLEUScore, CIDERScore
+from cider import readJSON, readPickle, getGTCaptions
+from utils.caption_metrics import caption_metrics
 from dataloaders import construct_dataloader
 from models.T5 import SimpleT5Model
-from transformers import AutoTokenizer, AdamW
+from transformers import AdamW
 from torch.utils.tensorboard import SummaryWriter
 from models import load_checkpoint
+from models.train_state import rng_state, set_rng_state
+from utils.dist import init_distributed, wrap_model, gather_results
+from utils.attention_store import save_attention, to_array
 os.environ['TOKENIZERS_PARALLELISM'] = "false"
 from tqdm import tqdm
 import numpy as np
-from datetime import timedelta
 import logging
 import pickle
 from bert_score import score
-from nlgmetricverse import NLGMetricverse,load_metric
 import dotenv
 
 logging.getLogger().setLevel(logging.WARNING)
@@ -28,36 +30,57 @@ dotenv.load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-def eval(cfg,eval_dataloader, model,epoch,summary_writer,sanity_check=False,store=None,name_list = None,logger=None, eval_name="",pkl_file=None):       
+def attention_videos(cfg, video_name, video_count):
+    '''
+        Names of the videos of a batch whose attention is exported, an empty list unless the config asks for it.
+        ATTENTION_EVERY_N : every Nth video seen by this process, counted from @video_count
+        ATTENTION_VIDEOS  : list of video names
+    '''
+    every_n = cfg.ATTENTION_EVERY_N if hasattr(cfg,'ATTENTION_EVERY_N') and cfg.ATTENTION_EVERY_N else None
+    names   = set(cfg.ATTENTION_VIDEOS) if hasattr(cfg,'ATTENTION_VIDEOS') and cfg.ATTENTION_VIDEOS else set()
+    return [name for i, name in enumerate(video_name) if name in names or (every_n is not None and (video_count + i) % every_n == 0)]
+
+def eval(*args, **kwargs):
+    '''
+        Evaluation that leaves the random state of the training untouched : evaluate_epoch reseeds every batch, the RNG
+        states are restored on exit, so a run resumed from a checkpoint continues on the same random stream as a run
+        that was not interrupted. Same arguments as evaluate_epoch.
+    '''
+    state = rng_state()
+    try:
+        return evaluate_epoch(*args, **kwargs)
+    finally:
+        set_rng_state(state)
+
+def evaluate_epoch(cfg,eval_dataloader, model,epoch,summary_writer,sanity_check=False,name_list = None,logger=None, eval_name="",pkl_file=None):       
     
     assert logger is not None, "Please provide logger object"
-    Tokenizer = AutoTokenizer.from_pretrained('t5-base', use_fast=True)
+    # Labels are tokenized once by the dataset, the tokenizer is only kept for the prompt and decoding
+    Tokenizer = eval_dataloader.dataset.tokenizer
     model.eval()
-    model = model.cuda()
     loss_list = [] 
+    generated_results = {}
     att_node_results = {}
     att_A_results = {}
     max_index_results = {}
+    video_count = 0
     prompt = "Motion Description : " if cfg.TASK.PRETRAIN else "Motion Instruction : "
+    prompt_ids = Tokenizer( [prompt],
+                            return_tensors="pt", 
+                            padding=True, 
+                            truncation=True, 
+                            max_length=160,
+                            add_special_tokens=False)['input_ids']
     with torch.no_grad():
         # Distributed Training
         if dist.get_rank() == 0:
             eval_dataloader = tqdm(eval_dataloader, total=len(eval_dataloader), desc='Evaluating')
         for index,batch in enumerate(eval_dataloader):
-            (video_name,src_batch,keypoints_mask_batch,standard,seq_len,label_batch,subtraction) = batch
+            (video_name,src_batch,keypoints_mask_batch,standard,seq_len,label_batch,subtraction,tgt_input,tgt_label,_,standard_key) = batch
             # If evaluating multiple checkpoints, dont do inference but directly load the result jsons
             if cfg.args.eval_multi: 
                 break
-            decoder_input_ids = Tokenizer(  [prompt],
-                                            return_tensors="pt", 
-                                            padding=True, 
-                                            truncation=True, 
-                                            max_length=160,
-                                            add_special_tokens=False)['input_ids']
-            decoder_input_ids = decoder_input_ids.repeat(src_batch.shape[0], 1).to(src_batch.device)
-            tgt_batch = Tokenizer(label_batch, return_tensors="pt", padding="max_length", truncation=True, max_length=160)['input_ids'].to(src_batch.device)
-            tgt_input = tgt_batch[:, :-1]
-            tgt_label = tgt_batch[:, 1:]
+            decoder_input_ids = prompt_ids.repeat(src_batch.shape[0], 1).to(src_batch.device)
             inputs = {  "video_name"            : video_name,
                         "input_embedding"       : src_batch.to(model.device),
                         "input_embedding_mask"  : keypoints_mask_batch.to(model.device),
@@ -65,28 +88,30 @@ def eval(cfg,eval_dataloader, model,epoch,summary_writer,sanity_check=False,stor
                         "seq_len"               : seq_len.to(model.device),
                         "decoder_input_ids"     : decoder_input_ids.to(model.device),
                         "subtraction"           : subtraction.to(model.device),
+                        "standard_key"          : standard_key,
                         "tokenizer"             : Tokenizer,
                         "labels"                 : tgt_label.to(model.device),    
                         # For visualizing attention
                         "result_dir"            : cfg.LOGDIR,
-                        "epoch"                 : epoch 
+                        "epoch"                 : epoch,
+                        "attention_videos"      : attention_videos(cfg, video_name, video_count)
                         }
-            with torch.cuda.amp.autocast():
+            video_count += len(video_name)
+            with torch.cuda.amp.autocast(enabled=model.device.type == 'cuda'):
                 seed_everything(42) 
 
-                generated_ids , att_node , att_A, max_index = model.module.generate(**inputs)
-                # print("Genrated text:" , Tokenizer.decode(generated_ids[0], skip_special_tokens=True, clean_up_tokenization_spaces=True))
-
                 if (hasattr(cfg,'BRANCH') and cfg.BRANCH == 1) or (cfg.TRANSFORMATION.REDUCTION_POLICY == 'TIME_POOL'): 
-                    # print('Label: ', label_batch)
-                    inputs['labels'] = tgt_label.to(model.device)                              
-                    inputs['decoder_input_ids'] = tgt_input.to(model.device)
-                    loss = model(**inputs).loss
-            loss[torch.isnan(loss)] = 0
-            # Distributed Training
-            dist.all_reduce(loss, async_op=False)
-            reduced_loss = loss / dist.get_world_size()
-            loss_list.append(reduced_loss.detach().cpu())
+                    # The teacher-forced loss reuses the encoder pass of the generation
+                    inputs['target_input_ids'] = tgt_input.to(model.device)
+                generated_ids , att_node , att_A, max_index, loss = model.module.evaluate(**inputs)
+                # print("Genrated text:" , Tokenizer.decode(generated_ids[0], skip_special_tokens=True, clean_up_tokenization_spaces=True))
+            # No teacher-forced loss without target_input_ids (BRANCH 1 or TIME_POOL), the same on every process
+            if loss is not None:
+                loss[torch.isnan(loss)] = 0
+                # Distributed Training
+                dist.all_reduce(loss, async_op=False)
+                reduced_loss = loss / dist.get_world_size()
+                loss_list.append(reduced_loss.detach().cpu())
             for name, gen_id,label in zip(video_name, generated_ids,label_batch):
                 decoded_text = Tokenizer.decode(gen_id, skip_special_tokens=True, clean_up_tokenization_spaces=True).split(prompt)
                 if len(decoded_text) > 1:
@@ -94,27 +119,33 @@ def eval(cfg,eval_dataloader, model,epoch,summary_writer,sanity_check=False,stor
                 else:
                     decoded_text = ""
 
-                # Distributed Training
-                store.set(name,decoded_text)
-            for name, att_node in zip(video_name, att_node):
-                att_node_results[name] = att_node.cpu().numpy().tolist()
-            for name, att_A in zip(video_name, att_A):
-                att_A_results[name] = att_A.cpu().numpy().tolist()
-            for name, max_index in zip(video_name, max_index):
-                max_index_results[name] = max_index.cpu().numpy().tolist()
-            if dist.get_rank() == 0:
+                generated_results[name] = decoded_text
+            # Cut every sample of a padded batch to its own frames, as with a batch size of 1
+            frame_max_index = cfg.TRANSFORMATION.REDUCTION_POLICY == 'SKELETON_POOL'
+            for name, length, att_node, att_A, max_index in zip(video_name, seq_len.tolist(), att_node, att_A, max_index):
+                att_node_results[name]  = to_array('att_node', att_node[:, :length])
+                att_A_results[name]     = to_array('att_A', att_A)
+                max_index_results[name] = to_array('max_index', max_index[:length] if frame_max_index else max_index)
+            if dist.get_rank() == 0 and len(loss_list) > 0:
                 eval_dataloader.set_postfix({'loss': np.mean(loss_list),})
             if sanity_check and index > 4:
+                # The attention HTML of the batches seen so far is written before training goes on
+                model.module.wait_attention_export()
                 return
             
-    # Distributed Training
+    # Distributed Training, the results of every process are collected on rank 0 in one call
+    gathered = gather_results(generated_results, att_node_results, att_A_results, max_index_results)
     if dist.get_rank() == 0:
-        summary_writer.add_scalar('eval/loss', np.mean(loss_list), epoch)
+        if len(loss_list) > 0:
+            summary_writer.add_scalar('eval/loss', np.mean(loss_list), epoch)
 
-        results = {}
-        for name in name_list:
-            # Distributed Training
-            results[name] = store.get(name).decode('utf-8')
+        generated_results, att_node_results, att_A_results, max_index_results = gathered
+        missing = [name for name in name_list if name not in generated_results]
+        if len(missing) > 0 and not cfg.args.eval_multi:
+            logger.warning(f"No result for {len(missing)} videos of the test set : {missing[:10]}")
+        # In the order of the test set, followed by the videos it does not list
+        results = {name: generated_results[name] for name in name_list if name in generated_results}
+        results.update({name: text for name, text in generated_results.items() if name not in results})
         
         if not cfg.args.eval_multi:
             print("Saving results")
@@ -122,12 +153,8 @@ def eval(cfg,eval_dataloader, model,epoch,summary_writer,sanity_check=False,stor
             with open(result_json, 'w') as f:
                 json.dump(results, f,indent = 1)
                 print(f"Results saved in {result_json}")
-            with open(cfg.JSONDIR+'/att_node_results_epoch'+eval_name+str(epoch)+'.json', 'w') as f:
-                json.dump(att_node_results, f)
-            with open(cfg.JSONDIR+'/att_A_results_epoch'+eval_name+str(epoch)+'.json', 'w') as f:
-                json.dump(att_A_results, f)
-            with open(cfg.JSONDIR+'/max_index_epoch'+eval_name+str(epoch)+'.json', 'w') as f:
-                json.dump(max_index_results, f, indent=4)
+            # float16 attention maps in one memory mapped file, read back with utils.attention_store.AttentionStore
+            save_attention(cfg.JSONDIR+'/attention_epoch'+eval_name+str(epoch), att_node_results, att_A_results, max_index_results)
         
         if cfg.args.eval_multi:
             predictions = readJSON(cfg.JSONDIR+'/results_epoch'+str(epoch-1)+'.json')
@@ -149,6 +176,10 @@ def eval(cfg,eval_dataloader, model,epoch,summary_writer,sanity_check=False,stor
             print("\033[91m {} \033[00m".format("Result saved in ",result_json,". Skipping score calculation."))
         print("length of annotations: ",len(annotations))
         gts = getGTCaptions(annotations)
+        # Reference statistics of the whole test set, kept while the pickle does not change
+        annotation_file = cfg.DATA.TEST if pkl_file is None else pkl_file
+        metrics_key = None if cfg.args.gpt_sim else (annotation_file, os.path.getmtime(annotation_file))
+        metrics = caption_metrics(metrics_key, gts)
         print("length of gts: ",len(gts))
         new_gts = {}
         print("length of results: ",len(results))
@@ -170,35 +201,24 @@ def eval(cfg,eval_dataloader, model,epoch,summary_writer,sanity_check=False,stor
         assert all([type(pred) is str for pred in predictions.values()])
 
         # Calculate scores
-        metrics = [
-            load_metric("bleu",resulting_name="bleu_1",compute_kwargs={"max_order":1}),
-            load_metric("bleu",resulting_name="bleu_4",compute_kwargs={"max_order":4}),
-            load_metric("rouge"),
-            load_metric("cider"),
-        ]
-        Evaluator = NLGMetricverse(metrics)
-        # Need to convert predictions and gts to list to fit with bert_score
-        # Make sure predictions and gts are in the same order
-        predictions = dict(sorted(predictions.items()))
         # Del standard in gts since there is no standard in predictions
         if 'standard' in gts: del gts['standard']
-        gts = dict(sorted(gts.items()))
-
-        predictions = list(predictions.values())
-        gts = list(gts.values())
-        scores = Evaluator(predictions=predictions,references=gts, reduce_fn="max")
-        results = {}
-        results["bleu_1"]   = scores["bleu_1"]['score']
-        results["bleu_4"]   = scores["bleu_4"]['score']
-        results["rouge"]    = scores["rouge"]['rougeL']
-        results["cider"]    = scores["cider"]['score']
+        names = sorted(name for name in predictions if name in gts and name in metrics.references)
+        metric_workers = cfg.METRIC_WORKERS if hasattr(cfg,'METRIC_WORKERS') else 1
+        results = metrics({name: predictions[name] for name in names}, workers=metric_workers)
 
+        # Need to convert predictions and gts to list to fit with bert_score, in the same order
+        predictions = [predictions[name] for name in names]
+        gts = [gts[name] for name in names]
         P,R,F1 = score(predictions,gts,lang="en",verbose=False,idf=True,rescale_with_baseline=True)
         # results["bertscore"] = F1.mean().item()
         results["bertscore"] = F1.max().item()
-        logger.info(f"Epoch {epoch}: Loss {np.mean(loss_list)}")
+        if len(loss_list) > 0:
+            logger.info(f"Epoch {epoch}: Loss {np.mean(loss_list)}")
         for key in results:
             logger.info(f"Epoch {epoch}: {key}: {results[key]}")
+    # The attention HTML is written in the background while the scores are computed
+    model.module.wait_attention_export()
       
 def main():
     args = parse_args()
@@ -258,26 +278,13 @@ def main():
     # name_list.append('Loop')
     # name_list.append('Lutz')
 
-    dist.init_process_group(backend='nccl', init_method='env://')
-    id = dist.get_rank()
-    device = id % torch.cuda.device_count()
-    # Distributed Training
-    torch.cuda.set_device(id)
-
-    model = model.cuda()
-
     # Distributed Training
+    device = init_distributed(args.backend)
     model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
-    model = torch.nn.parallel.DistributedDataParallel(  model, device_ids=[device],
-                                                        output_device=device        )
+    model = wrap_model(model, device)
     optimizer = AdamW(model.parameters(), lr=float(cfg.OPTIMIZER.LR))
     summary_writer = SummaryWriter(os.path.join(cfg.LOGDIR, 'train_logs'))
 
-    # Distributed Training
-    if dist.get_rank() == 0:
-        store = dist.TCPStore("127.0.0.1", 5052, dist.get_world_size(), True, timedelta(seconds=30))
-    else:
-        store = dist.TCPStore("127.0.0.1", 5052, dist.get_world_size(), False, timedelta(seconds=30))
     val_dataloader  =  construct_dataloader('test' ,cfg,pickle_file)
     summary_writer = SummaryWriter()
     
@@ -290,8 +297,8 @@ def main():
     else:
         checkpoints = [args.ckpt]
     for ckpt in checkpoints:
-        epoch = load_checkpoint(cfg,model,optimizer,ckpt)
-        eval(cfg,val_dataloader, model,epoch,summary_writer,store=store,name_list=name_list,logger=logger,eval_name=eval_name,pkl_file=pickle_file)
+        epoch, _ = load_checkpoint(cfg,model,optimizer,ckpt)
+        eval(cfg,val_dataloader, model,epoch,summary_writer,name_list=name_list,logger=logger,eval_name=eval_name,pkl_file=pickle_file)
     dist.destroy_process_group()
 
 if __name__ == "__main__":
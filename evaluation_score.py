@@ -1,30 +1,19 @@
 from bert_score import score
-from nlgmetricverse import NLGMetricverse,load_metric
+from utils.caption_metrics import CaptionMetrics
 import pickle , os, json
 ## calculate scores
-def calculate_scores(predictions,gts):
-        metrics = [
-            load_metric("bleu",resulting_name="bleu_1",compute_kwargs={"max_order":1}),
-            load_metric("bleu",resulting_name="bleu_4",compute_kwargs={"max_order":4}),
-            load_metric("rouge"),
-            load_metric("cider"),
-        ]
-        Evaluator = NLGMetricverse(metrics)
+def calculate_scores(predictions,gts,metrics=None):
+        ## the statistics of the references are kept by metrics, pass the same CaptionMetrics for every result file
+        if metrics is None:
+            metrics = CaptionMetrics(gts)
 
         ## need to convert predictions and gts to list to fit with bert_score
         ### make sure predictions and gts are in the same order
-        predictions = dict(sorted(predictions.items()))
-        gts = dict(sorted(gts.items()))
+        names = sorted(name for name in predictions if name in metrics.references)
+        score_results = metrics({name: predictions[name] for name in names})
 
-        predictions = list(predictions.values())
-        gts = list(gts.values())
-
-        scores = Evaluator(predictions=predictions,references=gts)
-        score_results = {}
-        score_results["bleu_1"] = scores["bleu_1"]['score']
-        score_results["bleu_4"] = scores["bleu_4"]['score']
-        score_results["rouge"] = scores["rouge"]['rougeL']
-        score_results["cider"] = scores["cider"]['score']
+        predictions = [predictions[name] for name in names]
+        gts = [gts[name] for name in names]
 
         P,R,F1 = score(predictions,gts,lang="en",verbose=False,idf=True,rescale_with_baseline=True)
         score_results["bertscore"] = F1.mean().item()
@@ -44,6 +33,7 @@ def gts():
 
 def main():
     groud_truth = gts()
+    metrics = CaptionMetrics(groud_truth)
     All_file = {}
     # folder_path = "/home/weihsin/projects/MotionExpert_tmp/MotionExpert/STAGCN_output_finetune_new2"
     folder_path = "/home/weihsin/projects/MotionExpert_tmp/MotionExpert/STAGCN_output_local_new"
@@ -60,7 +50,7 @@ def main():
                    if 'Motion Instruction : ' in v:
                        v = v.replace('Motion Instruction : ', '')
                    predictions[k] = v
-                All_file[file_name] = calculate_scores(predictions,groud_truth)
+                All_file[file_name] = calculate_scores(predictions,groud_truth,metrics)
 
     # All_file calculate bertscore sort and then calculate bleu1, bleu4, rouge, cider
     All_file = dict(sorted(All_file.items(), key=lambda item: item[1]['bertscore'], reverse=True))
@@ -1,4 +1,4 @@
-import os,sys
+import os,sys,math,contextlib
 import torch.cuda
 os.environ['NUMEXPR_MAX_THREADS'] = '2'
 os.environ['TOKENIZERS_PARALLELISM'] = "false"
@@ -6,7 +6,7 @@ import warnings
 warnings.filterwarnings("ignore",category=UserWarning)
 warnings.filterwarnings("ignore",category=FutureWarning)
 import torch
-from transformers import AutoTokenizer, AdamW, get_linear_schedule_with_warmup
+from transformers import AdamW, get_linear_schedule_with_warmup
 from utils.parser import parse_args,load_config
 from tqdm import tqdm
 import numpy as np
@@ -20,29 +20,46 @@ from evaluation import eval
 from torch.utils.tensorboard import SummaryWriter
 # Distributed Training
 import torch.distributed as dist
-from dataloaders import construct_dataloader
+from dataloaders import construct_dataloader, set_epoch
 from models.T5 import SimpleT5Model
-from models import save_checkpoint,load_checkpoint
+from models import save_checkpoint,load_checkpoint,wait_checkpoint_writes
+from utils.dist import DistributedMean, init_distributed, wrap_model
 import traceback
-from datetime import timedelta
 
 logger = logging.getLogger(__name__)
 
-def train(cfg,train_dataloader, model, optimizer,scheduler,scaler,summary_writer,epoch,logger):
+def accumulation(cfg):
+    # Number of batches whose gradients are summed before every optimizer step
+    return cfg.OPTIMIZER.ACCUMULATION_STEPS if hasattr(cfg.OPTIMIZER,'ACCUMULATION_STEPS') else 1
+
+def train(cfg,train_dataloader, model, optimizer,scheduler,scaler,summary_writer,epoch,logger,start_step=0,progress=None):
+    '''
+    @start_step : steps of this epoch done before a resume, the batch sampler skips them (see ResumableBatchSampler)
+    @progress   : dict whose 'step' is set to the number of steps done in the epoch after every optimizer step
+    With OPTIMIZER.ACCUMULATION_STEPS = K the gradients of K batches are summed before every optimizer step, the
+    gradients are only all-reduced on the last of them. A step counts batches, the scheduler steps once per K batches.
+    '''
     model.train()
     optimizer.zero_grad()
-    loss_list = []
-    Tokenizer = AutoTokenizer.from_pretrained('t5-base', use_fast=True)
+    # Mean loss of the epoch, all-reduced and copied to the host every LOG_STEPS steps only
+    train_loss = DistributedMean(model.device)
+    log_steps = cfg.LOG_STEPS if hasattr(cfg,'LOG_STEPS') else 10
+    # Labels are tokenized once by the dataset, the tokenizer is only kept for decoding
+    Tokenizer = train_dataloader.dataset.tokenizer
+    num_steps = len(train_dataloader)
+    checkpoint_steps = cfg.CHECKPOINT_STEPS if hasattr(cfg,'CHECKPOINT_STEPS') else None
+    accumulation_steps = accumulation(cfg)
+    if start_step > 0:
+        train_dataloader.batch_sampler.set_start(start_step)
     if dist.get_rank() == 0:
-        train_dataloader = tqdm(train_dataloader,total=len(train_dataloader), desc='Training')
-    for index,batch in enumerate(train_dataloader):
-        (video_name,src_batch,keypoints_mask_batch,standard,seq_len,label_batch,subtraction) = batch
-        model.zero_grad()
-        optimizer.zero_grad()
-        tgt_batch = Tokenizer(label_batch, return_tensors="pt", padding="max_length", truncation=True, max_length=160)['input_ids'].to(src_batch.device)
-        tgt_input = tgt_batch[:, :-1]
-        tgt_label = tgt_batch[:, 1:]
-        with torch.cuda.amp.autocast():
+        train_dataloader = tqdm(train_dataloader,total=num_steps,initial=start_step, desc='Training')
+    for index,batch in enumerate(train_dataloader, start_step):
+        (video_name,src_batch,keypoints_mask_batch,standard,seq_len,label_batch,subtraction,tgt_input,tgt_label,label_group,standard_key) = batch
+        # Batches summed in this optimizer step, fewer for the last one of the epoch
+        group_start = index - index % accumulation_steps
+        group_size = min(accumulation_steps, num_steps - group_start)
+        last_micro_batch = index + 1 == group_start + group_size
+        with (contextlib.nullcontext() if last_micro_batch else model.no_sync()), torch.cuda.amp.autocast(enabled=model.device.type == 'cuda'):
             inputs = {  "video_name": video_name,
                         "input_embedding": src_batch.to(model.device),
                         "input_embedding_mask": keypoints_mask_batch.to(model.device),
@@ -51,8 +68,11 @@ def train(cfg,train_dataloader, model, optimizer,scheduler,scaler,summary_writer
                         "decoder_input_ids": tgt_input.to(model.device),
                         "labels": tgt_label.to(model.device),
                         "subtraction": subtraction.to(model.device),
+                        "standard_key": standard_key,
                         "tokenizer": Tokenizer
                         }
+            if label_group is not None:
+                inputs["label_group"] = label_group.to(model.device)
             '''
             ## branch 2
             if not ((hasattr(cfg,'BRANCH') and cfg.BRANCH == 1) or (cfg.TRANSFORMATION.REDUCTION_POLICY == 'TIME_POOL')):
@@ -62,24 +82,43 @@ def train(cfg,train_dataloader, model, optimizer,scheduler,scaler,summary_writer
             '''
             outputs = model(**inputs)
             loss = outputs.loss
-        scaler.scale(loss).backward()
-        scaler.step(optimizer)
-        scaler.update()
-        scheduler.step()
-
-        # Distributed Training
-        loss[torch.isnan(loss)] = 0
-        dist.all_reduce(loss, async_op=False)
-        reduced_loss = loss / dist.get_world_size()
-        loss_list.append(reduced_loss.detach().cpu())
-        if dist.get_rank() == 0:
-            train_dataloader.set_postfix({
-                'loss': np.mean(loss_list),
-                'lr': scheduler.optimizer.param_groups[0]['lr'],
-            })
+        # Optional preview of the teacher-forced prediction every PREVIEW_STEPS steps
+        if hasattr(cfg,'PREVIEW_STEPS') and cfg.PREVIEW_STEPS and index % cfg.PREVIEW_STEPS == 0 and dist.get_rank() == 0:
+            logger.info(f"Epoch {epoch} step {index} : {video_name[0]} : {model.module.preview_text(outputs.logits.detach(), Tokenizer)}")
+        # DDP decides in the forward whether the backward all-reduces the gradients, only the last batch does
+        scaler.scale(loss / group_size).backward()
+        if last_micro_batch:
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+            optimizer.zero_grad()
+            if model.module.standard_cache is not None:
+                model.module.standard_cache.step()
+            # The summed gradients are not saved, a run only stops or resumes after an optimizer step
+            if progress is not None:
+                progress['step'] = index + 1
+            # Training state every CHECKPOINT_STEPS steps, written in the background, the run resumes after this step
+            if checkpoint_steps and (index + 1) // checkpoint_steps > group_start // checkpoint_steps:
+                if index + 1 < num_steps:
+                    save_checkpoint(cfg,model,optimizer,epoch,step=index + 1,scheduler=scheduler,scaler=scaler)
+                else:
+                    save_checkpoint(cfg,model,optimizer,epoch + 1,step=0,scheduler=scheduler,scaler=scaler)
+
+        # Distributed Training, the loss is reduced over the processes every LOG_STEPS steps
+        train_loss.update(loss)
+        if (index + 1) % log_steps == 0 and index + 1 < num_steps:
+            mean_loss = train_loss.sync()
+            if dist.get_rank() == 0:
+                train_dataloader.set_postfix({
+                    'loss': mean_loss,
+                    'lr': scheduler.optimizer.param_groups[0]['lr'],
+                })
+    mean_loss = train_loss.sync()
     if dist.get_rank() == 0:
-        summary_writer.add_scalar('train/loss', np.mean(loss_list), epoch)
-        logger.info(f"Epoch {epoch} : Loss {np.mean(loss_list)}")
+        summary_writer.add_scalar('train/loss', mean_loss, epoch)
+        logger.info(f"Epoch {epoch} : Loss {mean_loss}")
+        if model.module.standard_cache is not None:
+            summary_writer.add_scalar('train/standard_cache_hit_rate', model.module.standard_cache.hit_rate(), epoch)
 
 
 def main():
@@ -110,22 +149,15 @@ def main():
             print(d['video_name'])
 
     # Distributed Training
-    dist.init_process_group(backend='nccl', init_method='env://')
-    if dist.get_rank() == 0:
-        store = dist.TCPStore("127.0.0.1", 8082, dist.get_world_size(), True,timedelta(seconds=30))
-    else:
-        store = dist.TCPStore("127.0.0.1", 8082, dist.get_world_size(), False,timedelta(seconds=30))
+    device = init_distributed(args.backend)
         
     seed_everything(42)
     
     # Distributed Training
-    id = dist.get_rank()
-    device = id % torch.cuda.device_count()
-    model = model.to(device)
-    torch.cuda.set_device(id)
-    model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[device], output_device=device, find_unused_parameters=True)
+    model = wrap_model(model, device, find_unused_parameters=True)
 
-    scaler = torch.cuda.amp.GradScaler()
+    # Mixed precision on GPUs only
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
     optimizer = AdamW(model.parameters(), lr=float(cfg.OPTIMIZER.LR))
     summary_writer = SummaryWriter(os.path.join(cfg.LOGDIR, 'train_logs'))
 
@@ -133,32 +165,46 @@ def main():
     test_dataloader  =  construct_dataloader('test' ,cfg,cfg.DATA.TEST)
 
     max_epoch = cfg.OPTIMIZER.MAX_EPOCH
+    # One scheduler step per optimizer step, WARMUP_STEPS counts optimizer steps
+    optimizer_steps = math.ceil(len(train_dataloader) / accumulation(cfg))
     scheduler = get_linear_schedule_with_warmup(
-        optimizer, num_warmup_steps=cfg.OPTIMIZER.WARMUP_STEPS, num_training_steps=max_epoch * len(train_dataloader)
+        optimizer, num_warmup_steps=cfg.OPTIMIZER.WARMUP_STEPS, num_training_steps=max_epoch * optimizer_steps
     )
 
-    start_epoch = load_checkpoint(cfg,model,optimizer)
+    start_epoch, start_step = load_checkpoint(cfg,model,optimizer,scheduler=scheduler,scaler=scaler)
+    # Position of the training, saved when the run stops
+    progress = {'epoch': start_epoch, 'step': start_step}
     try:
         # Sanity check
-        eval(cfg, test_dataloader, model, start_epoch, summary_writer, True, store, name_list, logger)
+        eval(cfg, test_dataloader, model, start_epoch, summary_writer, True, name_list, logger)
         for epoch in range(start_epoch, max_epoch):
 
             # Distributed Training
             if dist.get_rank() == 0:
                 logger.info(f"Training epoch {epoch}")
             
-            train_dataloader.sampler.set_epoch(epoch)
-            train(cfg,train_dataloader, model, optimizer,scheduler,scaler,summary_writer, epoch,logger)
+            set_epoch(train_dataloader, epoch)
+            if hasattr(train_dataloader.batch_sampler,'padding_efficiency') and dist.get_rank() == 0:
+                efficiency, random_efficiency = train_dataloader.batch_sampler.padding_efficiency()
+                summary_writer.add_scalar('train/padding_efficiency', efficiency, epoch)
+                logger.info(f"Epoch {epoch} : padding efficiency {efficiency:.3f} (random batches {random_efficiency:.3f})")
+            progress.update(epoch=epoch, step=start_step if epoch == start_epoch else 0)
+            train(cfg,train_dataloader, model, optimizer,scheduler,scaler,summary_writer, epoch,logger,
+                  start_step=progress['step'], progress=progress)
+            progress.update(epoch=epoch + 1, step=0)
             if (epoch+ 1) % 5 == 0:
 
-                # Distributed Training
+                # Distributed Training, every rank takes part (RNG states), rank 0 writes in the background. The epoch
+                # checkpoint is on disk before the evaluation starts, a run killed during it resumes from this epoch.
                 if dist.get_rank() == 0:
                     os.makedirs(cfg.CKPTDIR,exist_ok=True)
-                    save_checkpoint(cfg,model,optimizer,epoch+1)
+                save_checkpoint(cfg,model,optimizer,epoch+1,scheduler=scheduler,scaler=scaler)
+                if dist.get_rank() == 0:
+                    wait_checkpoint_writes()
                 dist.barrier()
 
                 try:
-                    eval(cfg,test_dataloader, model,epoch+1,summary_writer,False, store=store,name_list=name_list,logger=logger)
+                    eval(cfg,test_dataloader, model,epoch+1,summary_writer,False, name_list=name_list,logger=logger)
                 except Exception as e:
                     print(traceback.format_exc())
                     print(f"Error {e} \n in evaluation at epoch {epoch}, continuing training.")
@@ -169,8 +215,11 @@ def main():
         print(traceback.format_exc())
         print(f"{e} occured, saving model before quitting.")
     finally:
-        if dist.get_rank() == 0 and epoch != start_epoch:
-            save_checkpoint(cfg,model,optimizer,epoch+1)
+        if dist.get_rank() == 0 and (progress['epoch'], progress['step']) != (start_epoch, start_step):
+            # The other ranks may be gone, only the RNG state of rank 0 is kept
+            save_checkpoint(cfg,model,optimizer,progress['epoch'],step=progress['step'] if progress['step'] > 0 else None,
+                            scheduler=scheduler,scaler=scaler,collective=False)
+        wait_checkpoint_writes()
         dist.destroy_process_group()
     
 if __name__ == '__main__':
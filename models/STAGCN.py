@@ -47,22 +47,51 @@ class STA_GCN(nn.Module):
         self.perception_branch = Perception_branch(config=p_config,num_class=num_class, num_att_A=num_att_A, **kwargs)
         self.output_channel = p_config[-1][1] + a_config[-1][1] 
 
-    def forward(self, x):
+        '''
+            Temporal receptive radius of the whole network : every block adds (t_kernel_size - 1) // 2 frames on
+            each side. Summing all blocks is an upper bound of the longest path. forward_static relies on it,
+            it is None when a block downsamples the time axis.
+        '''
+        if all(stride == 1 for _, _, stride in f_config + a_config + p_config):
+            self.temporal_radius = ((t_kernel_size - 1) // 2) * (len(f_config) + len(a_config) + len(p_config))
+        else:
+            self.temporal_radius = None
+
+    def set_fused_graph_conv(self, layers=True):
+        '''
+            Select the fused spatial graph convolution (net.Utils_attention.graph_convolution.graph_conv) per block.
+            @layers : True / False for every block, 'auto' for the blocks that widen the channels (where folding the kernels
+                      into the input channels saves the most), or the names of the fused blocks, e.g. ['feature_extractor.stgc_block0']
+        '''
+        for name, module in self.named_modules():
+            if isinstance(module, Stgc_block):
+                if isinstance(layers, bool):
+                    module.sgc.fused = layers
+                elif layers == 'auto':
+                    module.sgc.fused = module.sgc.graph_first
+                else:
+                    module.sgc.fused = name in layers
+
+    def forward(self, x, frame_weight=None, frame_mask=None):
+        '''
+        @frame_weight : [batch_size, num_frames] or None, weight of every frame in the temporal average of the attention branch
+        @frame_mask   : [batch_size, num_frames] or None, 1 for the real frames of a padded batch, see forward_masked
+        '''
         # [N : number of attention, c : channels, t : number of frame, v : joints]
         N, c, t, v = x.size() 
  
         if self.PRETRAIN_SETTING == 'STAGCN' :
-            feature = self.feature_extractor(x, self.A)
-            attention_last , att_node, att_A = self.attention_branch(feature, self.A)
+            feature = self.feature_extractor(x, self.A, frame_mask)
+            attention_last , att_node, att_A = self.attention_branch(feature, self.A, frame_weight)
 
         else :
-            feature,feature_last = self.feature_extractor(x, self.A)
-            att_node, att_A = self.attention_branch(feature_last, self.A)
+            feature,feature_last = self.feature_extractor(x, self.A, frame_mask)
+            att_node, att_A = self.attention_branch(feature_last, self.A, frame_weight)
 
         # Attention Mechanism
         att_x = feature * att_node
 
-        perception_last = self.perception_branch(att_x, self.A, att_A)
+        perception_last = self.perception_branch(att_x, self.A, att_A, frame_mask)
 
         '''
             The dimension of perception_last is [batchsize, channel(256), number of frame, joints(22)]
@@ -79,4 +108,98 @@ class STA_GCN(nn.Module):
             feature_last   = feature_last.permute(0,2,3,1)     
             concatenate_embedding = torch.cat([perception_last, feature_last], dim=-1) 
 
-        return concatenate_embedding, att_node, att_A
\ No newline at end of file
+        return concatenate_embedding, att_node, att_A
+
+    def forward_masked(self, x, seq_len):
+        '''
+            forward on a zero padded batch where every sample gets the output it would get alone (batch size 1, eval mode)
+            on its first seq_len frames. The padded frames are zeroed before every temporal convolution and left out of the
+            temporal average of the attention branch. The outputs of the padded frames are meaningless.
+            Networks that downsample the time axis run sample by sample instead.
+        '''
+        N, c, t, v = x.size()
+        seq_len = seq_len.to(x.device)
+        if self.temporal_radius is None:
+            return self.forward_per_sample(x, seq_len)
+        frame_mask = (torch.arange(t, device=x.device).unsqueeze(0) < seq_len.unsqueeze(1)).to(x.dtype)
+        return self.forward(x, frame_mask, frame_mask)
+
+    def forward_per_sample(self, x, seq_len):
+        outputs = [self.forward(x[i:i + 1, :, :int(length)]) for i, length in enumerate(seq_len.tolist())]
+        concatenate_embedding   = x.new_zeros(len(outputs), x.shape[2], *outputs[0][0].shape[2:])
+        att_node                = x.new_zeros(len(outputs), outputs[0][1].shape[1], x.shape[2], outputs[0][1].shape[3])
+        for i, (embedding, node, _) in enumerate(outputs):
+            concatenate_embedding[i, :embedding.shape[1]]   = embedding[0]
+            att_node[i, :, :node.shape[2]]                  = node[0]
+        return concatenate_embedding, att_node, torch.cat([att_A for _, _, att_A in outputs])
+
+    def static_pose_index(self, seq_len, num_frames, radius):
+        '''
+            Compression of sequences made of two constant runs, the static pose [0, seq_len) and the padding [seq_len, num_frames).
+            Away from the run edges a frame only sees the same value within @radius frames, so every run longer than
+            2 * radius + 1 frames is shortened : its first and last radius frames are kept and one frame stands for the interior.
+            return  compressed_index : [batch_size, compressed_frames] original frame of every compressed frame
+                    frame_index      : [batch_size, num_frames] compressed frame of every original frame
+                    frame_weight     : [batch_size, compressed_frames] number of original frames every compressed frame stands for
+        '''
+        window = 2 * radius + 1
+        runs = []
+        for length in seq_len.tolist():
+            length = min(max(int(length), 0), num_frames)
+            runs.append([(start, n) for start, n in [(0, length), (length, num_frames - length)] if n > 0])
+        compressed_frames = max(sum(min(n, window) for _, n in sample_runs) for sample_runs in runs)
+
+        compressed_index    = torch.zeros(len(runs), compressed_frames, dtype=torch.long)
+        frame_index         = torch.zeros(len(runs), num_frames, dtype=torch.long)
+        for i, sample_runs in enumerate(runs):
+            # Shorter samples give their extra compressed frames to the runs that can be shortened
+            extra = compressed_frames - sum(min(n, window) for _, n in sample_runs)
+            offset = 0
+            for start, n in sample_runs:
+                m = min(n, window)
+                grow = min(extra, n - m)
+                m, extra = m + grow, extra - grow
+
+                t = torch.arange(n)
+                frame = torch.where(t <= radius, t, torch.where(n - 1 - t <= radius, m - n + t, torch.full_like(t, radius)))
+                frame_index[i, start:start + n] = offset + frame
+
+                p = torch.arange(m)
+                source = torch.where(p <= radius, p, torch.where(m - 1 - p <= radius, n - m + p, torch.full_like(p, radius)))
+                compressed_index[i, offset:offset + m] = start + source
+                offset += m
+
+        frame_weight = torch.zeros(len(runs), compressed_frames).scatter_add_(1, frame_index, torch.ones(len(runs), num_frames))
+        return compressed_index, frame_index, frame_weight
+
+    def forward_static(self, x, seq_len, radius=None, masked=False):
+        '''
+            Same outputs as forward for a static pose held for seq_len frames followed by constant padding,
+            e.g. the pretraining standard motion of SimpleT5Model.get_standard_feature, at the cost of a sequence of
+            at most 2 * (2 * radius + 1) frames. It is exact in eval mode with the default radius, the temporal receptive
+            radius of the network. A smaller @radius trades accuracy for speed.
+            @masked : same outputs as forward_masked instead of forward
+        '''
+        N, c, t, v = x.size()
+        if radius is None:
+            radius = self.temporal_radius
+        if self.temporal_radius is None or radius is None:
+            return self.forward_masked(x, seq_len) if masked else self.forward(x)
+
+        compressed_index, frame_index, frame_weight = self.static_pose_index(seq_len, t, radius)
+        if compressed_index.shape[1] >= t:
+            return self.forward_masked(x, seq_len) if masked else self.forward(x)
+        compressed_index, frame_index, frame_weight = compressed_index.to(x.device), frame_index.to(x.device), frame_weight.to(x.device)
+
+        frame_mask = None
+        if masked:
+            # The compressed frames coming from the padding are masked like the padded frames of forward_masked
+            frame_mask      = (compressed_index < seq_len.to(x.device).unsqueeze(1)).to(x.dtype)
+            frame_weight    = frame_weight * frame_mask
+        x = torch.gather(x, 2, compressed_index[:, None, :, None].expand(N, c, -1, v))
+        concatenate_embedding, att_node, att_A = self.forward(x, frame_weight, frame_mask)
+
+        # Expand back to every original frame
+        concatenate_embedding = torch.gather(concatenate_embedding, 1, frame_index[:, :, None, None].expand(-1, -1, *concatenate_embedding.shape[2:]))
+        att_node = torch.gather(att_node, 2, frame_index[:, None, :, None].expand(-1, att_node.shape[1], -1, att_node.shape[3]))
+        return concatenate_embedding, att_node, att_A
@@ -1,15 +1,40 @@
 from transformers import T5ForConditionalGeneration, AutoConfig
+import transformers
+from packaging import version
+from transformers.modeling_outputs import BaseModelOutput
 from torch import nn
 from visualize_model import model_view, head_view
 from .STAGCN import STA_GCN
 from .Transformation import Transformation
+from .standard_cache import StandardEmbeddingCache
+from .packing import pack, unpack, block_diagonal_mask
+from .inference import merge_lora, replace_modules, fold_batch_norms
+from net.Utils_attention.graph_convolution import Stgc_block
+import loralib as lora
 import torch,os
+from concurrent.futures import ThreadPoolExecutor
 import torch.distributed as dist
 
+def packed_mask_format():
+    '''
+        Block diagonal mask the T5 encoder of the installed transformers takes : transformers 5 a [rows, 1, tokens, tokens]
+        boolean mask ('4d'), before 4.46 a [rows, tokens, tokens] one through get_extended_attention_mask ('3d').
+        The versions in between only take [rows, tokens] masks, None.
+    '''
+    installed = version.parse(transformers.__version__).release
+    if installed >= (5,):
+        return '4d'
+    if installed < (4, 46):
+        return '3d'
+    return None
+
 class SimpleT5Model(nn.Module):
-    def __init__(self,cfg):
+    def __init__(self,cfg,t5_config=None):
+        '''
+        @t5_config : build a randomly initialized T5 from this config instead of loading t5-base, e.g. for benchmarks
+        '''
         super(SimpleT5Model, self).__init__()
-        config = AutoConfig.from_pretrained('t5-base')
+        config = AutoConfig.from_pretrained('t5-base') if t5_config is None else t5_config
 
         self.cfg    = cfg
         self.stagcn = STA_GCN(num_class=1024,
@@ -23,19 +48,47 @@ class SimpleT5Model(nn.Module):
                               num_att_A=4,
                               PRETRAIN_SETTING = self.cfg.TASK.PRETRAIN_SETTING,
                               PRETRAIN = cfg.TASK.PRETRAIN)
+        # true for every block, or a list of block names, see STA_GCN.set_fused_graph_conv
+        if hasattr(self.cfg.TASK,'FUSED_GRAPH_CONV'):
+            self.stagcn.set_fused_graph_conv(self.cfg.TASK.FUSED_GRAPH_CONV)
         
         if self.cfg.TASK.PRETRAIN_DIFFERENCE or hasattr(self.cfg.TASK,'DIFFERENCE_TYPE') and self.cfg.TASK.DIFFERENCE_TYPE== 'RGB':
             in_channel = 1024
         else : 
             in_channel = self.stagcn.output_channel
 
-        self.transformation = Transformation(cfg,in_channel ,t5_channel=768)
-        self.t5 = T5ForConditionalGeneration.from_pretrained('t5-base', config=config) 
+        self.transformation = Transformation(cfg,in_channel ,t5_channel=config.d_model)
+        if t5_config is None:
+            self.t5 = T5ForConditionalGeneration.from_pretrained('t5-base', config=config) 
+        else:
+            self.t5 = T5ForConditionalGeneration(config)
 
         self.RGB_lifting = nn.Linear(128, 512)
-        # Distributed Training
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Finetuning trains STA-GCN, its LoRA updates and Transformation, T5 stays as pretrained unless TASK.TRAIN_T5
+        if not self.cfg.TASK.PRETRAIN and not (hasattr(self.cfg.TASK,'TRAIN_T5') and self.cfg.TASK.TRAIN_T5):
+            self.t5.requires_grad_(False)
+        # Embeddings of the standard routines in finetuning, see StandardEmbeddingCache
+        self.standard_cache = None
+        if hasattr(self.cfg.TASK,'STANDARD_CACHE') and self.cfg.TASK.STANDARD_CACHE and not self.cfg.TASK.PRETRAIN:
+            self.standard_cache = StandardEmbeddingCache(refresh_steps  = self.cfg.TASK.STANDARD_CACHE_STEPS if hasattr(self.cfg.TASK,'STANDARD_CACHE_STEPS') else 1,
+                                                         max_entries    = self.cfg.TASK.STANDARD_CACHE_SIZE if hasattr(self.cfg.TASK,'STANDARD_CACHE_SIZE') else 512)
+        # Several clips share one T5 encoder row with SKELETON_POOL, see run_encoder
+        self.pack_encoder = hasattr(self.cfg.TRANSFORMATION,'PACK_ENCODER') and self.cfg.TRANSFORMATION.PACK_ENCODER and self.cfg.TRANSFORMATION.REDUCTION_POLICY == 'SKELETON_POOL'
+        self.packed_mask_format = packed_mask_format()
+        if self.pack_encoder and self.packed_mask_format is None:
+            print(f"PACK_ENCODER ignored, the T5 encoder of transformers {transformers.__version__} takes no block diagonal mask")
+            self.pack_encoder = False
+        # Frozen by optimize_for_inference
+        self.inference_optimized = False
+        # Background writer of the attention HTML, see export_attention
+        self.attention_worker   = None
+        self.attention_exports  = []
     
+    @property
+    def device(self):
+        # Device the model was moved to, e.g. by utils.dist.wrap_model on the device of init_distributed
+        return next(self.parameters()).device
+
     def get_difference_feature(self, user, standard, DIFFERENCE_SETTING):     
         if DIFFERENCE_SETTING == 'Subtraction':
             batch_diff = user-standard 
@@ -49,151 +102,258 @@ class SimpleT5Model(nn.Module):
 
     def get_standard_feature(self,keypoints,seq_len, pretrain, standard):
         # no need to decide the start and end frame now
-        # if pretrain :
-            standard_input_embedding = keypoints
-            # batch size
-            for i in range(0,keypoints.shape[0]):
-                # number of frames
-                for j in range(1,seq_len[i]):
-                    # joints coordinates (3) + bones coordinates (3)
-                    for k in range(0,6):
-                        # copy the 22 joints of every coordinate
-                        standard_input_embedding[i][k][j] = keypoints[i][k][0]
-        # else : 
-        #     standard_input_embedding = []
-        #     for i in len(std_start_batch):
-        #         standard_input_embedding.append(standard[0][:][std_start_batch[i]:std_end_batch[i]].copy())
-            return standard_input_embedding
+        # The standard motion of pretraining is the first frame held for the whole valid length of every sequence.
+        # The padded frames are kept as they are, and a new tensor is returned instead of writing into keypoints.
+        # keypoints : [batch size, coordinates(6), number of frame, joints(22)]
+        valid_frame = torch.arange(keypoints.shape[2], device=keypoints.device).unsqueeze(0) < seq_len.to(keypoints.device).unsqueeze(1)
+        standard_input_embedding = torch.where(valid_frame[:, None, :, None], keypoints[:, :, :1], keypoints)
+        return standard_input_embedding
     
-    def get_transformation_feature(self, stagcn_embedding, difference_embedding,PRETRAIN_DIFFERENCE):
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    def embed_skeleton(self, x, seq_len=None):
+        # STA-GCN, every sample of a padded batch gets its batch size 1 output when seq_len is given (see STA_GCN.forward_masked)
+        if seq_len is None:
+            return self.stagcn(x)
+        return self.stagcn.forward_masked(x, seq_len)
+
+    def get_standard_embedding(self, standard, standard_key, seq_len=None):
+        # standard(coach) skeleton -> stagcn embeddings, served by the standard cache when every sample has a window key
+        if self.standard_cache is None or standard_key is None or any(key is None for key in standard_key):
+            standard_embedding, _ , _ = self.embed_skeleton(standard, seq_len)
+            return standard_embedding
+        # Masked and unmasked embeddings differ on the frames near the padding
+        standard_key = [(key, seq_len is not None) for key in standard_key]
+        return self.standard_cache(standard_key, standard, lambda index: self.embed_skeleton(standard[index], None if seq_len is None else seq_len[index])[0])
+
+    def get_encoder_mask(self, transform_embedding, input_embedding_mask, seq_len):
+        # SKELETON_POOL gives one encoder token per frame, mask the padded ones. The other policies give one token per joint.
+        if self.cfg.TRANSFORMATION.REDUCTION_POLICY == 'SKELETON_POOL':
+            num_tokens = transform_embedding.shape[1]
+            return (torch.arange(num_tokens, device=transform_embedding.device).unsqueeze(0) < seq_len.to(transform_embedding.device).unsqueeze(1)).to(input_embedding_mask.dtype)
+        return input_embedding_mask
+
+    def run_encoder(self, transform_embedding, encoder_mask):
+        '''
+            T5 encoder, packed when TRANSFORMATION.PACK_ENCODER is set : the clips are packed into rows of the longest clip
+            with block diagonal self attention and unpacked afterwards, so the result keeps the padded layout.
+        '''
+        if not self.pack_encoder:
+            return self.t5.encoder(inputs_embeds=transform_embedding.contiguous(), attention_mask=encoder_mask, return_dict=True)
+        packed, segment, position = pack(transform_embedding, encoder_mask.sum(dim=1).long())
+        block_mask = block_diagonal_mask(segment)
+        attention_mask = block_mask.unsqueeze(1) if self.packed_mask_format == '4d' else block_mask.to(encoder_mask.dtype)
+        hidden = self.t5.encoder(inputs_embeds=packed, attention_mask=attention_mask, return_dict=True).last_hidden_state
+        return BaseModelOutput(last_hidden_state=unpack(hidden, position))
+
+    def get_transformation_feature(self, stagcn_embedding, difference_embedding,PRETRAIN_DIFFERENCE, seq_len=None):
+        device = stagcn_embedding.device
         if PRETRAIN_DIFFERENCE:
             concatenate_embedding   = torch.cat([stagcn_embedding,difference_embedding.to(device)],dim=-1)
-            transform_embedding, max_indices     = self.transformation(concatenate_embedding)
+            transform_embedding, max_indices     = self.transformation(concatenate_embedding, seq_len)
         elif self.cfg.TASK.DIFFERENCE_TYPE == 'RGB':
             difference_embedding    = self.RGB_lifting(difference_embedding)
             difference_embedding    = difference_embedding[:,:(stagcn_embedding).shape[1],:,:]
             concatenate_embedding   = torch.cat([stagcn_embedding,difference_embedding.to(device)],dim=-1)
-            transform_embedding, max_indices     = self.transformation(concatenate_embedding)
+            transform_embedding, max_indices     = self.transformation(concatenate_embedding, seq_len)
         else :
-            transform_embedding, max_indices     = self.transformation(stagcn_embedding)
+            transform_embedding, max_indices     = self.transformation(stagcn_embedding, seq_len)
         return transform_embedding, max_indices
 
-    def forward(self,**kwargs):
-        video_name           = kwargs['video_name']
+    def encode(self, **kwargs):
+        '''
+            Skeleton encoder shared by forward, generate and evaluate : STA-GCN, the standard / RGB difference branch and Transformation.
+            With kwargs['mask_padded_frames'], every sample of a padded batch is encoded as it would be alone.
+            return transform_embedding [batch size, tokens, 768], attention_node, attention_matrix, max_indices
+        '''
         input_embedding      = kwargs['input_embedding']
-        input_embedding_mask = kwargs['input_embedding_mask']
         standard             = kwargs['standard']
         seq_len              = kwargs['seq_len']
-        decoder_input_ids    = kwargs['decoder_input_ids']
-        labels               = kwargs['labels']
-        tokenizer            = kwargs['tokenizer']
         subtraction          = kwargs['subtraction']
-        self.stagcn.train()
-        stagcn_embedding, _, _ = self.stagcn(input_embedding)
+        frame_len            = seq_len if 'mask_padded_frames' in kwargs and kwargs['mask_padded_frames'] else None
+        stagcn_embedding, attention_node, attention_matrix = self.embed_skeleton(input_embedding, frame_len)
         if hasattr(self.cfg,"BRANCH") and self.cfg.BRANCH != 0: 
             if self.cfg.TASK.PRETRAIN_DIFFERENCE : 
                 with torch.no_grad():
                     self.stagcn.eval()
                     if self.cfg.TASK.PRETRAIN : 
                         standard_input_embedding = self.get_standard_feature(input_embedding, seq_len, self.cfg.TASK.PRETRAIN, None)
-                        standard_embedding, _ , _ = self.stagcn(standard_input_embedding)
+                        if hasattr(self.cfg.TASK,'STATIC_POSE_FAST_PATH') and self.cfg.TASK.STATIC_POSE_FAST_PATH :
+                            # The standard motion is the first frame held still, embed it on a short window
+                            radius = self.cfg.TASK.STATIC_POSE_RADIUS if hasattr(self.cfg.TASK,'STATIC_POSE_RADIUS') else None
+                            standard_embedding, _ , _ = self.stagcn.forward_static(standard_input_embedding, seq_len, radius, masked=frame_len is not None)
+                        else :
+                            standard_embedding, _ , _ = self.embed_skeleton(standard_input_embedding, frame_len)
                     else : # skeleton difference
+                        # switch dimension of standard, [a, b, c, d] -> [a, c, b, d]
                         standard = standard.permute(0,2,1,3)
-                        standard_embedding, _ , _ = self.stagcn(standard)  # standard(coach) skeleton -> stagcn embeddings
+                        standard_embedding = self.get_standard_embedding(standard, kwargs['standard_key'] if 'standard_key' in kwargs else None, frame_len)
                     #   standard_embedding = self.get_standard_feature(None, None, self.cfg.TASK.PRETRAIN, standard_embedding)                  
 
                 difference_embedding = self.get_difference_feature(stagcn_embedding, standard_embedding, self.cfg.TASK.DIFFERENCE_SETTING)
-                assert difference_embedding.shape[:-1] == stagcn_embedding.shape[:-1], f"Difference embedding shape {difference_embedding.shape[:-1]} should be equal to embeddings shape {difference_embedding.shape[:-1]} except for the last dimension, check if you correctly did padding "
+                assert difference_embedding.shape[:-1] == stagcn_embedding.shape[:-1], f"Difference embedding shape {difference_embedding.shape[:-1]} should be equal to embeddings shape {stagcn_embedding.shape[:-1]} except for the last dimension, check if you correctly did padding "
                 
-                transform_embedding, max_indices = self.get_transformation_feature(stagcn_embedding,difference_embedding,self.cfg.TASK.PRETRAIN_DIFFERENCE)
+                transform_embedding, max_indices = self.get_transformation_feature(stagcn_embedding,difference_embedding,self.cfg.TASK.PRETRAIN_DIFFERENCE,frame_len)
             elif hasattr(self.cfg.TASK,'DIFFERENCE_TYPE') and self.cfg.TASK.DIFFERENCE_TYPE== 'RGB':
                 difference_embedding = subtraction ## batch size, seq length, 1, 128
                 difference_embedding = subtraction.unsqueeze(2).expand(-1,-1,22,-1) ## batch size, seq length, 22, 128
-                transform_embedding, max_indices = self.get_transformation_feature(stagcn_embedding,difference_embedding,self.cfg.TASK.PRETRAIN_DIFFERENCE)
+                transform_embedding, max_indices = self.get_transformation_feature(stagcn_embedding,difference_embedding,self.cfg.TASK.PRETRAIN_DIFFERENCE,frame_len)
             else: 
-                transform_embedding, max_indices = self.get_transformation_feature(stagcn_embedding,None,self.cfg.TASK.PRETRAIN_DIFFERENCE)
+                transform_embedding, max_indices = self.get_transformation_feature(stagcn_embedding,None,self.cfg.TASK.PRETRAIN_DIFFERENCE,frame_len)
+        return transform_embedding, attention_node, attention_matrix, max_indices
+
+    def forward(self,**kwargs):
+        input_embedding_mask = kwargs['input_embedding_mask']
+        decoder_input_ids    = kwargs['decoder_input_ids']
+        labels               = kwargs['labels']
+        if not self.inference_optimized:
+            self.stagcn.train()
+        transform_embedding, _, _, _ = self.encode(**kwargs)
+        encoder_mask = self.get_encoder_mask(transform_embedding, input_embedding_mask, kwargs['seq_len'])
  
-        logits = self.t5(inputs_embeds=transform_embedding.contiguous(), attention_mask=input_embedding_mask, decoder_input_ids=decoder_input_ids).logits
-        argmax = torch.argmax(logits, dim=-1)
-        decoded_text = tokenizer.decode(argmax[0], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        label_group = kwargs['label_group'] if 'label_group' in kwargs else None
+        if label_group is not None or self.pack_encoder:
+            # Grouped training : encode every motion once, then decode all of its labels against the same encoder states
+            encoder_outputs = self.run_encoder(transform_embedding, encoder_mask)
+            if label_group is not None:
+                encoder_outputs.last_hidden_state = encoder_outputs.last_hidden_state[label_group]
+                encoder_mask = encoder_mask[label_group]
+            return self.t5(encoder_outputs=encoder_outputs, attention_mask=encoder_mask, decoder_input_ids=decoder_input_ids, labels=labels.contiguous())
 
-        return self.t5(inputs_embeds=transform_embedding.contiguous(), attention_mask=input_embedding_mask, decoder_input_ids=decoder_input_ids, labels=labels.contiguous())        
-    
-    def generate(self,**kwargs):
-        video_name              = kwargs['video_name']
-        input_embedding         = kwargs['input_embedding']
-        input_embedding_mask    = kwargs['input_embedding_mask']
-        standard                = kwargs['standard']
-        seq_len                 = kwargs['seq_len']
-        decoder_input_ids       = kwargs['decoder_input_ids']
-        tokenizer               = kwargs['tokenizer']
-        subtraction             = kwargs['subtraction']
-        stagcn_embedding, attention_node, attention_matrix = self.stagcn(input_embedding)
-        if hasattr(self.cfg,"BRANCH") and self.cfg.BRANCH !=0: 
+        # Single pass, the output carries both the loss and the logits (see preview_text for decoding them)
+        return self.t5(inputs_embeds=transform_embedding.contiguous(), attention_mask=encoder_mask, decoder_input_ids=decoder_input_ids, labels=labels.contiguous())
 
-            if self.cfg.TASK.PRETRAIN_DIFFERENCE : 
-                with torch.no_grad():
-                    self.stagcn.eval()
-                    if self.cfg.TASK.PRETRAIN : 
-                        standard_input_embedding = self.get_standard_feature(input_embedding, seq_len, self.cfg.TASK.PRETRAIN, None)
-                        standard_embedding, _ , _ = self.stagcn(standard_input_embedding)
-                    else : # skeleton difference
-                        # switch dimension of standard, [a, b, c, d] -> [a, c, b, d]
-                        standard = standard.permute(0,2,1,3)
-                        standard_embedding, _ , _ = self.stagcn(standard)  # standard(coach) skeleton -> stagcn embeddings
-                    #    standard_embedding = self.get_standard_feature(None, None, self.cfg.TASK.PRETRAIN, standard_embedding)          
+    def optimize_for_inference(self):
+        '''
+            Frozen inference model with the same eval mode outputs and fewer ops : the LoRA updates are merged into plain
+            nn.Conv2d / nn.Linear layers, the dropouts removed, the batch normalizations of STA-GCN and Transformation folded
+            into their neighbouring layers (see models.inference) and A * M of every STA-GCN block computed once.
+            The model stays in eval mode and cannot be trained afterwards.
+        '''
+        self.eval()
+        replace_modules(self, lambda module: merge_lora(module) if isinstance(module, (lora.ConvLoRA, lora.Linear)) else None)
+        replace_modules(self, lambda module: nn.Identity() if isinstance(module, nn.Dropout) else None)
+        fold_batch_norms(self.stagcn)
+        fold_batch_norms(self.transformation)
+        for parameter in self.parameters():
+            parameter.requires_grad_(False)
+        for module in self.stagcn.modules():
+            if isinstance(module, Stgc_block):
+                module.effective_A(self.stagcn.A)
+        if self.standard_cache is not None:
+            self.standard_cache.invalidate()
+        self.inference_optimized = True
+        return self
 
-                difference_embedding = self.get_difference_feature(stagcn_embedding, standard_embedding, self.cfg.TASK.DIFFERENCE_SETTING)
-                assert difference_embedding.shape[:-1] == stagcn_embedding.shape[:-1], f"Difference embedding shape {difference_embedding.shape[:-1]} should be equal to embeddings shape {stagcn_embedding.shape[:-1]} except for the last dimension, check if you correctly did padding "
-                
-                transform_embedding, max_indices = self.get_transformation_feature(stagcn_embedding,difference_embedding,self.cfg.TASK.PRETRAIN_DIFFERENCE)
-            elif hasattr(self.cfg.TASK,'DIFFERENCE_TYPE') and self.cfg.TASK.DIFFERENCE_TYPE== 'RGB':
-                difference_embedding = subtraction ## batch size, seq length, 1, 128
-                difference_embedding = subtraction.unsqueeze(2).expand(-1,-1,22,-1) ## batch size, seq length, 22, 128
-                transform_embedding, max_indices = self.get_transformation_feature(stagcn_embedding,difference_embedding,self.cfg.TASK.PRETRAIN_DIFFERENCE)
-            else :
-                transform_embedding, max_indices = self.get_transformation_feature(stagcn_embedding,None,self.cfg.TASK.PRETRAIN_DIFFERENCE)
-        generated_ids = self.t5.generate( inputs_embeds             = transform_embedding, 
-                                          attention_mask            = input_embedding_mask,
-                                          decoder_input_ids         = decoder_input_ids, 
-                                          max_length                = 160,
-                                          num_beams                 = 3,
-                                          repetition_penalty        = 2.5,
-                                          length_penalty            = 1.0,
-                                          return_dict_in_generate   = True,
-                                          output_attentions         = True,   
-                                          # Set do_sample           = True if you want to demo
-                                          do_sample                 = False,           
-                                          early_stopping            = True)
-        # Distributed Training
-        if(not self.cfg.TASK.PRETRAIN) and dist.get_rank() == 0 and (hasattr(self.cfg,'BRANCH') and self.cfg.BRANCH ==1):
-            decoded_text = tokenizer.convert_ids_to_tokens(generated_ids.sequences[0])
-            out = self.t5(  inputs_embeds       = transform_embedding[0].unsqueeze(0), 
-                            decoder_input_ids   = generated_ids.sequences[0].unsqueeze(0), 
+    def train(self, mode=True):
+        return super().train(mode and not self.inference_optimized)
+
+    def preview_text(self, logits, tokenizer):
+        # Greedy decoding of the teacher-forced logits of the first sample, for monitoring the training only
+        argmax = torch.argmax(logits[0], dim=-1)
+        return tokenizer.decode(argmax, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+    def beam_search(self, transform_embedding, input_embedding_mask, decoder_input_ids, encoder_outputs=None):
+        # No attention bookkeeping here, export_attention recomputes the attentions of the requested videos only
+        if encoder_outputs is not None:
+            # generate expands the encoder states for the beams in place, hand it a copy
+            inputs = {"encoder_outputs" : BaseModelOutput(last_hidden_state=encoder_outputs.last_hidden_state)}
+        else:
+            inputs = {"inputs_embeds" : transform_embedding}
+        return self.t5.generate(  **inputs,
+                                  attention_mask            = input_embedding_mask,
+                                  decoder_input_ids         = decoder_input_ids, 
+                                  max_length                = 160,
+                                  num_beams                 = 3,
+                                  repetition_penalty        = 2.5,
+                                  length_penalty            = 1.0,
+                                  # Set do_sample           = True if you want to demo
+                                  do_sample                 = False,           
+                                  early_stopping            = True)
+
+    def export_attention(self, generated_ids, transform_embedding, encoder_mask, **kwargs):
+        '''
+            Attention visualization (model_view / head_view HTML) of the videos listed in kwargs['attention_videos'].
+            Every sample is cut to its own encoder tokens and generated tokens, as if it was decoded alone.
+            The attentions are computed here, the HTML is rendered and written by a background worker,
+            call wait_attention_export to make sure every file is written.
+        '''
+        tokenizer = kwargs['tokenizer']
+        html_dir  = kwargs['result_dir'] + "/HTML/epoch" + str(kwargs['epoch'])
+        for i, name in enumerate(kwargs['video_name']):
+            if name not in kwargs['attention_videos']:
+                continue
+            sample_embedding    = transform_embedding[i, :int(encoder_mask[i].sum())]
+            sequence            = generated_ids[i]
+            eos                 = (sequence == self.t5.config.eos_token_id).nonzero()
+            if len(eos) > 0:
+                # Shorter sequences of a batch are padded after their end of sentence
+                sequence = sequence[:eos[0, 0] + 1]
+            out = self.t5(  inputs_embeds       = sample_embedding.unsqueeze(0), 
+                            decoder_input_ids   = sequence.unsqueeze(0), 
                             output_attentions   = True, 
                             return_dict         = True)
-
-            encoder_attentions  = out.encoder_attentions
-            cross_attentions    = out.cross_attentions
-            decoder_attentions  = out.decoder_attentions
-            inputs = {  "encoder_attention" : encoder_attentions,
-                        "decoder_attention" : decoder_attentions,
-                        "cross_attention"   : cross_attentions,
-                        "encoder_tokens"    : len(transform_embedding[0]),
-                        "decoder_tokens"    : decoded_text,
+            inputs = {  "encoder_attention" : tuple(attention.float().cpu() for attention in out.encoder_attentions),
+                        "decoder_attention" : tuple(attention.float().cpu() for attention in out.decoder_attentions),
+                        "cross_attention"   : tuple(attention.float().cpu() for attention in out.cross_attentions),
+                        "encoder_tokens"    : len(sample_embedding),
+                        "decoder_tokens"    : tokenizer.convert_ids_to_tokens(sequence),
                         "html_action"       : 'return'}
+            if self.attention_worker is None:
+                self.attention_worker = ThreadPoolExecutor(max_workers=1)
+            self.attention_exports.append(self.attention_worker.submit(write_attention_html, html_dir, name, inputs))
+
+    def wait_attention_export(self):
+        for export in self.attention_exports:
+            export.result()
+        self.attention_exports = []
 
-            html_object         = model_view(**inputs)
-            html_object_head    = head_view(**inputs)
+    def generate(self,**kwargs):
+        '''
+            Beam search decoding. Pass the names of the videos to visualize in "attention_videos", see export_attention.
+            The padded frames of a batch are masked, so every sample decodes as it would alone.
+        '''
+        decoder_input_ids       = kwargs['decoder_input_ids']
+        kwargs.setdefault('mask_padded_frames', True)
+        transform_embedding, attention_node, attention_matrix, max_indices = self.encode(**kwargs)
+        encoder_mask = self.get_encoder_mask(transform_embedding, kwargs['input_embedding_mask'], kwargs['seq_len'])
+        encoder_outputs = self.run_encoder(transform_embedding, encoder_mask) if self.pack_encoder else None
+        generated_ids = self.beam_search(transform_embedding, encoder_mask, decoder_input_ids, encoder_outputs)
+        if 'attention_videos' in kwargs and kwargs['attention_videos']:
+            self.export_attention(generated_ids, transform_embedding, encoder_mask, **kwargs)
+
+        return generated_ids, attention_node , attention_matrix, max_indices
+
+    def evaluate(self,**kwargs):
+        '''
+            generate and the teacher-forced loss of forward sharing one pass of the skeleton encoder and of the T5 encoder.
+            The loss is computed when kwargs carries the teacher-forcing "target_input_ids" and their "labels", otherwise it is None.
+            Unlike forward, STA-GCN is not switched to training mode, so the loss uses the same encoder states as the generation.
+            Like generate, the padded frames of a batch are masked.
+            return generated sequences, attention_node, attention_matrix, max_indices, loss
+        '''
+        decoder_input_ids       = kwargs['decoder_input_ids']
+        kwargs.setdefault('mask_padded_frames', True)
+        transform_embedding, attention_node, attention_matrix, max_indices = self.encode(**kwargs)
+        encoder_mask = self.get_encoder_mask(transform_embedding, kwargs['input_embedding_mask'], kwargs['seq_len'])
+        encoder_outputs = self.run_encoder(transform_embedding, encoder_mask)
+        generated_ids = self.beam_search(transform_embedding, encoder_mask, decoder_input_ids, encoder_outputs)
 
-            if not os.path.exists(kwargs['result_dir'] + "/HTML/epoch" + str(kwargs['epoch'])):
-                os.makedirs(kwargs['result_dir'] + "/HTML/epoch" + str(kwargs['epoch']))
+        loss = None
+        if 'target_input_ids' in kwargs and kwargs['target_input_ids'] is not None:
+            loss = self.t5( encoder_outputs     = encoder_outputs,
+                            attention_mask      = encoder_mask,
+                            decoder_input_ids   = kwargs['target_input_ids'],
+                            labels              = kwargs['labels'].contiguous()).loss
+        if 'attention_videos' in kwargs and kwargs['attention_videos']:
+            self.export_attention(generated_ids, transform_embedding, encoder_mask, **kwargs)
 
-            ''' @name : kwargs['name'][0] since its batch size is one in inference dataset '''
-            with open(kwargs['result_dir'] + "/HTML/epoch" + str(kwargs['epoch']) + "/"+ kwargs['video_name'][0] + "_model_view.html", 'w') as file:
-                file.write(html_object.data)
-            with open(kwargs['result_dir'] + "/HTML/epoch" + str(kwargs['epoch']) + "/"+ kwargs['video_name'][0] + "_head_view.html", 'w') as file:
-                file.write(html_object_head.data)
+        return generated_ids, attention_node , attention_matrix, max_indices, loss
 
-        return generated_ids.sequences, attention_node , attention_matrix, max_indices
\ No newline at end of file
+def write_attention_html(html_dir, video_name, inputs):
+    # Runs on the attention worker thread of SimpleT5Model
+    html_object         = model_view(**inputs)
+    html_object_head    = head_view(**inputs)
+    os.makedirs(html_dir, exist_ok=True)
+    with open(html_dir + "/" + video_name + "_model_view.html", 'w') as file:
+        file.write(html_object.data)
+    with open(html_dir + "/" + video_name + "_head_view.html", 'w') as file:
+        file.write(html_object_head.data)
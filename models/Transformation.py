@@ -1,3 +1,4 @@
+import torch
 import torch.nn.functional as F
 import torch.nn as nn
 import loralib as lora
@@ -42,10 +43,16 @@ class Transformation(nn.Module):
         else:
             self.video_emb= lora.Linear(512,self.t5_channel, r = 32, lora_alpha = 64, lora_dropout = 0.1)
 
-    def forward(self,x):
+    def forward(self,x,seq_len=None):
+        '''
+        @seq_len : [B] or None, number of real frames of every sample, the padded frames are left out of the time pooling
+        '''
         B,T,V,C = x.size()
         ## Either aggregate time and skeleton dimension, avg pool skeleton dimension, or max pool time dimension
         if   self.cfg.TRANSFORMATION.REDUCTION_POLICY == 'TIME_POOL': ## Cindy's method
+            if seq_len is not None:
+                padded_frame = torch.arange(T, device=x.device).unsqueeze(0) >= seq_len.to(x.device).unsqueeze(1)
+                x = x.masked_fill(padded_frame[:, :, None, None], float('-inf'))
             x = x.permute(0,2,1,3)
             x_ = F.avg_pool2d(x, kernel_size=(1, x.size(3)))
             x_, max_indices = F.max_pool2d(x_, kernel_size=(x_.size(2), 1), return_indices=True)
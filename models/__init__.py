@@ -2,78 +2,177 @@ import os, json
 import torch
 from natsort import natsorted
 import torch.distributed as dist
+from .train_state import CheckpointWriter, to_cpu, trainable_state, gather_rng_state, set_rng_state, read_checkpoint, base_hash
 
-def save_checkpoint(cfg, model, optimizer, epoch):
+# Background writer of save_checkpoint
+checkpoint_writer = None
+
+def save_checkpoint(cfg, model, optimizer, epoch, step=None, scheduler=None, scaler=None, collective=True):
+    '''
+        Saves the trainable tensors of the model with the training state (see models.train_state), written in the background.
+        @epoch      : epoch to resume from
+        @step       : None at the end of an epoch, otherwise the number of steps done in the epoch (step checkpoint,
+                      only the last one is kept, written incrementally, see models.train_state)
+        @collective : called on every rank, which gathers the RNG states of all ranks. Only rank 0 writes.
+    '''
+    global checkpoint_writer
+    rng_states = gather_rng_state(collective)
+    if dist.get_rank() != 0:
+        return
     if not cfg.TASK.PRETRAIN:
         path = os.path.join(cfg.LOGDIR, "checkpoints")
     else:
         path = os.path.join(cfg.LOGDIR, "pretrain_checkpoints")
     os.makedirs(path, exist_ok=True)
-    ckpt_path = os.path.join(path, "checkpoint_epoch_{:05d}.pth".format(epoch))
-    # Record the state
-    checkpoint = {
+    if step is None:
+        ckpt_path = os.path.join(path, "checkpoint_epoch_{:05d}.pth".format(epoch))
+    else:
+        ckpt_path = os.path.join(path, "checkpoint_epoch_{:05d}_step_{:07d}.pth".format(epoch, step))
+    if os.path.exists(ckpt_path):
+        return
+    base_path = base_checkpoint(cfg)
+    # Record the state, copied to the CPU so training goes on while it is written
+    checkpoint = to_cpu({
         "epoch": epoch,
-        "model_state": model.module.state_dict(),
+        "step": step if step is not None else 0,
+        "model_state": trainable_state(model.module),
         "optimizer_state": optimizer.state_dict(),
-    }
-    if not os.path.exists(ckpt_path):
-        torch.save(checkpoint, ckpt_path)
-        print(f"Saving epoch {epoch} checkpoint at {ckpt_path}")
+        "scheduler_state": scheduler.state_dict() if scheduler is not None else None,
+        "scaler_state": scaler.state_dict() if scaler is not None else None,
+        "rng_states": rng_states,
+        # The frozen weights are not saved, load_checkpoint checks they come from the same base
+        "base": {"path": base_path, "sha1": base_hash(base_path) if base_path is not None else None},
+    })
+    if checkpoint_writer is None:
+        checkpoint_writer = CheckpointWriter()
+    checkpoint_writer.submit(ckpt_path, checkpoint, step_checkpoint=step is not None)
+    print(f"Saving epoch {epoch} checkpoint at {ckpt_path}")
+
+def wait_checkpoint_writes():
+    # Blocks until the checkpoints submitted by save_checkpoint are on disk
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+
+def convert_lora_state(state_dict, model_state):
+    '''
+        Pretraining checkpoints store the plain nn.Conv2d of the STA-GCN blocks (<name>.weight), the finetuning model wraps
+        them in LoRA convolutions (<name>.conv.weight). Rename those keys and drop the weights whose shape does not match
+        the model, e.g. the t x t temporal kernels of finetuning checkpoints saved before TemporalConvLoRA.
+        return the converted state dict, the renamed keys, the dropped keys
+    '''
+    converted, renamed, dropped = {}, [], []
+    for k, v in state_dict.items():
+        if k not in model_state:
+            head, _, tail = k.rpartition('.')
+            if f'{head}.conv.{tail}' in model_state:
+                renamed.append(k)
+                k = f'{head}.conv.{tail}'
+        if k in model_state and model_state[k].shape != v.shape:
+            dropped.append(k)
+            continue
+        converted[k] = v
+    return converted, renamed, dropped
+
+def latest_checkpoint(checkpoint_dir):
+    if not os.path.exists(checkpoint_dir):
+        return None
+    checkpoints = [f for f in os.listdir(checkpoint_dir) if f.endswith('.pth')]
+    return os.path.join(checkpoint_dir, natsorted(checkpoints)[-1]) if len(checkpoints) > 0 else None
+
+def base_checkpoint(cfg):
+    # Checkpoint the frozen weights come from : WEIGHT_PATH, or in finetuning the last pretraining checkpoint
+    if hasattr(cfg,'WEIGHT_PATH'):
+        return cfg.WEIGHT_PATH
+    if cfg.TASK.PRETRAIN:
+        return None
+    return latest_checkpoint(os.path.join(cfg.LOGDIR, "pretrain_checkpoints"))
+
+def check_base(checkpoint, checkpoint_path, base_path):
+    '''
+        Raises when the checkpoint was saved by a run started from another base than base_path. Checkpoints saved
+        before the base was recorded are not checked.
+    '''
+    base = checkpoint.get("base")
+    if base is None or base.get("sha1") is None:
+        return
+    if base_path is None or base_hash(base_path) != base["sha1"]:
+        raise RuntimeError(f"Checkpoint {checkpoint_path} was trained from the base {base['path']} (sha1 {base['sha1']}), "
+                           f"the base found is {base_path}{'' if base_path is None else ' (sha1 ' + base_hash(base_path) + ')'}. "
+                           f"Set WEIGHT_PATH to the base of the checkpoint.")
+
+def load_model_state(model, model_state):
+    '''
+        Loads model_state into model.module, without the projections. Missing keys are allowed, see load_checkpoint.
+        return the keys of the model that were loaded
+    '''
+    newckpt = {'model_state':{}}
+    for k,v in model_state.items():
+        if not 'projection' in k:
+            newckpt['model_state'][k] = v
+    newckpt['model_state'], renamed, dropped = convert_lora_state(newckpt['model_state'], model.module.state_dict())
+    if dist.get_rank() == 0 and len(renamed) + len(dropped) > 0:
+        print(f"Loaded {len(renamed)} pretraining convolutions into LoRA convolutions, dropped {len(dropped)} weights of another shape: {dropped}")
+    model.module.load_state_dict(newckpt["model_state"],strict=False)
+    return set(newckpt["model_state"]) & set(model.module.state_dict())
 
-def load_checkpoint(cfg,model,optimizer,name=None):
-    continue_training = False
+def load_checkpoint(cfg,model,optimizer,name=None,scheduler=None,scaler=None):
+    '''
+        Loads the base weights first, WEIGHT_PATH or in finetuning the last pretraining checkpoint, then the checkpoint
+        to resume from, name or the last checkpoint of this run. Checkpoints only hold the trainable tensors, the frozen
+        ones come from the base. Raises when the checkpoint records another base, or when frozen weights are in neither.
+        @scheduler, @scaler : given when training resumes, then their states, the optimizer state and the RNG states
+                              are restored too
+        return the epoch and the step in the epoch to resume from
+    '''
     logdir = cfg.LOGDIR 
     print("LOGDIR: ",logdir)
-
-    if os.path.exists(os.path.join(logdir,'checkpoints')) and len(os.listdir(os.path.join(logdir,'checkpoints')))>0:
-        continue_training = True
-    if continue_training:
-        checkpoint_dir = os.path.join(logdir, "checkpoints")
-    else:
+    base_path = base_checkpoint(cfg)
+    if cfg.TASK.PRETRAIN:
         checkpoint_dir = os.path.join(logdir, "pretrain_checkpoints")
-        print("PRETRAIN CHECKPOINT DIR: ",checkpoint_dir)
-        # os.makedirs(checkpoint_dir, exist_ok=True)
-        # assert os.path.exists(checkpoint_dir), f"Checkpoint dir {checkpoint_dir} not found"
-    if os.path.exists(checkpoint_dir) or hasattr(cfg,'WEIGHT_PATH'):
-        if os.path.exists(checkpoint_dir):
-            checkpoints = os.listdir(checkpoint_dir)
-        else:
-            checkpoints = []
-        if len(checkpoints) > 0 or hasattr(cfg,'WEIGHT_PATH'):
-            # Sort the files in checkpoint dir
-            if name is not None or hasattr(cfg,'WEIGHT_PATH'):
-                checkpoint_path = name if name is not None else cfg.WEIGHT_PATH
-                checkpoint = torch.load(checkpoint_path)
-            elif len(checkpoints) > 0: ## current checkpoint should have higher priority
-                checkpoint_path = natsorted(checkpoints)[-1]
-                checkpoint = torch.load(os.path.join(checkpoint_dir,checkpoint_path))
-            else:
-                raise ValueError("No checkpoint found. No weight path provided.")
-            print("CHECKPOINT PATH: ",checkpoint_path)
-            newckpt = {'model_state':{}}
-            for k,v in checkpoint["model_state"].items():
-                if not 'projection' in k:
-                    newckpt['model_state'][k] = v
+    else:
+        checkpoint_dir = os.path.join(logdir, "checkpoints")
+        print("PRETRAIN CHECKPOINT: ",base_path)
+    checkpoint_path = name if name is not None else latest_checkpoint(checkpoint_dir)
 
-            model.module.load_state_dict(newckpt["model_state"],strict=False)
-            # Use for check the pretrain weight loaded correctly
-            # print(newckpt["model_state"].keys())
-            '''
-            if continue_training or cfg.TASK.PRETRAIN:
-                if not cfg.args.no_calc_score:
-                    print("args.no_calc_score is: ",cfg.args.no_calc_score)
-                    optimizer.load_state_dict(checkpoint["optimizer_state"])
-            '''
-            # Distributed Training
-            if dist.get_rank() == 0:
-                print(f"LOADING CHECKPOINT AT {checkpoint_path}")
-            if continue_training:
-                return checkpoint["epoch"] 
-            return 0
-    # Distributed Training
-    if dist.get_rank() == 0:
+    loaded = set()
+    if base_path is not None and base_path != checkpoint_path:
+        loaded |= load_model_state(model, read_checkpoint(base_path)["model_state"])
+        # Distributed Training
+        if dist.get_rank() == 0:
+            print(f"LOADING BASE WEIGHTS AT {base_path}")
+    epoch, step = 0, 0
+    if checkpoint_path is not None:
+        # Memory mapped, the optimizer state is only read when training resumes
+        checkpoint = read_checkpoint(checkpoint_path)
+        print("CHECKPOINT PATH: ",checkpoint_path)
+        check_base(checkpoint, checkpoint_path, base_path)
+        loaded |= load_model_state(model, checkpoint["model_state"])
+        epoch, step = checkpoint["epoch"], checkpoint.get("step", 0)
+        if scheduler is not None:
+            if "optimizer_state" in checkpoint:
+                optimizer.load_state_dict(checkpoint["optimizer_state"])
+            if checkpoint.get("scheduler_state") is not None:
+                scheduler.load_state_dict(checkpoint["scheduler_state"])
+            if scaler is not None and checkpoint.get("scaler_state") is not None:
+                scaler.load_state_dict(checkpoint["scaler_state"])
+            rng_states = checkpoint.get("rng_states", [])
+            if dist.get_rank() < len(rng_states):
+                set_rng_state(rng_states[dist.get_rank()])
+        # Distributed Training
+        if dist.get_rank() == 0:
+            print(f"LOADING CHECKPOINT AT {checkpoint_path}, epoch {epoch} step {step}")
+    elif base_path is None and dist.get_rank() == 0:
         print("CHECKPOINT NOT FOUND")
-    return 0 
+    if len(loaded) > 0:
+        # Frozen weights are never trained, a model started from saved weights must have loaded all of them
+        frozen = {k for k, parameter in model.module.named_parameters() if not parameter.requires_grad and not 'projection' in k}
+        missing = sorted(frozen - loaded)
+        if len(missing) > 0:
+            raise RuntimeError(f"Frozen weights in neither the base {base_path} nor the checkpoint {checkpoint_path}: {missing[:10]}"
+                               f"{' ...' if len(missing) > 10 else ''} ({len(missing)} weights)")
+    if getattr(model.module, 'standard_cache', None) is not None:
+        model.module.standard_cache.invalidate()
+    return epoch, step
 
 def load_alignment_checkpoint(cfg,align_module):
     checkpoint_dir = os.path.join(cfg.alignment_cfg.LOGDIR, "checkpoints")
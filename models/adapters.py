@@ -0,0 +1,110 @@
+'''
+    Sport adapters : the finetuning of one sport stored as a delta to the shared pretraining weights, and swapped on a
+    single SimpleT5Model in a long running process.
+
+    An adapter holds the LoRA tensors (lora_A / lora_B) of the finetuned model. Finetuning also trains the layers of
+    STA-GCN outside LoRA (batch normalizations, feature extractor), Transformation, and T5 with TASK.TRAIN_T5, so when
+    the base weights are given, every other tensor that differs from them is stored too. Without them the adapter is
+    LoRA only.
+'''
+import torch
+import loralib as lora
+from . import convert_lora_state
+
+def extract_adapter(model_state, base_state=None):
+    '''
+        @model_state : state dict of a finetuned SimpleT5Model (checkpoint["model_state"])
+        @base_state  : state dict of the base it was finetuned from, e.g. the pretraining checkpoint, or None
+        return         the adapter, a state dict with the LoRA tensors and the tensors that differ from the base
+    '''
+    # The projection heads are never loaded, see load_checkpoint
+    model_state = {k: v for k, v in model_state.items() if not 'projection' in k}
+    adapter = {k: v for k, v in model_state.items() if 'lora_' in k}
+    if base_state is not None:
+        base_state, _, _ = convert_lora_state(base_state, model_state)
+        for k, v in model_state.items():
+            if k not in adapter and (k not in base_state or not torch.equal(base_state[k], v)):
+                adapter[k] = v
+    return adapter
+
+def save_adapter(path, adapter):
+    torch.save({'adapter': adapter}, path)
+
+def load_adapter(path):
+    return torch.load(path, map_location='cpu')['adapter']
+
+def lora_weight(module):
+    # The weight of a lora.Conv2d is the one of its inner conv
+    return module.conv.weight if isinstance(module, lora.ConvLoRA) else module.weight
+
+def lora_delta(module):
+    # LoRA update B @ A in the layout of lora_weight(module), as loralib merges it
+    delta = module.lora_B @ module.lora_A
+    if isinstance(module, lora.ConvLoRA):
+        return delta.view(module.conv.weight.shape) * module.scaling
+    return (delta.transpose(0, 1) if module.fan_in_fan_out else delta) * module.scaling
+
+class LoRAAdapters:
+    '''
+        Adapters swapped on one model without reloading T5 or the base STA-GCN.
+        The base value of every tensor an adapter overwrites is kept, a swap restores it before writing the next adapter,
+        so swapping back and forth does not drift. With merge the LoRA updates are merged into the base weights as in
+        loralib's eval mode, inference then runs the plain convolutions / linear layers. The updates are added and
+        subtracted directly, the train / eval mode of the model is left as it is.
+
+        adapters = LoRAAdapters(model)
+        adapters.add('skating', load_adapter('skating.pth'))
+        adapters.add('boxing', load_adapter('boxing.pth'))
+        adapters.activate('boxing')
+    '''
+    def __init__(self, model):
+        self.model      = model
+        self.layers     = [module for module in model.modules() if isinstance(module, lora.LoRALayer) and module.r > 0]
+        self.state      = {**dict(model.named_parameters()), **dict(model.named_buffers())}
+        self.adapters   = {}
+        self.active     = None
+        # Base weights of the LoRA layers, without the update of the LoRA tensors the model was built or loaded with
+        self.unmerge()
+        self.base = {}
+        for name, module in model.named_modules():
+            if isinstance(module, lora.LoRALayer) and module.r > 0:
+                # The weight of a lora.Conv2d is the one of its inner conv
+                key = f'{name}.conv.weight' if isinstance(module, lora.ConvLoRA) else f'{name}.weight'
+                self.base[key] = self.state[key].detach().clone()
+
+    @torch.no_grad()
+    def unmerge(self):
+        for module in self.layers:
+            if module.merged:
+                lora_weight(module).sub_(lora_delta(module))
+                module.merged = False
+
+    def add(self, name, adapter):
+        missing = [k for k in adapter if k not in self.state]
+        if len(missing) > 0:
+            raise KeyError(f"Adapter {name} has weights the model does not have: {missing}")
+        self.adapters[name] = adapter
+
+    @torch.no_grad()
+    def activate(self, name, merge=True):
+        '''
+            @merge : merge the LoRA updates into the base weights for inference, otherwise the LoRA layers stay unmerged
+        '''
+        adapter = self.adapters[name]
+        for module in self.layers:
+            module.merged = False
+        for k, v in self.base.items():
+            self.state[k].copy_(v)
+        for k, v in adapter.items():
+            if k not in self.base:
+                self.base[k] = self.state[k].detach().clone()
+            self.state[k].copy_(v)
+        if merge:
+            # Only the layers loralib merges, the others would not be unmerged by train()
+            for module in self.layers:
+                if module.merge_weights:
+                    lora_weight(module).add_(lora_delta(module))
+                    module.merged = True
+        if getattr(self.model, 'standard_cache', None) is not None:
+            self.model.standard_cache.invalidate()
+        self.active = name
@@ -0,0 +1,103 @@
+'''
+    Inference transforms used by SimpleT5Model.optimize_for_inference. In eval mode a batch normalization is an affine
+    map per channel, so it folds into the convolution or linear layer next to it when nothing non linear sits between them.
+'''
+import torch
+import torch.nn as nn
+import loralib as lora
+from net.Utils_attention.attention_branch import Attention_branch
+
+def batch_norm_affine(bn):
+    # eval mode batch normalization as x * scale + shift
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+    return scale, shift
+
+def set_bias(layer, bias):
+    if layer.bias is None:
+        layer.bias = nn.Parameter(bias)
+    else:
+        layer.bias.data.copy_(bias)
+
+@torch.no_grad()
+def fold_batch_norm(layer, bn):
+    '''
+        bn(layer(x)) -> layer(x), for a nn.Conv2d / nn.Linear followed by a batch normalization of its output channels
+    '''
+    scale, shift = batch_norm_affine(bn)
+    bias = layer.bias if layer.bias is not None else torch.zeros_like(shift)
+    layer.weight.mul_(scale.view(-1, *[1] * (layer.weight.dim() - 1)))
+    set_bias(layer, bias * scale + shift)
+
+@torch.no_grad()
+def fold_batch_norm_into_next(bn, conv):
+    '''
+        conv(bn(x)) -> conv(x), for a batch normalization followed by a 1x1 convolution without padding
+    '''
+    scale, shift = batch_norm_affine(bn)
+    weight = conv.weight.flatten(1)
+    bias = conv.bias if conv.bias is not None else torch.zeros(weight.size(0), device=weight.device, dtype=weight.dtype)
+    set_bias(conv, bias + weight @ shift)
+    conv.weight.mul_(scale.view(1, -1, *[1] * (conv.weight.dim() - 2)))
+
+@torch.no_grad()
+def merge_lora(module):
+    '''
+        lora.Linear / lora.Conv2d -> nn.Linear / nn.Conv2d with the LoRA update B @ A merged into the weight
+    '''
+    if isinstance(module, lora.ConvLoRA):
+        conv = module.conv
+        if module.r > 0 and not module.merged:
+            conv.weight += (module.lora_B @ module.lora_A).view(conv.weight.shape) * module.scaling
+        return conv
+    weight = module.weight.data
+    if module.r > 0 and not module.merged:
+        delta = module.lora_B @ module.lora_A
+        weight = weight + (delta.transpose(0, 1) if module.fan_in_fan_out else delta) * module.scaling
+    if module.fan_in_fan_out:
+        weight = weight.transpose(0, 1)
+    linear = nn.Linear(module.in_features, module.out_features, bias=module.bias is not None,
+                       device=weight.device, dtype=weight.dtype)
+    linear.weight.copy_(weight)
+    if module.bias is not None:
+        linear.bias.copy_(module.bias)
+    return linear
+
+def replace_modules(model, replace):
+    '''
+        Replaces every sub module m with replace(m) when it does not return None
+    '''
+    for name, module in list(model.named_children()):
+        new_module = replace(module)
+        if new_module is not None:
+            setattr(model, name, new_module)
+        else:
+            replace_modules(module, replace)
+
+def fold_sequential(sequential):
+    # Every conv / linear directly followed by its batch normalization, the batch normalization becomes an identity
+    for i in range(len(sequential) - 1):
+        layer, bn = sequential[i], sequential[i + 1]
+        if isinstance(layer, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) or isinstance(layer, nn.Linear) and isinstance(bn, nn.BatchNorm1d):
+            fold_batch_norm(layer, bn)
+            sequential[i + 1] = nn.Identity()
+
+def fold_batch_norms(model):
+    '''
+        Folds the eval batch normalizations of STA-GCN and Transformation into their convolutions / linear layers :
+        conv -> BN in Stgc_block.tgc and Stgc_block.residual, linear -> BN in Transformation, and in the attention branch
+        att_bn0 -> att_conv, att_node_conv -> att_node_bn, att_A_conv -> att_A_bn.
+        The first batch normalization of Stgc_block.tgc stays, it follows the graph aggregation and precedes a ReLU.
+    '''
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            fold_sequential(module)
+        elif isinstance(module, Attention_branch):
+            fold_batch_norm_into_next(module.att_bn0, module.att_conv)
+            fold_batch_norm(module.att_node_conv, module.att_node_bn)
+            fold_batch_norm(module.att_A_conv, module.att_A_bn)
+            module.att_bn0, module.att_node_bn, module.att_A_bn = nn.Identity(), nn.Identity(), nn.Identity()
@@ -0,0 +1,60 @@
+'''
+    Sequence packing for the T5 encoder. With SKELETON_POOL every frame is an encoder token, so a padded batch spends
+    most of the encoder on padded frames when the clip lengths differ. Packing puts several clips into one row of the
+    length of the longest clip and restricts the self attention to each clip (block diagonal mask).
+    T5 only uses relative positions, so every clip gets the same encoder states as in its own row.
+'''
+import torch
+
+def pack_lengths(lengths, capacity):
+    '''
+        First fit decreasing bin packing.
+        return row and offset of every sequence, number of rows
+    '''
+    rows, offsets, free = [0] * len(lengths), [0] * len(lengths), []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for row, space in enumerate(free):
+            if lengths[i] <= space:
+                break
+        else:
+            row = len(free)
+            free.append(capacity)
+        rows[i], offsets[i] = row, capacity - free[row]
+        free[row] -= lengths[i]
+    return rows, offsets, len(free)
+
+def pack(embeds, seq_len):
+    '''
+        @embeds  : [batch size, tokens, channels] padded encoder inputs
+        @seq_len : [batch size] number of real tokens of every sample
+        return packed inputs [rows, tokens, channels], segment id of every packed token [rows, tokens] (-1 for padding)
+               and the packed position of every padded token [batch size, tokens] (-1 for padding)
+    '''
+    B, T, C = embeds.shape
+    lengths = [min(int(length), T) for length in seq_len.tolist()]
+    rows, offsets, num_rows = pack_lengths(lengths, T)
+
+    position = torch.full((B, T), -1, dtype=torch.long)
+    for i, (length, row, offset) in enumerate(zip(lengths, rows, offsets)):
+        position[i, :length] = row * T + torch.arange(offset, offset + length)
+    position = position.to(embeds.device)
+    valid = position >= 0
+
+    packed  = embeds.new_zeros(num_rows * T, C)
+    packed[position[valid]] = embeds[valid]
+    segment = torch.full((num_rows * T,), -1, dtype=torch.long, device=embeds.device)
+    segment[position[valid]] = torch.arange(B, device=embeds.device).unsqueeze(1).expand(B, T)[valid]
+    return packed.view(num_rows, T, C), segment.view(num_rows, T), position
+
+def unpack(packed, position):
+    # Back to the padded layout, padded tokens are zero
+    num_rows, T, C = packed.shape
+    valid = position >= 0
+    hidden = packed.new_zeros(*position.shape, C)
+    hidden[valid] = packed.view(num_rows * T, C)[position[valid]]
+    return hidden
+
+def block_diagonal_mask(segment):
+    # [rows, tokens, tokens], a token only attends to the tokens of its own clip.
+    # The padding is a block of its own, so no row is fully masked.
+    return segment.unsqueeze(2) == segment.unsqueeze(1)
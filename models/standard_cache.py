@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import torch
+
+class StandardEmbeddingCache:
+    '''
+        Cache of the STA-GCN embedding of the standard (coach) motion in finetuning and inference.
+        Only a handful of standard routines exist, so the same standard frames come back in many batches.
+
+        An entry is keyed by (standard window key, padded number of frames, weights version). The window key
+        "<routine>:<start>:<end>" comes from DatasetLoader, the caller may extend it with how the embedding is computed.
+        The padded length is part of the key because the zero padding changes the STA-GCN output near the end of the
+        window and in the attention branch.
+        @refresh_steps : the cached embeddings are dropped every refresh_steps calls of step(), i.e. optimizer steps.
+                         1 keeps them exact, larger values reuse slightly stale embeddings for more hits.
+                         Nothing calls step() at inference, so the cache stays warm.
+        @max_entries   : least recently used entries are evicted above this size
+    '''
+    def __init__(self, refresh_steps=1, max_entries=512):
+        self.refresh_steps  = refresh_steps
+        self.max_entries    = max_entries
+        self.entries        = OrderedDict()
+        self.version        = 0
+        self.steps          = 0
+        self.hits           = 0
+        self.misses         = 0
+
+    def step(self):
+        self.steps += 1
+        if self.steps % self.refresh_steps == 0:
+            self.invalidate()
+
+    def invalidate(self):
+        # Called after the weights change, e.g. an optimizer step or a checkpoint load
+        self.version += 1
+        self.entries.clear()
+
+    def __call__(self, standard_key, standard, embed):
+        '''
+            @standard_key : window key of every sample, see DatasetLoader
+            @standard     : [batch size, coordinates(6), number of frame, joints(22)]
+            @embed        : callable running the standard branch of STA-GCN on the samples of a list of batch indices
+            return          the embedding of every sample, computed only for the keys missing from the cache
+        '''
+        keys = [(key, standard.shape[2], self.version) for key in standard_key]
+        missing = OrderedDict()
+        for i, key in enumerate(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            elif key not in missing:
+                missing[key] = i
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if len(missing) > 0:
+            embedding = embed(list(missing.values()))
+            for key, sample_embedding in zip(missing, embedding):
+                self.entries[key] = sample_embedding
+        embedding = torch.stack([self.entries[key] for key in keys])
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return embedding
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
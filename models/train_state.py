@@ -0,0 +1,171 @@
+'''
+    Training state snapshots used by save_checkpoint / load_checkpoint.
+
+    A checkpoint stores the trainable parameters and the buffers of the model only. The frozen weights (T5 and the base
+    weights of the LoRA layers in finetuning, see TASK.TRAIN_T5) come from the base the run started from, WEIGHT_PATH
+    or the pretraining checkpoints, whose path and sha1 the checkpoint records so it is only loaded on top of the same
+    base. Next to the model it stores the optimizer, scheduler and GradScaler states, the RNG states of every rank and
+    the position in the epoch, so a preempted run resumes on the same batch. It is written by a background thread from
+    a CPU copy, and read back memory mapped so only the tensors that are used get loaded.
+
+    Step checkpoints are incremental : they only hold the model tensors and the optimizer states of the parameters that
+    changed since the last full checkpoint (an epoch checkpoint, or the first checkpoint of the process), their parent.
+    read_checkpoint completes them from it.
+'''
+import os, random, hashlib
+import numpy as np
+import torch
+import torch.distributed as dist
+from concurrent.futures import ThreadPoolExecutor
+
+def to_cpu(state):
+    # Copy of a (nested) state dict on the CPU, so training can go on while it is written
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+def trainable_state(model):
+    '''
+        Trainable parameters and buffers (batch normalization statistics, A of STA-GCN) of the model
+    '''
+    trainable = {name for name, parameter in model.named_parameters() if parameter.requires_grad}
+    trainable |= {name for name, _ in model.named_buffers()}
+    return {k: v for k, v in model.state_dict().items() if k in trainable}
+
+def rng_state():
+    # The numpy state is kept as a tensor, so the checkpoint loads with torch.load(weights_only=True)
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    numpy_state = (name, torch.from_numpy(keys.astype(np.int64)), position, has_gauss, cached_gaussian)
+    state = {'python': random.getstate(), 'numpy': numpy_state, 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, position, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), position, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def gather_rng_state(collective=True):
+    '''
+        RNG states of every rank, a collective call when collective is True and the process group is running,
+        otherwise only the state of this rank
+    '''
+    state = rng_state()
+    if collective and dist.is_available() and dist.is_initialized():
+        states = [None] * dist.get_world_size()
+        dist.all_gather_object(states, state)
+        return states
+    return [state]
+
+# sha1 of the base checkpoints, by path, size and modification time
+base_hashes = {}
+
+def base_hash(path):
+    '''
+        sha1 of a base checkpoint, recorded in the checkpoints of the run and checked when they are loaded.
+        Computed once per process and file.
+    '''
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in base_hashes:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                sha1.update(chunk)
+        base_hashes[key] = sha1.hexdigest()
+    return base_hashes[key]
+
+def load_file(path):
+    # Memory mapped : the tensors are only read when they are used, e.g. the optimizer state is not read for evaluation
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1, or a file in the legacy (non zip) format
+        return torch.load(path, map_location='cpu')
+
+def same(a, b):
+    if isinstance(a, torch.Tensor) or isinstance(b, torch.Tensor):
+        return isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor) and a.shape == b.shape and torch.equal(a, b)
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+    return a == b
+
+def incremental(checkpoint, parent_path, parent):
+    '''
+        checkpoint without the model tensors and the optimizer states that are the same in parent, the full checkpoint
+        written at parent_path, which the result refers to by its file name
+    '''
+    parent_model, parent_optimizer = parent["model_state"], parent["optimizer_state"]["state"]
+    optimizer_state = checkpoint["optimizer_state"]
+    return {**checkpoint,
+            "model_state": {k: v for k, v in checkpoint["model_state"].items() if not (k in parent_model and same(v, parent_model[k]))},
+            "optimizer_state": {**optimizer_state, "state": {i: state for i, state in optimizer_state["state"].items()
+                                                             if not (i in parent_optimizer and same(state, parent_optimizer[i]))}},
+            "parent": os.path.basename(parent_path)}
+
+def read_checkpoint(path):
+    '''
+        Checkpoint at path, memory mapped (see load_file). An incremental checkpoint gets the tensors it left out from its
+        parent, in the same directory, and is returned as a full one.
+    '''
+    checkpoint = load_file(path)
+    if checkpoint.get("parent") is None:
+        return checkpoint
+    parent = load_file(os.path.join(os.path.dirname(path), checkpoint.pop("parent")))
+    checkpoint["model_state"] = {**parent["model_state"], **checkpoint["model_state"]}
+    checkpoint["optimizer_state"] = {**checkpoint["optimizer_state"],
+                                     "state": {**parent["optimizer_state"]["state"], **checkpoint["optimizer_state"]["state"]}}
+    return checkpoint
+
+class CheckpointWriter:
+    '''
+        Writes checkpoints on a background thread, one at a time. The file is written next to its destination and renamed
+        once complete, so a preempted run never finds a partial checkpoint. Step checkpoints are written incrementally
+        against the last full checkpoint, whose CPU copy is kept.
+        @keep_last_steps : number of step checkpoints (see save_checkpoint) kept, older ones are deleted unless a kept
+                           one refers to them
+    '''
+    def __init__(self, keep_last_steps=1):
+        self.worker             = ThreadPoolExecutor(max_workers=1)
+        self.pending            = []
+        self.step_checkpoints   = []
+        self.keep_last_steps    = keep_last_steps
+        # (path, checkpoint) of the last full checkpoint, and the parent of every incremental one by path
+        self.parent             = None
+        self.parents            = {}
+
+    def submit(self, path, checkpoint, step_checkpoint=False):
+        # The previous checkpoint is on disk before the next one is queued
+        self.wait()
+        if step_checkpoint and self.parent is not None:
+            checkpoint = incremental(checkpoint, *self.parent)
+            self.parents[path] = self.parent[0]
+        else:
+            self.parent = (path, checkpoint)
+        self.pending.append(self.worker.submit(self.write, path, checkpoint, step_checkpoint))
+
+    def write(self, path, checkpoint, step_checkpoint):
+        torch.save(checkpoint, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        print(f"Saved checkpoint at {path}")
+        if step_checkpoint:
+            self.step_checkpoints.append(path)
+            kept = self.step_checkpoints[-self.keep_last_steps:]
+            kept += [self.parents[k] for k in kept if k in self.parents]
+            for old in self.step_checkpoints:
+                if old not in kept and os.path.exists(old):
+                    os.remove(old)
+            self.step_checkpoints = [old for old in self.step_checkpoints if old in kept]
+
+    def wait(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
@@ -42,7 +42,11 @@ class Attention_branch(nn.Module):
         self.tanh = nn.Tanh()
         self.relu = nn.ReLU()
 
-    def forward(self, x, A):
+    def forward(self, x, A, frame_weight=None):
+        '''
+        @frame_weight : [batch_size, num_frames] or None, number of original frames every frame stands for
+                        when STA_GCN.forward_static runs on a compressed sequence, used by the temporal average
+        '''
         N, c, T, V = x.size()
         
         if self.PRETRAIN_SETTING == 'STAGCN' :
@@ -62,7 +66,10 @@ class Attention_branch(nn.Module):
         x_node = F.interpolate(x_node, size=(T, V))
         att_node = self.sigmoid(x_node)
         # Attention edge
-        x_A = F.avg_pool2d(x_att, (x_att.size()[2], 1))
+        if frame_weight is None:
+            x_A = F.avg_pool2d(x_att, (x_att.size()[2], 1))
+        else:
+            x_A = (x_att * frame_weight[:, None, :, None]).sum(dim=2, keepdim=True) / frame_weight.sum(dim=1)[:, None, None, None]
         x_A = self.att_A_conv(x_A)
         x_A = self.att_A_bn(x_A)
         x_A = x_A.view(N, self.num_att_A, V, V)
@@ -71,7 +71,7 @@ class Feature_extractor(nn.Module):
             self.stgc_block8 = Stgc_block(config[8][0], config[8][1], config[8][2], **kwargs)
             self.stgc_block9 = Stgc_block(config[9][0], config[9][1], config[9][2], **kwargs)
 
-    def forward(self, x, A):
+    def forward(self, x, A, frame_mask=None):
         # Batch Normalization
         N, C, T, V = x.size()
         x = x.permute(0, 3, 1, 2).contiguous().view(N, V * C, T)
@@ -82,33 +82,33 @@ class Feature_extractor(nn.Module):
             x2 = x[:, 3:, :, :] # joints
             
             # branch1 : bone
-            x1 = self.stgc_block1_0(x1, A, None)
-            x1 = self.stgc_block1_1(x1, A, None)
-            x1 = self.stgc_block1_2(x1, A, None)
-            x1 = self.stgc_block1_3(x1, A, None)
-            x1 = self.stgc_block1_4(x1, A, None)  
+            x1 = self.stgc_block1_0(x1, A, None, frame_mask)
+            x1 = self.stgc_block1_1(x1, A, None, frame_mask)
+            x1 = self.stgc_block1_2(x1, A, None, frame_mask)
+            x1 = self.stgc_block1_3(x1, A, None, frame_mask)
+            x1 = self.stgc_block1_4(x1, A, None, frame_mask)  
 
             # branch2 : joints
-            x2 = self.stgc_block2_0(x2, A, None)
-            x2 = self.stgc_block2_1(x2, A, None)
-            x2 = self.stgc_block2_2(x2, A, None)
-            x2 = self.stgc_block2_3(x2, A, None)
-            x2 = self.stgc_block2_4(x2, A, None) 
+            x2 = self.stgc_block2_0(x2, A, None, frame_mask)
+            x2 = self.stgc_block2_1(x2, A, None, frame_mask)
+            x2 = self.stgc_block2_2(x2, A, None, frame_mask)
+            x2 = self.stgc_block2_3(x2, A, None, frame_mask)
+            x2 = self.stgc_block2_4(x2, A, None, frame_mask) 
 
             # Concatenate
             feature = torch.cat([x1, x2], dim=1)
             return feature
         
         else :
-            x = self.stgc_block0(x, A, None)
-            x = self.stgc_block1(x, A, None)
-            x = self.stgc_block2(x, A, None)
-            x = self.stgc_block3(x, A, None)
-            x = self.stgc_block4(x, A, None)  
-            x_last = self.stgc_block5(x, A, None)
-            x_last = self.stgc_block6(x_last, A, None)
-            x_last = self.stgc_block7(x_last, A, None)
-            x_last = self.stgc_block8(x_last, A, None)
-            x_last = self.stgc_block9(x_last, A, None)
+            x = self.stgc_block0(x, A, None, frame_mask)
+            x = self.stgc_block1(x, A, None, frame_mask)
+            x = self.stgc_block2(x, A, None, frame_mask)
+            x = self.stgc_block3(x, A, None, frame_mask)
+            x = self.stgc_block4(x, A, None, frame_mask)  
+            x_last = self.stgc_block5(x, A, None, frame_mask)
+            x_last = self.stgc_block6(x_last, A, None, frame_mask)
+            x_last = self.stgc_block7(x_last, A, None, frame_mask)
+            x_last = self.stgc_block8(x_last, A, None, frame_mask)
+            x_last = self.stgc_block9(x_last, A, None, frame_mask)
 
             return x, x_last
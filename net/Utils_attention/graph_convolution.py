@@ -1,6 +1,70 @@
 import torch
 import torch.nn as nn
 import loralib as lora
+
+def conv_weight(conv):
+    '''
+        Weight and bias of a 1x1 nn.Conv2d or lora.Conv2d, with the LoRA update when it is not merged
+    '''
+    if isinstance(conv, lora.ConvLoRA):
+        weight = conv.conv.weight
+        if conv.r > 0 and not conv.merged:
+            weight = weight + (conv.lora_B @ conv.lora_A).view(weight.shape) * conv.scaling
+        return weight, conv.conv.bias
+    return conv.weight, conv.bias
+
+def graph_conv(conv, x, A, s_kernel_size, graph_first):
+    '''
+        Fused spatial graph convolution sum_k (W_k x + b_k) A_k as batched matmuls, without the 5-D einsum and its copies.
+        @conv          : 1x1 convolution with out_channels * s_kernel_size output channels, kernel major
+        @x             : [batch_size, in_channels, num_frames, num_nodes]
+        @A             : [s_kernel_size, num_nodes, num_nodes] or [batch_size, s_kernel_size, num_nodes, num_nodes]
+        @graph_first   : aggregate the joints of the input first and fold the kernels into the input channels of the
+                         1x1 convolution (one matmul over s_kernel_size * in_channels). Cheaper when in_channels < out_channels,
+                         otherwise the convolution runs first and the kernels are summed after one batched matmul.
+        return           [batch_size, out_channels, num_frames, num_nodes]
+    '''
+    n, c_in, t, v = x.size()
+    A = A if A.dim() == 4 else A.unsqueeze(0)
+    w = A.size(-1)
+    if graph_first:
+        weight, bias = conv_weight(conv)
+        c = weight.size(0) // s_kernel_size
+        x = torch.matmul(x.reshape(n, 1, c_in * t, v), A)
+        weight = weight.view(s_kernel_size, c, c_in).transpose(0, 1).reshape(c, s_kernel_size * c_in)
+        x = torch.matmul(weight, x.view(n, s_kernel_size * c_in, t * w)).view(n, c, t, w)
+        if bias is not None:
+            # The bias of every kernel goes through the column sums of its adjacency
+            x = x + torch.einsum('kc,nkw->ncw', bias.view(s_kernel_size, c), A.sum(-2)).unsqueeze(2)
+        return x
+    x = conv(x)
+    c = x.size(1) // s_kernel_size
+    return torch.matmul(x.view(n, s_kernel_size, c * t, v), A).sum(1).view(n, c, t, w)
+
+''' 
+    LoRA temporal convolution
+    lora.Conv2d only builds square kernels, so a scalar t_kernel_size gives a t x t kernel that also mixes the joints.
+    This one has the (t_kernel_size, 1) kernel of the pretraining nn.Conv2d, the pretrained weight loads into conv.weight.
+    The update B @ A has rank r * t_kernel_size as in lora.Conv2d and the shape of the (t_kernel_size, 1) weight.
+'''
+class TemporalConvLoRA(lora.ConvLoRA):
+    def __init__(self, in_channels, out_channels, t_kernel_size, stride=1, bias=True, r=0, lora_alpha=1, lora_dropout=0., merge_weights=True):
+        nn.Module.__init__(self)
+        self.conv = nn.Conv2d(in_channels, out_channels,
+                              (t_kernel_size, 1),
+                              (stride, 1),
+                              ((t_kernel_size - 1) // 2, 0),
+                              bias=bias)
+        lora.LoRALayer.__init__(self, r=r, lora_alpha=lora_alpha, lora_dropout=lora_dropout, merge_weights=merge_weights)
+        if r > 0:
+            self.lora_A = nn.Parameter(self.conv.weight.new_zeros((r * t_kernel_size, in_channels * t_kernel_size)))
+            self.lora_B = nn.Parameter(self.conv.weight.new_zeros((out_channels, r * t_kernel_size)))
+            self.scaling = self.lora_alpha / self.r
+            # Freezing the pre-trained weight matrix
+            self.conv.weight.requires_grad = False
+        self.reset_parameters()
+        self.merged = False
+
 ''' Spatial Temporal Graph Convolution Block '''
 class Stgc_block(nn.Module):
     def __init__(self, in_channels, out_channels, stride, s_kernel_size, t_kernel_size, dropout, residual, A_size, PRETRAIN_SETTING, bias=True, use_att_A=False, num_att_A=0, PRETRAIN = True):
@@ -34,6 +98,8 @@ class Stgc_block(nn.Module):
 
         # Learnable weight matrix M
         self.M = nn.Parameter(torch.ones(A_size))
+        # A * M, reused while A and M are unchanged, see effective_A
+        self.A_cache = None
 
         # Temporal Graph Convolution unit
         if self.PRETRAIN :
@@ -53,15 +119,12 @@ class Stgc_block(nn.Module):
         else:
             self.tgc = nn.Sequential(nn.BatchNorm2d(out_channels),
                                     nn.ReLU(),
-                                    lora.Conv2d(in_channels = out_channels,
-                                                out_channels = out_channels,
-                                                # (temporal kernel size dimension, spatial kernel size dimension)
-                                                kernel_size = t_kernel_size,
-                                                # (temporal stride dimension, spatial stride dimension)
-                                                stride = stride,
-                                                # (temporal padding kernel size, spatial padding kernel size)
-                                                padding = (t_kernel_size - 1) // 2,
-                                                bias=bias, r = 32, lora_alpha = 64, lora_dropout = 0.1),
+                                    # (t_kernel_size, 1) kernel, stride and padding on the temporal axis only, like the pretraining conv
+                                    TemporalConvLoRA(in_channels = out_channels,
+                                                     out_channels = out_channels,
+                                                     t_kernel_size = t_kernel_size,
+                                                     stride = stride,
+                                                     bias=bias, r = 32, lora_alpha = 64, lora_dropout = 0.1),
                                     nn.BatchNorm2d(out_channels),
                                     nn.Dropout(dropout),
                                     nn.ReLU())
@@ -107,16 +170,33 @@ class Stgc_block(nn.Module):
                                                         nn.BatchNorm2d(out_channels))
         self.relu = nn.ReLU()
 
-    def forward(self, x, A, att_A):
+    def forward(self, x, A, att_A, frame_mask=None):
         '''
         @x : [batch_size, in_channels, num_frames, num_nodes]
         @A : [multihead_STGCN, num_nodes, num_nodes]
+        @frame_mask : [batch_size, num_frames] or None, 1 for the real frames of a padded batch
         '''
-        sgc_out = self.sgc(x, A * self.M, att_A) # x, A, att_A 
-        x0 = self.tgc(sgc_out)
+        sgc_out = self.sgc(x, self.effective_A(A), att_A) # x, A, att_A 
+        if frame_mask is None:
+            x0 = self.tgc(sgc_out)
+        else:
+            # Zero the padded frames before the temporal convolution, so they act like its zero padding
+            x0 = self.tgc[2:](self.tgc[:2](sgc_out) * frame_mask[:, None, :, None])
         x = x0 + self.residual(x)
         return x
 
+    def effective_A(self, A):
+        '''
+            A * M. Without a gradient to M (inference, or M frozen in finetuning) it is computed once and kept
+            until A or M changes, e.g. after an optimizer step or a checkpoint load.
+        '''
+        if torch.is_grad_enabled() and self.M.requires_grad:
+            return A * self.M
+        key = (A.data_ptr(), A._version, self.M.data_ptr(), self.M._version)
+        if self.A_cache is None or self.A_cache[0] != key:
+            self.A_cache = (key, (A * self.M).detach())
+        return self.A_cache[1]
+
 ''' Spatial Graph Convolution '''
 class S_GC(nn.Module):
     def __init__(self,
@@ -128,6 +208,9 @@ class S_GC(nn.Module):
         super().__init__()
 
         self.s_kernel_size = s_kernel_size
+        # Fused graph convolution, see graph_conv and STA_GCN.set_fused_graph_conv
+        self.fused = False
+        self.graph_first = in_channels < out_channels
         if PRETRAIN :
             self.conv = nn.Conv2d(in_channels=in_channels,
                                 out_channels=out_channels * s_kernel_size,
@@ -145,6 +228,8 @@ class S_GC(nn.Module):
                                 dilation=(1, 1),
                                 bias=bias, r = 32, lora_alpha = 64, lora_dropout = 0.1)
     def forward(self, x, A, att_A):
+        if self.fused:
+            return graph_conv(self.conv, x, A, self.s_kernel_size, self.graph_first)
         x = self.conv(x)  
         n, kc, t, v = x.size()
         x = x.view(n, self.s_kernel_size, kc//self.s_kernel_size, t, v)
@@ -167,6 +252,8 @@ class S_GC_att_A(nn.Module):
         self.num_att_A = num_att_A                     
  
         self.s_kernel_size = s_kernel_size + num_att_A  
+        self.fused = False
+        self.graph_first = in_channels < out_channels
         if PRETRAIN :
             self.conv = nn.Conv2d(in_channels=in_channels,
                                 out_channels=out_channels * self.s_kernel_size,
@@ -185,6 +272,10 @@ class S_GC_att_A(nn.Module):
                                 bias=bias, r = 32, lora_alpha = 64, lora_dropout = 0.1)
 
     def forward(self, x, A, att_A):
+        if self.fused:
+            # The kernels of A come first in the output channels of the convolution, then the attention graphs
+            A = torch.cat([A.unsqueeze(0).expand(x.size(0), *A.size()), att_A], dim=1)
+            return graph_conv(self.conv, x, A, self.s_kernel_size, self.graph_first)
         x = self.conv(x)
         n, kc, t, v = x.size()
         x = x.view(n, self.s_kernel_size, kc//self.s_kernel_size, t, v)
@@ -217,6 +308,8 @@ class A_GC(nn.Module):
         self.num_att_A = num_att_A                      
 
         self.s_kernel_size = num_att_A  
+        self.fused = False
+        self.graph_first = in_channels < out_channels
         if PRETRAIN :
             self.conv = nn.Conv2d(in_channels=in_channels,
                                 out_channels=out_channels * self.s_kernel_size,
@@ -235,6 +328,8 @@ class A_GC(nn.Module):
                                 bias=bias, r = 32, lora_alpha = 64, lora_dropout = 0.1)
 
     def forward(self, x, A, att_A):
+        if self.fused:
+            return graph_conv(self.conv, x, att_A, self.s_kernel_size, self.graph_first)
         x = self.conv(x)
         n, kc, t, v = x.size()
         x = x.view(n, self.s_kernel_size, kc//self.s_kernel_size, t, v)
@@ -26,10 +26,10 @@ class Perception_branch(nn.Module):
         self.stgc_block3 = Stgc_block(config[3][0], config[3][1], config[3][2], **kwargs)
         self.stgc_block4 = Stgc_block(config[4][0], config[4][1], config[4][2], **kwargs)
 
-    def forward(self, x, A, att_A):
-        x = self.stgc_block0(x, A, att_A)
-        x = self.stgc_block1(x, A, att_A)
-        x = self.stgc_block2(x, A, att_A)
-        x = self.stgc_block3(x, A, att_A)
-        x = self.stgc_block4(x, A, att_A)
+    def forward(self, x, A, att_A, frame_mask=None):
+        x = self.stgc_block0(x, A, att_A, frame_mask)
+        x = self.stgc_block1(x, A, att_A, frame_mask)
+        x = self.stgc_block2(x, A, att_A, frame_mask)
+        x = self.stgc_block3(x, A, att_A, frame_mask)
+        x = self.stgc_block4(x, A, att_A, frame_mask)
         return x
@@ -0,0 +1,3 @@
+import os
+# dataloaders.Dataset reads USER at import
+os.environ.setdefault('USER', 'test')
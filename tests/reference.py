@@ -0,0 +1,33 @@
+'''
+    Former implementations, copied unchanged from the baseline sources, kept as the reference of the tests and of the
+    benchmarks of the code that replaced them.
+'''
+import numpy as np
+from dataloaders.Dataset import bonelink
+
+def generate_data_loop(current_keypoints):
+    # dataloaders.Dataset.generate_data before generate_data_batch
+    joint_coordinate    = np.zeros((3,len(current_keypoints),22))
+    bone_coordinate     = np.zeros((3,len(current_keypoints),22))
+    for i in range(len(current_keypoints)):
+        for j in range(0,len(current_keypoints[i]),3):
+            joint_coordinate[:, i, j//3] = current_keypoints[i, j: j+3]
+
+    for v1, v2 in bonelink:
+        bone_coordinate[:, :, v2] = joint_coordinate[:, :, v1] - joint_coordinate[:, :, v2]
+
+    coordinates = np.concatenate((joint_coordinate, bone_coordinate), axis=0)
+    return coordinates
+
+def get_standard_feature_loop(keypoints, seq_len):
+    # models.T5.SimpleT5Model.get_standard_feature before its vectorization, it writes into keypoints
+    standard_input_embedding = keypoints
+    # batch size
+    for i in range(0,keypoints.shape[0]):
+        # number of frames
+        for j in range(1,seq_len[i]):
+            # joints coordinates (3) + bones coordinates (3)
+            for k in range(0,6):
+                # copy the 22 joints of every coordinate
+                standard_input_embedding[i][k][j] = keypoints[i][k][0]
+    return standard_input_embedding
@@ -0,0 +1,75 @@
+import logging
+from types import SimpleNamespace
+import pytest
+import torch
+import torch.distributed as dist
+from easydict import EasyDict
+
+# evaluation.py imports these at the top, the test runs where the evaluation does
+for module in ['pytorch_lightning', 'dotenv', 'bert_score', 'language_evaluation', 'torch.utils.tensorboard']:
+    pytest.importorskip(module)
+import evaluation
+from utils.dist import init_distributed
+
+PROMPT = "Motion Instruction : "
+
+class Tokenizer:
+    def __call__(self, texts, **kwargs):
+        return {'input_ids': torch.tensor([[1, 2, 3]])}
+
+    def decode(self, ids, **kwargs):
+        return PROMPT + "keep the knees bent"
+
+class Batches(list):
+    # The DataLoader interface evaluate_epoch relies on : iteration, len and dataset.tokenizer
+    dataset = SimpleNamespace(tokenizer=Tokenizer())
+
+class Model:
+    # DDP wrapped model whose evaluate gives no teacher-forced loss, as without target_input_ids
+    device = torch.device('cpu')
+
+    def __init__(self):
+        self.calls = []
+        self.waits = 0
+        self.module = SimpleNamespace(evaluate=self.evaluate, wait_attention_export=self.wait_attention_export)
+
+    def eval(self):
+        return self
+
+    def evaluate(self, **inputs):
+        self.calls.append(inputs)
+        batch_size, frames = len(inputs['video_name']), inputs['input_embedding'].shape[2]
+        generated_ids = torch.ones(batch_size, 4, dtype=torch.long)
+        att_node = torch.rand(batch_size, 8, frames)
+        att_A = torch.rand(batch_size, 22, 22)
+        max_index = torch.zeros(batch_size, frames, dtype=torch.long)
+        return generated_ids, att_node, att_A, max_index, None
+
+    def wait_attention_export(self):
+        self.waits += 1
+
+def batch(index, frames=12):
+    names = [f"video_{index}_{i}" for i in range(2)]
+    seq_len = torch.tensor([frames, frames - 3])
+    keypoints = torch.randn(2, 6, frames, 22)
+    labels = torch.ones(2, 5, dtype=torch.long)
+    return (names, keypoints, torch.ones(2, frames), keypoints.clone(), seq_len, ["label", "label"],
+            torch.zeros_like(keypoints), labels, labels, None, [None, None])
+
+@pytest.fixture
+def process_group(monkeypatch):
+    monkeypatch.delenv('WORLD_SIZE', raising=False)
+    init_distributed('gloo')
+    yield
+    dist.destroy_process_group()
+
+def test_evaluate_epoch_without_loss(process_group, tmp_path):
+    cfg = EasyDict({'TASK': {'PRETRAIN': False}, 'TRANSFORMATION': {'REDUCTION_POLICY': 'SKELETON_POOL'},
+                    'args': {'eval_multi': False}, 'LOGDIR': str(tmp_path)})
+    model = Model()
+    # The sanity check stops after the sixth batch, before the scores
+    evaluation.evaluate_epoch(cfg, Batches(batch(index) for index in range(8)), model, 0, None, sanity_check=True,
+                              logger=logging.getLogger(__name__))
+    assert len(model.calls) == 6
+    assert all('target_input_ids' not in inputs for inputs in model.calls)
+    assert model.waits == 1
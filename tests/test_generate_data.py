@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from dataloaders.Dataset import generate_data, generate_data_batch
+from tests.reference import generate_data_loop
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_generate_data_batch_matches_loop(dtype):
+    rng = np.random.default_rng(0)
+    # Ragged lengths, with a single frame sequence
+    keypoints_list = [rng.standard_normal((length, 66)).astype(dtype) for length in [1, 7, 30, 2, 120]]
+    outputs = generate_data_batch(keypoints_list)
+    assert len(outputs) == len(keypoints_list)
+    for keypoints, output in zip(keypoints_list, outputs):
+        reference = generate_data_loop(keypoints).astype(np.float32)
+        assert output.dtype == np.float32
+        assert output.shape == reference.shape == (6, len(keypoints), 22)
+        assert np.array_equal(output, reference)
+
+def test_generate_data_matches_loop():
+    keypoints = np.random.default_rng(1).standard_normal((45, 66)).astype(np.float32)
+    assert np.array_equal(generate_data(keypoints), generate_data_loop(keypoints).astype(np.float32))
+
+def test_generate_data_batch_leaves_input():
+    keypoints = np.random.default_rng(2).standard_normal((10, 66)).astype(np.float32)
+    original = keypoints.copy()
+    generate_data_batch([keypoints])
+    assert np.array_equal(keypoints, original)
@@ -0,0 +1,15 @@
+import pytest
+import torch
+from models.T5 import SimpleT5Model
+from tests.reference import get_standard_feature_loop
+
+@pytest.mark.parametrize('seq_len', [[0, 1, 2, 17, 40], [40], [1, 40, 0]])
+def test_get_standard_feature_matches_loop(seq_len):
+    torch.manual_seed(0)
+    seq_len = torch.tensor(seq_len)
+    # Random padded frames, so frames past seq_len being left as they are is checked too
+    keypoints = torch.randn(len(seq_len), 6, 40, 22)
+    original = keypoints.clone()
+    standard = SimpleT5Model.get_standard_feature(None, keypoints, seq_len, True, None)
+    assert torch.equal(keypoints, original)
+    assert torch.equal(standard, get_standard_feature_loop(keypoints.clone(), seq_len))
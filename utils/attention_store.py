@@ -0,0 +1,83 @@
+'''
+    Binary store of the attention results of one evaluation, written by evaluation.eval.
+
+    <path>.bin          : the arrays of every video back to back, att_node and att_A in float16, max_index in int32
+    <path>.index.json   : for every video name and kind (att_node, att_A, max_index) the byte offset, dtype and shape
+    The reader maps the .bin file with np.memmap, so fetching the maps of one video reads only its bytes.
+
+    store = AttentionStore('results/finetune/jsons/attention_epoch9')
+    att_node = store.att_node('468398487521460434_0')      # (num_att_node, T)
+    att_A    = store.att_A('468398487521460434_0')         # (num_att_A, 22, 22)
+'''
+import os, json
+import numpy as np
+import torch
+
+KINDS       = ['att_node', 'att_A', 'max_index']
+DTYPES      = {'att_node': np.float16, 'att_A': np.float16, 'max_index': np.int32}
+ALIGNMENT   = 8
+
+def to_array(kind, value):
+    # Tensors are cast on their device, before the copy to the host
+    if torch.is_tensor(value):
+        value = value.detach().to(torch.float16 if DTYPES[kind] == np.float16 else torch.int32).cpu().numpy()
+    return np.ascontiguousarray(value, dtype=DTYPES[kind])
+
+def save_attention(path, att_node_results, att_A_results, max_index_results):
+    '''
+        @path : file name without extension, <path>.bin and <path>.index.json are written
+        The results are {video name: array or tensor} dicts, a video may be missing from some of them
+    '''
+    results = {'att_node': att_node_results, 'att_A': att_A_results, 'max_index': max_index_results}
+    index   = {}
+    offset  = 0
+    # Written next to the destination and renamed, a reader never sees a partial store
+    with open(path + '.bin.tmp', 'wb') as f:
+        for kind in KINDS:
+            for name, value in results[kind].items():
+                array = to_array(kind, value)
+                f.write(array.tobytes())
+                index.setdefault(name, {})[kind] = [offset, np.dtype(DTYPES[kind]).name, list(array.shape)]
+                offset += array.nbytes
+                padding = -offset % ALIGNMENT
+                f.write(b'\0' * padding)
+                offset += padding
+    with open(path + '.index.json.tmp', 'w') as f:
+        json.dump({'videos': index}, f)
+    os.replace(path + '.bin.tmp', path + '.bin')
+    os.replace(path + '.index.json.tmp', path + '.index.json')
+
+class AttentionStore:
+    '''
+        Reader of a store written by save_attention. The arrays it returns are read only views of the memory map,
+        copy them (e.g. np.array or .astype) to modify them.
+    '''
+    def __init__(self, path):
+        with open(path + '.index.json') as f:
+            self.index = json.load(f)['videos']
+        # np.memmap refuses empty files
+        self.data = np.memmap(path + '.bin', dtype=np.uint8, mode='r') if os.path.getsize(path + '.bin') > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return list(self.index.keys())
+
+    def get(self, name, kind):
+        offset, dtype, shape = self.index[name][kind]
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        return self.data[offset:offset + size].view(dtype).reshape(shape)
+
+    def att_node(self, name):
+        return self.get(name, 'att_node')
+
+    def att_A(self, name):
+        return self.get(name, 'att_A')
+
+    def max_index(self, name):
+        return self.get(name, 'max_index')
@@ -0,0 +1,78 @@
+'''
+    Helpers of the utils/benchmark_*.py scripts : the common command line options, timing with warmup and CUDA
+    synchronization, and random batch normalization statistics.
+
+    parser = argument_parser(repeat=3, device=True)
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parse_arguments(parser)                         # sets the number of threads and the seed
+    output, seconds = measure(lambda: model(x), args.repeat, args.device)
+'''
+import time
+import argparse
+import torch
+
+def argument_parser(repeat=None, device=False, threads=True, seed=0):
+    '''
+        Parser with the options shared by the benchmarks, the ones given here :
+        @repeat  : default of --repeat, the number of timed calls, no option when None
+        @device  : add --device, default cpu
+        @threads : add --threads, the number of torch threads
+        @seed    : default of --seed, no option when None
+    '''
+    parser = argparse.ArgumentParser()
+    if repeat is not None:
+        parser.add_argument('--repeat', type=int, default=repeat)
+    if device:
+        parser.add_argument('--device', default='cpu')
+    if threads:
+        parser.add_argument('--threads', type=int, default=None)
+    if seed is not None:
+        parser.add_argument('--seed', type=int, default=seed)
+    return parser
+
+def parse_arguments(parser):
+    # Arguments of argument_parser applied : --threads set, --seed given to torch, --device as a torch.device
+    args = parser.parse_args()
+    if getattr(args, 'threads', None) is not None:
+        torch.set_num_threads(args.threads)
+    if hasattr(args, 'seed'):
+        torch.manual_seed(args.seed)
+    if hasattr(args, 'device'):
+        args.device = torch.device(args.device)
+    return args
+
+def synchronize(device=None):
+    # Queued CUDA kernels are part of the measured time
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def timed(function, device=None):
+    # Output and time in seconds of one call
+    synchronize(device)
+    start = time.perf_counter()
+    output = function()
+    synchronize(device)
+    return output, time.perf_counter() - start
+
+def measure(forward, repeat, device=None, warmup=1, grad=False):
+    '''
+        Mean time in seconds of repeat calls of forward after warmup untimed ones, with the output of the last call.
+        Autograd is disabled unless grad is True.
+    '''
+    with torch.set_grad_enabled(grad):
+        for _ in range(warmup):
+            output = forward()
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            output = forward()
+        synchronize(device)
+    return output, (time.perf_counter() - start) / repeat
+
+def randomize_batch_norms(model, std=0.1):
+    # Random running statistics, so a network in eval mode is not close to the identity
+    for module in model.modules():
+        if isinstance(module, (torch.nn.BatchNorm1d, torch.nn.BatchNorm2d)):
+            module.running_mean.normal_(0, std)
+            module.running_var.uniform_(0.5, 1.5)
+    return model
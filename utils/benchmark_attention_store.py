@@ -0,0 +1,64 @@
+'''
+    Attention results of an evaluation on random maps : size and write time of the former JSON dumps and of the binary
+    store (utils/attention_store.py), and the time to read the maps of a single video from each, in a temporary directory.
+
+    $ python utils/benchmark_attention_store.py --num_videos 2000 --max_len 300
+'''
+import os, sys, json, tempfile
+import numpy as np
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from utils.attention_store import save_attention, to_array, AttentionStore
+from utils.benchmark import argument_parser, parse_arguments, timed
+
+def size(directory, prefix):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.startswith(prefix))
+
+def main():
+    parser = argument_parser(threads=False)
+    parser.add_argument('--num_videos', type=int, default=2000)
+    parser.add_argument('--min_len', type=int, default=30)
+    parser.add_argument('--max_len', type=int, default=300)
+    args = parse_arguments(parser)
+
+    att_node, att_A, max_index = {}, {}, {}
+    for i in range(args.num_videos):
+        length = int(torch.randint(args.min_len, args.max_len + 1, ()))
+        att_node[f'video_{i}']  = torch.rand(1, length, 22)
+        att_A[f'video_{i}']     = torch.rand(4, 22, 22)
+        max_index[f'video_{i}'] = torch.randint(0, length, (length,))
+    name = f'video_{args.num_videos // 2}'
+
+    with tempfile.TemporaryDirectory() as directory:
+        def write_json():
+            with open(os.path.join(directory, 'att_node_results_epoch0.json'), 'w') as f:
+                json.dump({k: v.numpy().tolist() for k, v in att_node.items()}, f)
+            with open(os.path.join(directory, 'att_A_results_epoch0.json'), 'w') as f:
+                json.dump({k: v.numpy().tolist() for k, v in att_A.items()}, f)
+            with open(os.path.join(directory, 'max_index_epoch0.json'), 'w') as f:
+                json.dump({k: v.numpy().tolist() for k, v in max_index.items()}, f, indent=4)
+        def read_json():
+            with open(os.path.join(directory, 'att_node_results_epoch0.json')) as f:
+                node = np.array(json.load(f)[name])
+            with open(os.path.join(directory, 'att_A_results_epoch0.json')) as f:
+                A = np.array(json.load(f)[name])
+            return node, A
+        path = os.path.join(directory, 'attention_epoch0')
+        def write_store():
+            save_attention(path, {k: to_array('att_node', v) for k, v in att_node.items()},
+                           {k: to_array('att_A', v) for k, v in att_A.items()}, {k: to_array('max_index', v) for k, v in max_index.items()})
+        def read_store():
+            store = AttentionStore(path)
+            return store.att_node(name).astype(np.float32), store.att_A(name).astype(np.float32)
+
+        _, json_write_time = timed(write_json)
+        (json_node, json_A), json_read_time = timed(read_json)
+        _, store_write_time = timed(write_store)
+        (store_node, store_A), store_read_time = timed(read_store)
+        print(f"{args.num_videos} videos, {args.min_len} to {args.max_len} frames")
+        print(f"JSON  : {(size(directory, 'att_') + size(directory, 'max_')) / 1e6:8.1f} MB, write {json_write_time:6.2f} s, read one video {json_read_time * 1000:8.1f} ms")
+        print(f"store : {size(directory, 'attention_') / 1e6:8.1f} MB, write {store_write_time:6.2f} s, read one video {store_read_time * 1000:8.1f} ms")
+        print(f"largest difference (float16) : {max(np.abs(json_node - store_node).max(), np.abs(json_A - store_A).max()):.1e}")
+
+if __name__ == "__main__":
+    main()
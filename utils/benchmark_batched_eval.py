@@ -0,0 +1,85 @@
+'''
+    Batched finetune evaluation (DATA.EVAL_BATCH_SIZE) on CPU : videos per second of SimpleT5Model.evaluate at several
+    batch sizes, and a check that every sample decodes to the same tokens as with a batch size of 1.
+    Runs on a randomly initialized model with a small T5, so no checkpoint or t5-base download is needed.
+
+    $ python utils/benchmark_batched_eval.py --num_videos 32 --batch_sizes 1 8 32
+'''
+import os, sys
+import torch
+from easydict import EasyDict
+from transformers import T5Config
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+os.environ.setdefault('USER', 'benchmark')
+from dataloaders import collate_fn
+from models.T5 import SimpleT5Model
+from utils.benchmark import argument_parser, parse_arguments, timed, randomize_batch_norms
+
+def build_model(reduction_policy):
+    cfg = EasyDict({'TASK'              : {'PRETRAIN': False, 'PRETRAIN_SETTING': 'Attention', 'PRETRAIN_DIFFERENCE': True,
+                                           'DIFFERENCE_TYPE': 'Skeleton', 'DIFFERENCE_SETTING': 'Subtraction'},
+                    'TRANSFORMATION'    : {'REDUCTION_POLICY': reduction_policy},
+                    'BRANCH'            : 1})
+    t5_config = T5Config(vocab_size=32128, d_model=256, d_kv=32, d_ff=1024, num_layers=2, num_decoder_layers=2, num_heads=8,
+                         decoder_start_token_id=0, pad_token_id=0, eos_token_id=1)
+    # Random batch norm statistics, so the padded frames would leak into the real ones without masking
+    return randomize_batch_norms(SimpleT5Model(cfg, t5_config)).eval()
+
+def random_items(num_videos, min_len, max_len):
+    # Videos of random skeletons, with the item layout of DatasetLoader.__getitem__
+    items = []
+    for i in range(num_videos):
+        length = int(torch.randint(min_len, max_len + 1, ()))
+        items.append((f'video_{i}', torch.randn(6, length, 22), torch.ones(22), torch.randn(6, length, 22), torch.tensor(length),
+                      '', torch.empty(0), torch.tensor([1]), None))
+    return items
+
+def trim(sequence, eos_token_id):
+    eos = (sequence == eos_token_id).nonzero()
+    return sequence[:eos[0, 0] + 1].tolist() if len(eos) > 0 else sequence.tolist()
+
+def run(model, items, batch_size, prompt_ids):
+    sequences, att_nodes = [], []
+    with torch.no_grad():
+        for i in range(0, len(items), batch_size):
+            (video_name, keypoints, keypoints_mask, standard, seq_len, _, subtraction, _, _, _, standard_key) = collate_fn(items[i:i + batch_size])
+            generated_ids, att_node, _, _, _ = model.evaluate(  video_name           = video_name,
+                                                                input_embedding      = keypoints,
+                                                                input_embedding_mask = keypoints_mask,
+                                                                standard             = standard,
+                                                                seq_len              = seq_len,
+                                                                decoder_input_ids    = prompt_ids.repeat(len(video_name), 1),
+                                                                subtraction          = subtraction,
+                                                                standard_key         = standard_key)
+            for j, length in enumerate(seq_len.tolist()):
+                sequences.append(trim(generated_ids[j], model.t5.config.eos_token_id))
+                att_nodes.append(att_node[j, :, :length])
+    return sequences, att_nodes
+
+def main():
+    parser = argument_parser()
+    parser.add_argument('--num_videos', type=int, default=32)
+    parser.add_argument('--min_len', type=int, default=30)
+    parser.add_argument('--max_len', type=int, default=120)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--reduction_policy', default='TIME_POOL', choices=['TIME_POOL', 'SKELETON_POOL'])
+    args = parse_arguments(parser)
+
+    model = build_model(args.reduction_policy)
+    items = random_items(args.num_videos, args.min_len, args.max_len)
+    prompt_ids = torch.randint(2, 32128, (1, 4))
+
+    reference = None
+    print(f"{args.num_videos} videos of {args.min_len} to {args.max_len} frames, {args.reduction_policy}, {torch.get_num_threads()} threads")
+    for batch_size in args.batch_sizes:
+        (sequences, att_nodes), seconds = timed(lambda: run(model, items, batch_size, prompt_ids))
+        speed = len(items) / seconds
+        if reference is None:
+            reference = (sequences, att_nodes)
+        same_tokens = sum(a == b for a, b in zip(sequences, reference[0]))
+        node_error  = max((a - b).abs().max().item() for a, b in zip(att_nodes, reference[1]))
+        print(f"batch size {batch_size:3d} : {speed:8.2f} videos/s, {same_tokens}/{len(items)} sequences identical to "
+              f"batch size {args.batch_sizes[0]}, max attention node difference {node_error:.1e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+'''
+    Caption metrics (utils/caption_metrics.py) on the references of a test pickle and random predictions drawn from other
+    references : time of the first evaluation (reference statistics included), of a later one and with worker processes.
+    When NLGMetricverse is installed, its scores and time on the same predictions are printed too.
+
+    $ python utils/benchmark_caption_metrics.py --pkl_file <test pickle> --workers 4
+    $ python utils/benchmark_caption_metrics.py --num_videos 2000
+'''
+import os, sys, random
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from utils.caption_metrics import CaptionMetrics
+from utils.benchmark import argument_parser, parse_arguments, timed
+
+def random_references(num_videos, rng):
+    words = ("the left right knee arm hip shoulder bends too early late keep your body straight rotate faster slower during "
+             "jump landing take off spin and with more speed").split()
+    sentence = lambda: ' '.join(rng.choice(words) for _ in range(rng.randint(5, 30)))
+    return {f'video_{i}': [sentence() for _ in range(rng.randint(1, 3))] for i in range(num_videos)}
+
+def main():
+    parser = argument_parser(threads=False)
+    parser.add_argument('--pkl_file', default=None, help='test pickle, random references when not given')
+    parser.add_argument('--num_videos', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parse_arguments(parser)
+
+    rng = random.Random(args.seed)
+    if args.pkl_file is not None:
+        from cider import readPickle, getGTCaptions
+        gts = getGTCaptions(readPickle(args.pkl_file))
+        gts = {name: references for name, references in gts.items() if name != 'standard' and len(references) > 0}
+    else:
+        gts = random_references(args.num_videos, rng)
+    # Predictions made of the references of other videos, with some overlap
+    names = sorted(gts)
+    predictions = {}
+    for name in names:
+        references = gts[rng.choice(names)]
+        predictions[name] = references if isinstance(references, str) else references[0]
+
+    metrics, build_time = timed(lambda: CaptionMetrics(gts))
+    scores, first_time = timed(lambda: metrics(predictions))
+    _, cached_time = timed(lambda: metrics(predictions))
+    parallel_scores, parallel_time = timed(lambda: metrics(predictions, workers=args.workers))
+    print(f"{len(names)} videos")
+    print(f"reference statistics : {build_time:6.2f} s")
+    print(f"first evaluation     : {first_time:6.2f} s, {scores}")
+    print(f"later evaluation     : {cached_time:6.2f} s")
+    print(f"{args.workers} workers            : {parallel_time:6.2f} s, same scores : {parallel_scores == scores}")
+
+    try:
+        from nlgmetricverse import NLGMetricverse, load_metric
+    except ImportError:
+        return
+    evaluator = NLGMetricverse([load_metric("bleu", resulting_name="bleu_1", compute_kwargs={"max_order": 1}),
+                                load_metric("bleu", resulting_name="bleu_4", compute_kwargs={"max_order": 4}),
+                                load_metric("rouge"), load_metric("cider")])
+    reference, nlg_time = timed(lambda: evaluator(predictions=[predictions[name] for name in names],
+                                                  references=[gts[name] for name in names], reduce_fn="max"))
+    reference = {'bleu_1': reference['bleu_1']['score'], 'bleu_4': reference['bleu_4']['score'],
+                 'rouge': reference['rouge']['rougeL'], 'cider': reference['cider']['score']}
+    print(f"NLGMetricverse       : {nlg_time:6.2f} s, {reference}")
+
+if __name__ == "__main__":
+    main()
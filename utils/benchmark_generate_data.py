@@ -0,0 +1,42 @@
+'''
+    Micro-benchmark of the skeleton-to-tensor conversion used by DatasetLoader.
+    Compares the vectorized generate_data_batch against the original per-frame / per-joint loop (tests/reference.py)
+    and checks that both produce exactly the same float32 tensors, as tests/test_generate_data.py does.
+
+    $ python utils/benchmark_generate_data.py --num_sequences 2000 --min_len 20 --max_len 300
+'''
+import os, sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+os.environ.setdefault('USER', 'benchmark')
+from dataloaders.Dataset import generate_data_batch
+from utils.benchmark import argument_parser, parse_arguments, timed
+from tests.reference import generate_data_loop
+
+def main():
+    parser = argument_parser(threads=False)
+    parser.add_argument('--num_sequences', type=int, default=1000)
+    parser.add_argument('--min_len', type=int, default=20)
+    parser.add_argument('--max_len', type=int, default=300)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float64'])
+    args = parse_arguments(parser)
+
+    rng = np.random.default_rng(args.seed)
+    keypoints_list = [rng.standard_normal((rng.integers(args.min_len, args.max_len + 1), 66)).astype(args.dtype)
+                      for _ in range(args.num_sequences)]
+    num_frames = sum(len(keypoints) for keypoints in keypoints_list)
+
+    reference, loop_time = timed(lambda: [generate_data_loop(keypoints).astype(np.float32) for keypoints in keypoints_list])
+    vectorized, vectorized_time = timed(lambda: generate_data_batch(keypoints_list))
+
+    for ref, out in zip(reference, vectorized):
+        assert ref.shape == out.shape and out.dtype == np.float32, f"{ref.shape} != {out.shape}"
+        assert np.array_equal(ref, out), "Vectorized output does not match the loop implementation"
+
+    print(f"{args.num_sequences} sequences, {num_frames} frames ({args.dtype} input)")
+    print(f"loop       : {loop_time * 1000:10.1f} ms")
+    print(f"vectorized : {vectorized_time * 1000:10.1f} ms")
+    print(f"speedup    : {loop_time / vectorized_time:10.1f} x, outputs match exactly")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+'''
+    Fused spatial graph convolution (TASK.FUSED_GRAPH_CONV) on CPU : time of every spatial graph convolution of STA-GCN
+    with the einsum and the fused path on its real input, then the whole STA-GCN forward with each, and the largest
+    relative difference of the outputs. The batch normalization statistics are randomized.
+
+    $ python utils/benchmark_graph_conv.py --num_frames 64 256 1024
+'''
+import os, sys
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from models.STAGCN import STA_GCN
+from net.Utils_attention.graph_convolution import Stgc_block
+from utils.benchmark import argument_parser, parse_arguments, measure, randomize_batch_norms
+
+def relative_error(output, reference):
+    return (output - reference).abs().max().item() / reference.abs().max().item()
+
+def main():
+    parser = argument_parser(repeat=3)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--num_frames', type=int, nargs='+', default=[64, 256, 1024])
+    parser.add_argument('--pretrain_setting', default='Attention', choices=['Attention', 'STAGCN'])
+    parser.add_argument('--lora', action='store_true', help='finetuning blocks (lora.Conv2d) instead of pretraining ones')
+    args = parse_arguments(parser)
+
+    stagcn = STA_GCN(num_class=1024, in_channels=6, residual=True, dropout=0.5, t_kernel_size=9, layout='SMPL', strategy='spatial',
+                     hop_size=3, num_att_A=4, PRETRAIN_SETTING=args.pretrain_setting, PRETRAIN=not args.lora)
+    stagcn = randomize_batch_norms(stagcn).eval()
+    blocks = [(name, module) for name, module in stagcn.named_modules() if isinstance(module, Stgc_block)]
+
+    print(f"batch {args.batch_size}, {args.pretrain_setting}, {'lora' if args.lora else 'pretrain'} blocks, {torch.get_num_threads()} threads")
+    for num_frames in args.num_frames:
+        x = torch.randn(args.batch_size, 6, num_frames, 22)
+
+        # Inputs of every spatial graph convolution
+        inputs = {}
+        hooks = [block.sgc.register_forward_hook(lambda module, input, output, name=name: inputs.__setitem__(name, input))
+                 for name, block in blocks]
+        stagcn.set_fused_graph_conv(False)
+        (reference, _, _), einsum_time = measure(lambda: stagcn(x), args.repeat)
+        for hook in hooks:
+            hook.remove()
+
+        print(f"\n{num_frames} frames")
+        for name, block in blocks:
+            block.sgc.fused = False
+            einsum_output, block_einsum_time = measure(lambda: block.sgc(*inputs[name]), args.repeat)
+            block.sgc.fused = True
+            fused_output, block_fused_time = measure(lambda: block.sgc(*inputs[name]), args.repeat)
+            block.sgc.fused = False
+            print(f"  {name:36s} {type(block.sgc).__name__:10s} {inputs[name][0].shape[1]:4d} -> {fused_output.shape[1]:4d} : "
+                  f"einsum {block_einsum_time * 1000:8.2f} ms, fused {block_fused_time * 1000:8.2f} ms, "
+                  f"relative error {relative_error(fused_output, einsum_output):.1e}")
+
+        print(f"  STA-GCN forward, einsum  : {einsum_time * 1000:8.1f} ms")
+        for layers in [True, 'auto']:
+            stagcn.set_fused_graph_conv(layers)
+            (output, _, _), fused_time = measure(lambda: stagcn(x), args.repeat)
+            print(f"  STA-GCN forward, {str(layers):6s}  : {fused_time * 1000:8.1f} ms, speedup {einsum_time / fused_time:5.2f} x, "
+                  f"relative error {relative_error(output, reference):.1e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+'''
+    SimpleT5Model.optimize_for_inference on CPU : time of the STA-GCN + Transformation encoding and of the whole
+    evaluate call before and after, the largest difference of the embeddings and whether the generated tokens match.
+    Runs on a randomly initialized finetuning model with a small T5, random batch norm statistics and random LoRA updates.
+
+    $ python utils/benchmark_inference_optimization.py --batch_size 4 --max_len 120
+'''
+import os, sys, copy
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+os.environ.setdefault('USER', 'benchmark')
+from dataloaders import collate_fn
+from utils.benchmark import argument_parser, parse_arguments, measure
+from utils.benchmark_batched_eval import build_model, random_items
+
+def count_modules(model, types):
+    return sum(isinstance(module, types) for module in model.modules())
+
+def main():
+    parser = argument_parser(repeat=3)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--min_len', type=int, default=30)
+    parser.add_argument('--max_len', type=int, default=120)
+    parser.add_argument('--reduction_policy', default='TIME_POOL', choices=['TIME_POOL', 'SKELETON_POOL'])
+    args = parse_arguments(parser)
+
+    model = build_model(args.reduction_policy)
+    for name, parameter in model.named_parameters():
+        if 'lora_B' in name:
+            parameter.data.normal_(0, 0.02)
+    optimized = copy.deepcopy(model).optimize_for_inference()
+
+    items = random_items(args.batch_size, args.min_len, args.max_len)
+    (video_name, keypoints, keypoints_mask, standard, seq_len, _, subtraction, _, _, _, standard_key) = collate_fn(items)
+    inputs = dict(video_name=video_name, input_embedding=keypoints, input_embedding_mask=keypoints_mask, standard=standard,
+                  seq_len=seq_len, subtraction=subtraction, standard_key=standard_key, mask_padded_frames=True,
+                  decoder_input_ids=torch.randint(2, 32128, (1, 4)).repeat(len(items), 1))
+
+    types = (torch.nn.BatchNorm1d, torch.nn.BatchNorm2d, torch.nn.Dropout)
+    print(f"batch {args.batch_size}, {args.min_len} to {args.max_len} frames, {args.reduction_policy}, {torch.get_num_threads()} threads")
+    print(f"batch norm / dropout modules : {count_modules(model, types)} -> {count_modules(optimized, types)}")
+    (embedding, node, _, _), encode_time = measure(lambda: model.encode(**inputs), args.repeat)
+    (optimized_embedding, optimized_node, _, _), optimized_encode_time = measure(lambda: optimized.encode(**inputs), args.repeat)
+    print(f"encode   : {encode_time * 1000:8.1f} ms -> {optimized_encode_time * 1000:8.1f} ms, speedup {encode_time / optimized_encode_time:5.2f} x, "
+          f"max difference {(embedding - optimized_embedding).abs().max().item():.1e} (embedding), "
+          f"{(node - optimized_node).abs().max().item():.1e} (attention node)")
+    (generated_ids, _, _, _, _), evaluate_time = measure(lambda: model.evaluate(**inputs), args.repeat)
+    (optimized_ids, _, _, _, _), optimized_evaluate_time = measure(lambda: optimized.evaluate(**inputs), args.repeat)
+    print(f"evaluate : {evaluate_time * 1000:8.1f} ms -> {optimized_evaluate_time * 1000:8.1f} ms, speedup {evaluate_time / optimized_evaluate_time:5.2f} x, "
+          f"generated tokens identical : {torch.equal(generated_ids, optimized_ids)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+'''
+    LoRA temporal convolution of the finetuning STA-GCN blocks : parameters, FLOPs and CPU latency of the square
+    t x t lora.Conv2d built before against TemporalConvLoRA with the (t, 1) kernel of pretraining, for every finetuning
+    block, then the whole finetuning STA-GCN forward with TemporalConvLoRA.
+
+    $ python utils/benchmark_lora_temporal_conv.py --num_frames 256
+'''
+import os, sys
+import torch
+import loralib as lora
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from models.STAGCN import STA_GCN
+from net.Utils_attention.graph_convolution import TemporalConvLoRA
+from utils.benchmark import argument_parser, parse_arguments, measure
+
+def latency(forward, repeat):
+    return measure(forward, repeat)[1]
+
+def conv_flops(conv, x):
+    # Multiply-accumulates of the convolution with the LoRA update merged
+    with torch.no_grad():
+        output = conv(x)
+    return output.numel() * conv.conv.weight[0].numel()
+
+def main():
+    parser = argument_parser(repeat=3)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--num_frames', type=int, default=256)
+    parser.add_argument('--t_kernel_size', type=int, default=9)
+    args = parse_arguments(parser)
+
+    stagcn = STA_GCN(num_class=1024, in_channels=6, residual=True, dropout=0.5, t_kernel_size=args.t_kernel_size, layout='SMPL',
+                     strategy='spatial', hop_size=3, num_att_A=4, PRETRAIN_SETTING='Attention', PRETRAIN=False).eval()
+    temporal_convs = [(name, module) for name, module in stagcn.named_modules() if isinstance(module, TemporalConvLoRA)]
+
+    print(f"batch {args.batch_size}, {args.num_frames} frames, {torch.get_num_threads()} threads")
+    total = torch.zeros(6)
+    for name, conv in temporal_convs:
+        channels = conv.conv.in_channels
+        square = lora.Conv2d(channels, channels, kernel_size=args.t_kernel_size, stride=1, padding=(args.t_kernel_size - 1) // 2,
+                             r=32, lora_alpha=64, lora_dropout=0.1)
+        # Unmerged LoRA as in training, ConvLoRA.train does not return the module
+        square.train()
+        conv.train()
+        x = torch.randn(args.batch_size, channels, args.num_frames, 22)
+        row = torch.tensor([sum(p.numel() for p in square.parameters()), sum(p.numel() for p in conv.parameters()),
+                            conv_flops(square, x), conv_flops(conv, x),
+                            latency(lambda: square(x), args.repeat), latency(lambda: conv(x), args.repeat)], dtype=torch.float64)
+        total += row
+        print(f"  {name:36s} parameters {row[0] / 1e6:6.2f} M -> {row[1] / 1e6:6.2f} M, GMAC {row[2] / 1e9:7.2f} -> {row[3] / 1e9:6.2f}, "
+              f"latency {row[4] * 1000:8.1f} ms -> {row[5] * 1000:6.1f} ms")
+    print(f"  total : parameters {total[0] / 1e6:6.2f} M -> {total[1] / 1e6:6.2f} M, GMAC {total[2] / 1e9:7.2f} -> {total[3] / 1e9:6.2f}, "
+          f"latency {total[4] * 1000:8.1f} ms -> {total[5] * 1000:6.1f} ms")
+
+    x = torch.randn(args.batch_size, 6, args.num_frames, 22)
+    print(f"finetuning STA-GCN forward with TemporalConvLoRA : {latency(lambda: stagcn(x), args.repeat) * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
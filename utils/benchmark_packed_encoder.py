@@ -0,0 +1,55 @@
+'''
+    Packed T5 encoder (TRANSFORMATION.PACK_ENCODER) on CPU : time of SimpleT5Model.run_encoder on a padded batch
+    against the packed one, and the largest difference of the encoder states of the real frames.
+    Runs on a randomly initialized small T5, so no t5-base download is needed.
+
+    $ python utils/benchmark_packed_encoder.py --batch_size 16 --min_len 30 --max_len 300
+'''
+import os, sys
+import torch
+from easydict import EasyDict
+from transformers import T5Config
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+os.environ.setdefault('USER', 'benchmark')
+from models.T5 import SimpleT5Model
+from utils.benchmark import argument_parser, parse_arguments, measure
+
+def build_model():
+    cfg = EasyDict({'TASK'              : {'PRETRAIN': False, 'PRETRAIN_SETTING': 'Attention', 'PRETRAIN_DIFFERENCE': True,
+                                           'DIFFERENCE_TYPE': 'Skeleton', 'DIFFERENCE_SETTING': 'Subtraction'},
+                    'TRANSFORMATION'    : {'REDUCTION_POLICY': 'SKELETON_POOL', 'PACK_ENCODER': True},
+                    'BRANCH'            : 1})
+    t5_config = T5Config(vocab_size=32128, d_model=256, d_kv=32, d_ff=1024, num_layers=4, num_decoder_layers=2, num_heads=8,
+                         decoder_start_token_id=0, pad_token_id=0, eos_token_id=1)
+    return SimpleT5Model(cfg, t5_config).eval()
+
+def main():
+    parser = argument_parser(repeat=3)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--min_len', type=int, default=30)
+    parser.add_argument('--max_len', type=int, default=300)
+    args = parse_arguments(parser)
+
+    model = build_model()
+    if model.packed_mask_format is None:
+        print("The T5 encoder of this transformers version cannot be packed, see models.T5.packed_mask_format")
+        return
+    seq_len = torch.randint(args.min_len, args.max_len + 1, (args.batch_size,))
+    seq_len[0] = args.max_len
+    embedding = torch.randn(args.batch_size, args.max_len, model.t5.config.d_model)
+    mask = (torch.arange(args.max_len).unsqueeze(0) < seq_len.unsqueeze(1)).long()
+
+    model.pack_encoder = False
+    padded, padded_time = measure(lambda: model.run_encoder(embedding, mask).last_hidden_state, args.repeat)
+    model.pack_encoder = True
+    packed, packed_time = measure(lambda: model.run_encoder(embedding, mask).last_hidden_state, args.repeat)
+
+    valid = mask.bool()
+    error = (padded[valid] - packed[valid]).abs().max().item()
+    print(f"batch {args.batch_size}, {args.min_len} to {args.max_len} frames, {seq_len.sum().item()} real of "
+          f"{args.batch_size * args.max_len} padded tokens, {torch.get_num_threads()} threads, mask format {model.packed_mask_format}")
+    print(f"padded encoder : {padded_time * 1000:10.1f} ms")
+    print(f"packed encoder : {packed_time * 1000:10.1f} ms, speedup {padded_time / packed_time:5.2f} x, max difference {error:.2e}")
+
+if __name__ == "__main__":
+    main()
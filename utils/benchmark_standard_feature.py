@@ -0,0 +1,40 @@
+'''
+    Correctness check and timing of SimpleT5Model.get_standard_feature, the pretraining standard motion
+    (first frame held for the valid length of every sequence), against the former element-wise loop
+    (tests/reference.py), the check tests/test_standard_feature.py runs.
+
+    $ python utils/benchmark_standard_feature.py --batch_size 16 --max_len 200 --device cuda
+'''
+import os, sys
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+os.environ.setdefault('USER', 'benchmark')
+from models.T5 import SimpleT5Model
+from utils.benchmark import argument_parser, parse_arguments, timed
+from tests.reference import get_standard_feature_loop
+
+def main():
+    parser = argument_parser(device=True, threads=False)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_len', type=int, default=200)
+    args = parse_arguments(parser)
+    device = args.device
+
+    seq_len = torch.randint(0, args.max_len + 1, (args.batch_size,))
+    seq_len[0] = args.max_len
+    # Padded frames are zero like the output of collate_fn, but random values check that they are left untouched
+    keypoints = torch.randn(args.batch_size, 6, args.max_len, 22, device=device)
+    original = keypoints.clone()
+
+    standard, vectorized_time = timed(lambda: SimpleT5Model.get_standard_feature(None, keypoints, seq_len.to(device), True, None), device)
+    assert torch.equal(keypoints, original), "get_standard_feature must not write into its input"
+    reference, loop_time = timed(lambda: get_standard_feature_loop(keypoints.clone(), seq_len), device)
+
+    assert torch.equal(standard, reference), "get_standard_feature does not match the loop implementation"
+    print(f"batch {args.batch_size}, up to {args.max_len} frames on {device}")
+    print(f"loop       : {loop_time * 1000:10.2f} ms")
+    print(f"vectorized : {vectorized_time * 1000:10.2f} ms")
+    print("outputs match exactly, input left untouched")
+
+if __name__ == "__main__":
+    main()
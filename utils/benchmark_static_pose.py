@@ -0,0 +1,47 @@
+'''
+    Correctness check and timing of STA_GCN.forward_static, the static-pose fast path of the pretraining
+    standard motion (TASK.STATIC_POSE_FAST_PATH), against the full STA_GCN forward in eval mode.
+    The batch normalization statistics are randomized so the comparison does not run on an identity network.
+
+    $ python utils/benchmark_static_pose.py --batch_size 16 --max_len 600 --radius 60 20
+'''
+import os, sys
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from models.STAGCN import STA_GCN
+from models.T5 import SimpleT5Model
+from utils.benchmark import argument_parser, parse_arguments, measure, randomize_batch_norms
+
+def main():
+    parser = argument_parser(repeat=3, device=True, threads=False)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--min_len', type=int, default=20)
+    parser.add_argument('--max_len', type=int, default=600)
+    parser.add_argument('--radius', type=int, nargs='*', default=[], help='radii to compare on top of the exact one')
+    args = parse_arguments(parser)
+    device = args.device
+
+    stagcn = STA_GCN(num_class=1024, in_channels=6, residual=True, dropout=0.5, t_kernel_size=9, layout='SMPL',
+                     strategy='spatial', hop_size=3, num_att_A=4, PRETRAIN_SETTING='Attention', PRETRAIN=True)
+    stagcn = randomize_batch_norms(stagcn).to(device).eval()
+
+    seq_len = torch.randint(args.min_len, args.max_len + 1, (args.batch_size,))
+    seq_len[0] = args.max_len
+    keypoints = torch.zeros(args.batch_size, 6, args.max_len, 22)
+    for i, length in enumerate(seq_len.tolist()):
+        keypoints[i, :, :length] = torch.randn(6, length, 22)
+    standard = SimpleT5Model.get_standard_feature(None, keypoints.to(device), seq_len.to(device), True, None)
+
+    (reference, reference_node, reference_A), full_time = measure(lambda: stagcn(standard), args.repeat, device)
+    scale = reference.abs().max().item()
+    print(f"batch {args.batch_size}, {args.min_len} to {args.max_len} frames on {device}, exact radius {stagcn.temporal_radius}")
+    print(f"full forward    : {full_time * 1000:10.1f} ms")
+    for radius in [stagcn.temporal_radius] + args.radius:
+        compressed_frames = stagcn.static_pose_index(seq_len, args.max_len, radius)[0].shape[1]
+        (output, node, A), static_time = measure(lambda: stagcn.forward_static(standard, seq_len, radius), args.repeat, device)
+        error = max((output - reference).abs().max().item() / scale, (A - reference_A).abs().max().item())
+        print(f"radius {radius:4d}     : {static_time * 1000:10.1f} ms, {compressed_frames} frames, "
+              f"speedup {full_time / static_time:5.2f} x, max relative error {error:.2e}")
+
+if __name__ == "__main__":
+    main()
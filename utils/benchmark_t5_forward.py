@@ -0,0 +1,56 @@
+'''
+    CPU throughput comparison of the SimpleT5Model training forward on a tiny randomly initialized T5.
+    two_pass    : the former forward, logits pass + argmax + a second pass with labels for the loss
+    single_pass : the current forward, one pass returning loss and logits together
+    Both run forward + backward, the tokenizer decode of the former forward is not included.
+
+    $ python utils/benchmark_t5_forward.py --batch_size 8 --steps 20
+'''
+import os, sys
+import torch
+from transformers import T5Config, T5ForConditionalGeneration
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from utils.benchmark import argument_parser, parse_arguments, measure
+
+def two_pass(t5, inputs_embeds, attention_mask, decoder_input_ids, labels):
+    logits = t5(inputs_embeds=inputs_embeds, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids).logits
+    argmax = torch.argmax(logits, dim=-1)
+    return t5(inputs_embeds=inputs_embeds, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids, labels=labels)
+
+def single_pass(t5, inputs_embeds, attention_mask, decoder_input_ids, labels):
+    return t5(inputs_embeds=inputs_embeds, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids, labels=labels)
+
+def training_step(forward, t5, inputs):
+    t5.zero_grad()
+    forward(t5, **inputs).loss.backward()
+
+def main():
+    parser = argument_parser()
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--encoder_len', type=int, default=22)
+    parser.add_argument('--decoder_len', type=int, default=159)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    args = parse_arguments(parser)
+
+    config = T5Config(vocab_size=32128, d_model=256, d_kv=32, d_ff=1024, num_layers=2, num_decoder_layers=2, num_heads=8)
+    t5 = T5ForConditionalGeneration(config).train()
+    tgt_batch = torch.randint(1, config.vocab_size, (args.batch_size, args.decoder_len + 1))
+    inputs = {  "inputs_embeds"     : torch.randn(args.batch_size, args.encoder_len, config.d_model),
+                "attention_mask"    : torch.ones(args.batch_size, args.encoder_len),
+                "decoder_input_ids" : tgt_batch[:, :-1],
+                "labels"            : tgt_batch[:, 1:].contiguous()}
+
+    with torch.no_grad():
+        assert torch.equal(two_pass(t5.eval(), **inputs).logits, single_pass(t5.eval(), **inputs).logits)
+    t5.train()
+
+    _, two_pass_time    = measure(lambda: training_step(two_pass, t5, inputs), args.steps, warmup=args.warmup, grad=True)
+    _, single_pass_time = measure(lambda: training_step(single_pass, t5, inputs), args.steps, warmup=args.warmup, grad=True)
+    print(f"batch {args.batch_size}, encoder {args.encoder_len} tokens, decoder {args.decoder_len} tokens, {torch.get_num_threads()} threads")
+    print(f"two_pass    : {1 / two_pass_time:8.2f} steps/s")
+    print(f"single_pass : {1 / single_pass_time:8.2f} steps/s")
+    print(f"speedup     : {two_pass_time / single_pass_time:8.2f} x")
+
+if __name__ == "__main__":
+    main()
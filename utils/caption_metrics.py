@@ -0,0 +1,228 @@
+'''
+    BLEU-1, BLEU-4, ROUGE-L and CIDEr of generated captions, computed in process the way the NLGMetricverse metrics
+    used by evaluation.py compute them ("bleu" with max_order 1 and 4, "rouge" rougeL, "cider", reduce_fn max) :
+    BLEU        corpus BLEU on whitespace tokens, n-gram counts clipped by their maximum count over the references of the
+                prediction, brevity penalty against the shortest reference, no smoothing
+    ROUGE-L     LCS F-measure on the lower cased alphanumeric tokens (rouge_score), no stemming, the best reference of
+                every prediction, averaged over the predictions
+    CIDEr       CIDEr of pycocoevalcap on whitespace tokens : tf-idf n-gram vectors with the document frequency of the
+                references, clipped products, gaussian length penalty (sigma 6), x 10, averaged over the references
+                and the predictions
+
+    The statistics of the references (n-gram ids and counts, ROUGE-L match masks, CIDEr tf-idf vectors) are computed once
+    and kept by CaptionMetrics, an evaluation only counts the n-grams of the predictions. Every n-gram of the references
+    gets an integer id, so clipping and tf-idf products are numpy operations on sorted id arrays.
+
+    metrics = CaptionMetrics(gts)                          # {video name: reference or list of references}
+    scores  = metrics(predictions, workers=4)              # {video name: prediction}
+'''
+import re, math
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+def ngrams(tokens, n):
+    return Counter(zip(*(tokens[i:] for i in range(n))))
+
+def rouge_tokens(text):
+    # Tokenizer of rouge_score without stemming
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).split()
+
+def lcs_length(masks, length, tokens):
+    '''
+        Length of the longest common subsequence of a sequence of `length` tokens and tokens, with the bit parallel
+        algorithm of Allison and Dix. masks[token] has bit i set where the token is at position i of the sequence.
+    '''
+    full = (1 << length) - 1
+    v = full
+    for token in tokens:
+        u = v & masks.get(token, 0)
+        v = ((v + u) | (v - u)) & full
+    return length - bin(v).count('1')
+
+def rouge_l(prediction, reference, masks):
+    if len(prediction) == 0 or len(reference) == 0:
+        return 0.
+    lcs = lcs_length(masks, len(reference), prediction)
+    precision, recall = lcs / len(prediction), lcs / len(reference)
+    return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.
+
+def clipped(ids, values, reference_ids, reference_values):
+    '''
+        Element wise minimum of two sparse vectors (sorted ids and values), with the mask of the ids found in the
+        reference and their positions in it
+    '''
+    if len(reference_ids) == 0 or len(ids) == 0:
+        return np.zeros(0), np.zeros(len(ids), dtype=bool), np.zeros(0, dtype=np.int64)
+    position = np.minimum(np.searchsorted(reference_ids, ids), len(reference_ids) - 1)
+    found = reference_ids[position] == ids
+    position = position[found]
+    return np.minimum(values[found], reference_values[position]), found, position
+
+class CaptionMetrics:
+    '''
+        @references : {name: reference or list of references}, the references of every video that may be scored,
+                      videos with an empty list are left out
+        @max_order  : largest n-gram order of BLEU and CIDEr
+        @sigma      : standard deviation of the CIDEr length penalty
+    '''
+    def __init__(self, references, max_order=4, sigma=6.):
+        self.max_order  = max_order
+        self.sigma      = sigma
+        self.vocabulary = {}
+        self.references = {}
+        for name, texts in references.items():
+            texts = [texts] if isinstance(texts, str) else list(texts)
+            # Videos without reference cannot be scored
+            if len(texts) > 0:
+                self.references[name] = [self.reference_statistics(text) for text in texts]
+        self.bleu_references = {name: self.bleu_reference(references) for name, references in self.references.items()}
+        # CIDEr vectors, depend on the document frequencies of the references that are scored together
+        self.cider_names        = None
+        self.cider_vectors      = None
+        self.cider_frequency    = None
+        self.cider_length       = None
+
+    def counts(self, tokens, add=False):
+        '''
+            Ids, counts and orders (n - 1) of the n-grams of every order, sorted by id. N-grams missing from the
+            vocabulary get the id -1 when add is False.
+        '''
+        ids, counts, orders = [], [], []
+        for n in range(1, self.max_order + 1):
+            counter = ngrams(tokens, n)
+            if add:
+                ids += [self.vocabulary.setdefault(ngram, len(self.vocabulary)) for ngram in counter]
+            else:
+                ids += [self.vocabulary.get(ngram, -1) for ngram in counter]
+            counts += counter.values()
+            orders += [n - 1] * len(counter)
+        ids, counts, orders = np.array(ids, dtype=np.int64), np.array(counts, dtype=np.float64), np.array(orders, dtype=np.int64)
+        sort = np.argsort(ids, kind='stable')
+        return ids[sort], counts[sort], orders[sort]
+
+    def reference_statistics(self, text):
+        tokens = text.split()
+        masks = {}
+        rouge = rouge_tokens(text)
+        for i, token in enumerate(rouge):
+            masks[token] = masks.get(token, 0) | (1 << i)
+        return {'length': len(tokens), 'counts': self.counts(tokens, add=True), 'rouge': rouge, 'rouge_masks': masks}
+
+    def bleu_reference(self, references):
+        # Largest count of every n-gram over the references, for the clipping of BLEU
+        ids = np.concatenate([reference['counts'][0] for reference in references])
+        counts = np.concatenate([reference['counts'][1] for reference in references])
+        unique, inverse = np.unique(ids, return_inverse=True)
+        maximum = np.zeros(len(unique))
+        np.maximum.at(maximum, inverse, counts)
+        return unique, maximum
+
+    def cider_vector(self, counts):
+        # tf-idf vector and norm of every order, ids missing from the references (-1) have a frequency of 0
+        ids, tf, orders = counts
+        values = tf * (self.cider_length - np.log(np.maximum(1., self.cider_frequency[ids])))
+        norm = np.sqrt(np.bincount(orders, values ** 2, minlength=self.max_order))
+        # pycocoevalcap takes the length from the term frequencies of the bigrams
+        length = tf[orders == 1].sum()
+        return (ids, values, orders), norm, length
+
+    def prepare_cider(self, names):
+        if self.cider_names == names:
+            return
+        # Document frequency : number of videos whose references contain the n-gram, the last entry is for the id -1
+        document_frequency = np.zeros(len(self.vocabulary) + 1)
+        for name in names:
+            document_frequency[np.unique(np.concatenate([reference['counts'][0] for reference in self.references[name]]))] += 1
+        self.cider_frequency, self.cider_length = document_frequency, np.log(float(len(names)))
+        self.cider_vectors = {name: [self.cider_vector(reference['counts']) for reference in self.references[name]] for name in names}
+        self.cider_names = names
+
+    def sample_statistics(self, name, prediction):
+        '''
+            BLEU counts (clipped matches and possible matches of every order, prediction length, shortest reference),
+            best ROUGE-L F-measure and CIDEr of one prediction
+        '''
+        references = self.references[name]
+        tokens = prediction.split()
+        counts = self.counts(tokens)
+        minimum, found, _ = clipped(counts[0], counts[1], *self.bleu_references[name])
+        matches = np.bincount(counts[2][found], minimum, minlength=self.max_order)
+        possible = np.maximum(0, len(tokens) - np.arange(self.max_order)).astype(np.float64)
+
+        rouge = rouge_tokens(prediction)
+        rouge_score = max(rouge_l(rouge, reference['rouge'], reference['rouge_masks']) for reference in references)
+
+        (ids, values, orders), norm, length = self.cider_vector(counts)
+        cider = np.zeros(self.max_order)
+        for (reference_ids, reference_values, _), reference_norm, reference_length in self.cider_vectors[name]:
+            minimum, found, position = clipped(ids, values, reference_ids, reference_values)
+            value = np.bincount(orders[found], minimum * reference_values[position], minlength=self.max_order).astype(np.float64)
+            both = (norm != 0) & (reference_norm != 0)
+            value[both] /= norm[both] * reference_norm[both]
+            cider += value * np.e ** (-((length - reference_length) ** 2) / (2 * self.sigma ** 2))
+        cider = np.mean(cider) / len(references) * 10.
+        return matches, possible, len(tokens), min(reference['length'] for reference in references), rouge_score, cider
+
+    def bleu(self, matches, possible, prediction_length, reference_length, max_order):
+        precisions = np.divide(matches[:max_order], possible[:max_order], out=np.zeros(max_order), where=possible[:max_order] > 0)
+        if np.min(precisions) <= 0 or prediction_length == 0:
+            return 0.
+        geometric_mean = math.exp(np.sum(np.log(precisions)) / max_order)
+        ratio = prediction_length / reference_length
+        return geometric_mean * (1. if ratio > 1. else math.exp(1 - 1. / ratio))
+
+    def __call__(self, predictions, workers=1):
+        '''
+            @predictions : {name: prediction}, every name must have references
+            @workers     : processes scoring the predictions in parallel
+            return         {'bleu_1', 'bleu_4', 'rouge', 'cider'}
+        '''
+        names = sorted(predictions)
+        missing = [name for name in names if name not in self.references]
+        if len(missing) > 0:
+            raise KeyError(f"No references for {missing[:10]}")
+        self.prepare_cider(names)
+        if workers > 1 and len(names) > 1:
+            # Contiguous chunks, the statistics are summed in the same order as without workers
+            size = math.ceil(len(names) / workers)
+            chunks = [names[i:i + size] for i in range(0, len(names), size)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=set_worker_metrics, initargs=(self,)) as executor:
+                scored = executor.map(score_chunk, [[(name, predictions[name]) for name in chunk] for chunk in chunks])
+                statistics = [sample for chunk in scored for sample in chunk]
+        else:
+            statistics = [self.sample_statistics(name, predictions[name]) for name in names]
+
+        matches = np.sum([sample[0] for sample in statistics], axis=0)
+        possible = np.sum([sample[1] for sample in statistics], axis=0)
+        prediction_length = sum(sample[2] for sample in statistics)
+        reference_length = sum(sample[3] for sample in statistics)
+        return {'bleu_1'    : self.bleu(matches, possible, prediction_length, reference_length, 1),
+                'bleu_4'    : self.bleu(matches, possible, prediction_length, reference_length, min(4, self.max_order)),
+                'rouge'     : float(np.mean([sample[4] for sample in statistics])),
+                'cider'     : float(np.mean([sample[5] for sample in statistics]))}
+
+# Metrics of the worker processes, set once per process by the pool initializer
+worker_metrics = None
+
+def set_worker_metrics(metrics):
+    global worker_metrics
+    worker_metrics = metrics
+
+def score_chunk(samples):
+    return [worker_metrics.sample_statistics(name, prediction) for name, prediction in samples]
+
+# CaptionMetrics kept between evaluations, by key
+cached_metrics = {}
+
+def caption_metrics(key, references):
+    '''
+        CaptionMetrics of the references, reused by the next call with the same key, e.g. the test pickle and its
+        modification time, so the reference statistics are computed once per test set. A key of None is never cached.
+    '''
+    if key is None:
+        return CaptionMetrics(references)
+    if key not in cached_metrics:
+        cached_metrics.clear()
+        cached_metrics[key] = CaptionMetrics(references)
+    return cached_metrics[key]
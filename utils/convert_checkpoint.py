@@ -0,0 +1,37 @@
+'''
+    Converts a pretraining checkpoint for finetuning : the nn.Conv2d weights of the STA-GCN blocks that are LoRA
+    convolutions in finetuning are renamed to <name>.conv.weight, the weights of another shape are dropped
+    (see models.convert_lora_state). load_checkpoint does the same on the fly, this writes the converted file once.
+
+    $ python utils/convert_checkpoint.py --input pretrain_checkpoints/checkpoint_epoch_00008.pth --output finetune_init.pth
+'''
+import os, sys
+import argparse
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from models import convert_lora_state
+from models.STAGCN import STA_GCN
+from models.train_state import read_checkpoint
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--pretrain_setting', default='Attention', choices=['Attention', 'STAGCN'])
+    args = parser.parse_args()
+
+    # Same STA-GCN as SimpleT5Model in finetuning
+    stagcn = STA_GCN(num_class=1024, in_channels=6, residual=True, dropout=0.5, t_kernel_size=9, layout='SMPL', strategy='spatial',
+                     hop_size=3, num_att_A=4, PRETRAIN_SETTING=args.pretrain_setting, PRETRAIN=False)
+    model_state = {f'stagcn.{k}': v for k, v in stagcn.state_dict().items()}
+
+    checkpoint = read_checkpoint(args.input)
+    checkpoint['model_state'], renamed, dropped = convert_lora_state(checkpoint['model_state'], model_state)
+    missing = [k for k in model_state if k not in checkpoint['model_state'] and 'lora_' not in k]
+    torch.save(checkpoint, args.output)
+    print(f"renamed {len(renamed)} weights, dropped {len(dropped)} : {dropped}")
+    print(f"STA-GCN weights still missing (not LoRA) : {missing}")
+    print(f"saved {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,101 @@
+import os
+import torch
 import torch.distributed as dist
 
 def is_root_proc():
-    return dist.get_rank() == 0
\ No newline at end of file
+    return dist.get_rank() == 0
+
+def init_distributed(backend='auto'):
+    '''
+        Starts the process group and selects the device of this process.
+        @backend : 'nccl' (one GPU per process), 'gloo' (CPU processes), 'none' (a single process, on the GPU when there
+                   is one) or 'auto', nccl when CUDA is available and gloo otherwise.
+        When the script is not started by torchrun (no WORLD_SIZE) the process forms a group of its own, without any
+        port, so the collective calls of training and evaluation work unchanged.
+        return     the torch.device of this process
+    '''
+    if backend == 'auto':
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl' and not torch.cuda.is_available():
+        raise RuntimeError("The nccl backend needs CUDA devices, use the gloo backend on CPU nodes")
+    if backend == 'none' and int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        raise RuntimeError("The none backend runs a single process, use nccl or gloo with torchrun")
+
+    if backend == 'nccl' or backend == 'none' and torch.cuda.is_available():
+        # LOCAL_RANK is the rank on this node, set by torchrun
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)) % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+
+    process_group_backend = 'gloo' if backend == 'none' else backend
+    if 'WORLD_SIZE' in os.environ and backend != 'none':
+        dist.init_process_group(backend=process_group_backend, init_method='env://')
+    else:
+        dist.init_process_group(backend=process_group_backend, store=dist.HashStore(), rank=0, world_size=1)
+    return device
+
+def gather_results(*results, dst=0):
+    '''
+        Merges the {video name: value} dicts of every process on rank dst, in one collective call whatever the number
+        of videos. A name found on several processes (the DistributedSampler repeats samples to even out the shards,
+        a video with several labels is evaluated once per label) is kept once, with its first value.
+        @results : dicts of this process, e.g. the decoded texts and the attention of every video
+        return     the merged dicts on rank dst, in the order of results, None on the other ranks
+    '''
+    if dist.get_world_size() == 1:
+        gathered = [results]
+    else:
+        gathered = [None] * dist.get_world_size() if dist.get_rank() == dst else None
+        dist.gather_object(results, gathered, dst=dst)
+    if dist.get_rank() != dst:
+        return None
+    merged = tuple({} for _ in results)
+    for process_results in gathered:
+        for merged_dict, process_dict in zip(merged, process_results):
+            for name, value in process_dict.items():
+                merged_dict.setdefault(name, value)
+    return merged
+
+def wrap_model(model, device, **kwargs):
+    # DistributedDataParallel on the device of this process, device_ids is only given for a GPU
+    if device.type == 'cuda':
+        kwargs.update(device_ids=[device], output_device=device)
+    return torch.nn.parallel.DistributedDataParallel(model.to(device), **kwargs)
+
+class DistributedMean:
+    '''
+        Running mean of a scalar metric (e.g. the training loss) over the steps and the processes.
+        update() only adds the value to a sum kept on the device, without a collective or a device to host copy.
+        sync() all-reduces the sum and the count of the values added since the last sync, once for all of them, and is
+        the only call that waits for the device. It is a collective call, every process has to make it at the same step.
+    '''
+    def __init__(self, device):
+        self.pending        = torch.zeros((), dtype=torch.float64, device=device)
+        self.pending_count  = 0
+        self.total          = 0.
+        self.count          = 0
+
+    @torch.no_grad()
+    def update(self, value):
+        # NaN values count as 0
+        self.pending += torch.nan_to_num(value.detach().double(), nan=0.)
+        self.pending_count += 1
+
+    @torch.no_grad()
+    def sync(self):
+        '''
+            return the mean over every process of all the values added so far
+        '''
+        reduced = torch.stack([self.pending, self.pending.new_tensor(self.pending_count)])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(reduced)
+        total, count = reduced.tolist()
+        self.total += total
+        self.count += int(count)
+        self.pending.zero_()
+        self.pending_count = 0
+        return self.mean()
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else float('nan')
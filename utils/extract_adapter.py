@@ -0,0 +1,34 @@
+'''
+    Writes the adapter of a finetuning checkpoint (see models.adapters) : its LoRA tensors, and with --base the tensors
+    that differ from the pretraining checkpoint it was finetuned from. Load it with models.adapters.load_adapter and
+    swap it with LoRAAdapters.
+
+    $ python utils/extract_adapter.py --checkpoint results/skating/checkpoints/checkpoint_epoch_00050.pth \
+        --base results/pretrain/pretrain_checkpoints/checkpoint_epoch_00008.pth --output skating_adapter.pth
+'''
+import os, sys
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from models.adapters import extract_adapter, save_adapter
+from models.train_state import read_checkpoint
+
+def size(state):
+    return sum(v.numel() * v.element_size() for v in state.values()) / 2 ** 20
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, help='finetuning checkpoint')
+    parser.add_argument('--base', default=None, help='pretraining checkpoint, leave out for a LoRA only adapter')
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    model_state = read_checkpoint(args.checkpoint)['model_state']
+    base_state = read_checkpoint(args.base)['model_state'] if args.base is not None else None
+    adapter = extract_adapter(model_state, base_state)
+    save_adapter(args.output, adapter)
+    lora_tensors = sum('lora_' in k for k in adapter)
+    print(f"{lora_tensors} LoRA tensors, {len(adapter) - lora_tensors} other tensors, "
+          f"{size(adapter):.1f} MiB of {size(model_state):.1f} MiB, saved {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,8 @@ def parse_args():
     parser.add_argument('--multi_label_evals',action='store_true',help='evaluate multiple labels')
     parser.add_argument('--gpt_sim',default=False,action='store_true',help='use gpt to find similarity between predictions and ground truth')
     parser.add_argument('--Finetune', type=bool, default=True)
+    parser.add_argument('--backend', default='auto', choices=['auto','nccl','gloo','none'],
+                        help='distributed backend, auto uses nccl with GPUs and gloo on CPU, none runs a single process')
     args = parser.parse_args()
 
     config = load_config(args)
@@ -13,6 +13,8 @@ import matplotlib.cm as cmx
 import random
 import os, json, math, pickle, matplotlib, torch
 import torch.nn as nn
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from utils.attention_store import AttentionStore
 
 offset = 0.75
 matplotlib.use('Agg')
@@ -238,15 +240,14 @@ def normal_draw(joints,file_name):
 
 if __name__ == '__main__':
 
-    #attention_node_path   = '/home/weihsin/projects/MotionExpertST-GCN/STAGCN_att_node_results_epoch0.json'
-    #attention_matrix_path = '/home/weihsin/projects/MotionExpertST-GCN/STAGCN_att_A_results_epoch0.json'
+    #attention_path        = '/home/weihsin/projects/MotionExpertST-GCN/STAGCN_attention_epoch0'
     #node_coordinate_path  = '/home/weihsin/datasets/FigureSkate/HumanML3D_g/global_human_test.pkl'
-    attention_node_path   = '/home/weihsin/projects/MotionExpert/STAGCN_output_finetune/att_node_results_epoch9.json'
-    attention_matrix_path = '/home/weihsin/projects/MotionExpert/STAGCN_output_finetune/att_A_results_epoch9.json'
+    # attention_epoch<N>.bin / attention_epoch<N>.index.json written by evaluation.py
+    attention_path        = '/home/weihsin/projects/MotionExpert/STAGCN_output_finetune/attention_epoch9'
     node_coordinate_path  = '/home/weihsin/datasets/VQA/test_local.pkl'
 
-    with open(attention_node_path) as f:         attention_node   = json.load(f)
-    with open(attention_matrix_path) as f:       attention_matrix = json.load(f)
+    # Only the maps of the drawn videos are read from the store
+    attention_store = AttentionStore(attention_path)
     with open(node_coordinate_path, 'rb') as f:   node_coordinate = pkl.load(f)
     num_length = 0
     for item in node_coordinate:
@@ -264,14 +265,14 @@ if __name__ == '__main__':
             num_length = len(item['features'])
             key = item['video_name']
             print(type(key))
-            print("attention_node",np.shape(attention_node[key]))
+            print("attention_node",np.shape(attention_store.att_node(key)))
 
             color_map = 'jet'
             color_node = []
-            attention_node = np.array(attention_node[key])
-            attention_matrix_new = np.array(attention_matrix[key][0])
+            attention_node = attention_store.att_node(key).astype(np.float32)
+            attention_matrix_new = attention_store.att_A(key)[0].astype(np.float32)
             #for k in range(1,4):
-            #    attention_matrix_new += np.array(attention_matrix[key][1])
+            #    attention_matrix_new += attention_store.att_A(key)[1].astype(np.float32)
             for i in range(0,num_length,1 ):
                 if num_length <= 131 :
                     # 取(i/num_length)*160的 floor值